@@ -1,9 +1,12 @@
 # this file is part of https://github.com/cubinator/ext4
 
+import bisect
+import collections
 import ctypes
 import functools
 import io
 import math
+import mmap
 import queue
 
 
@@ -24,6 +27,133 @@ def wcscmp(str_a, str_b):
   return -1 if tmp < 0 else 1 if tmp > 0 else 0
 
 
+def _struct_from(structure, raw, offset=0):
+  """
+  Interprets the bytes at offset of raw as structure. Writable buffers (bytearray, views of a private mmap) are used in
+  place, everything else is copied.
+  """
+  if not memoryview(raw).readonly:
+    return structure.from_buffer(raw, offset)
+  return structure.from_buffer_copy(raw, offset)
+
+
+def _str2hashbuf(msg, num, unsigned):
+  """
+  Packs up to num * 4 bytes of msg into num 32-bit words as done by the kernel's str2hashbuf
+  """
+  pad = len(msg) | (len(msg) << 8)
+  pad = (pad | (pad << 16)) & 0xFFFFFFFF
+  val = pad
+  buf = []
+
+  for i, c in enumerate(msg[:num * 4]):
+    if not unsigned and c > 0x7F:
+      c -= 0x100
+    val = (c + (val << 8)) & 0xFFFFFFFF
+    if i % 4 == 3:
+      buf.append(val)
+      val = pad
+
+  if len(buf) < num:
+    buf.append(val)
+  while len(buf) < num:
+    buf.append(pad)
+
+  return buf
+
+
+def _rol32(x, s):
+  return ((x << s) | (x >> (32 - s))) & 0xFFFFFFFF
+
+
+def _half_md4_transform(buf, data):
+  """
+  Cut down MD4 transform used by DX_HASH_HALF_MD4, updates buf (4 words) with data (8 words)
+  """
+  def f(x, y, z): return z ^ (x & (y ^ z))
+  def g(x, y, z): return (x & y) + ((x ^ y) & z)
+  def h(x, y, z): return x ^ y ^ z
+
+  a, b, c, d = buf
+  rounds = (
+    (f, 0x0, ((0, 3), (1, 7), (2, 11), (3, 19), (4, 3), (5, 7), (6, 11), (7, 19))),
+    (g, 0x5A827999, ((1, 3), (3, 5), (5, 9), (7, 13), (0, 3), (2, 5), (4, 9), (6, 13))),
+    (h, 0x6ED9EBA1, ((3, 3), (7, 9), (2, 11), (6, 15), (1, 3), (5, 9), (0, 11), (4, 15))),
+  )
+  for func, k, steps in rounds:
+    for i, (word, shift) in enumerate(steps):
+      if i % 4 == 0:
+        a = _rol32((a + func(b, c, d) + data[word] + k) & 0xFFFFFFFF, shift)
+      elif i % 4 == 1:
+        d = _rol32((d + func(a, b, c) + data[word] + k) & 0xFFFFFFFF, shift)
+      elif i % 4 == 2:
+        c = _rol32((c + func(d, a, b) + data[word] + k) & 0xFFFFFFFF, shift)
+      else:
+        b = _rol32((b + func(c, d, a) + data[word] + k) & 0xFFFFFFFF, shift)
+
+  buf[0] = (buf[0] + a) & 0xFFFFFFFF
+  buf[1] = (buf[1] + b) & 0xFFFFFFFF
+  buf[2] = (buf[2] + c) & 0xFFFFFFFF
+  buf[3] = (buf[3] + d) & 0xFFFFFFFF
+
+
+def _tea_transform(buf, data):
+  """
+  TEA transform used by DX_HASH_TEA, updates buf (4 words) with data (4 words)
+  """
+  total = 0
+  b0, b1 = buf[0], buf[1]
+  a, b, c, d = data
+
+  for _ in range(16):
+    total = (total + 0x9E3779B9) & 0xFFFFFFFF
+    b0 = (b0 + ((((b1 << 4) + a) & 0xFFFFFFFF) ^ ((b1 + total) & 0xFFFFFFFF) ^ (((b1 >> 5) + b) & 0xFFFFFFFF))) \
+      & 0xFFFFFFFF
+    b1 = (b1 + ((((b0 << 4) + c) & 0xFFFFFFFF) ^ ((b0 + total) & 0xFFFFFFFF) ^ (((b0 >> 5) + d) & 0xFFFFFFFF))) \
+      & 0xFFFFFFFF
+
+  buf[0] = (buf[0] + b0) & 0xFFFFFFFF
+  buf[1] = (buf[1] + b1) & 0xFFFFFFFF
+
+
+def dx_hash(name, hash_version, seed=None):
+  """
+  Computes the directory index hash of name (bytes) and returns a tuple (hash, minor_hash). hash_version is one of
+  the DxHash.* constants including the *_UNSIGNED variants, seed is the superblock's s_hash_seed (4 words).
+  """
+  buf = [0x67452301, 0xEFCDAB89, 0x98BADCFE, 0x10325476]
+  if seed is not None and any(seed):
+    buf = list(seed)
+
+  unsigned = hash_version >= DxHash.LEGACY_UNSIGNED
+  if hash_version in (DxHash.LEGACY, DxHash.LEGACY_UNSIGNED):
+    hash0, hash1 = 0x12A3FE2D, 0x37ABE8F9
+    for c in name:
+      if not unsigned and c > 0x7F:
+        c -= 0x100
+      value = (hash1 + (hash0 ^ ((c * 7152373) & 0xFFFFFFFF))) & 0xFFFFFFFF
+      if value & 0x80000000:
+        value = (value - 0x7FFFFFFF) & 0xFFFFFFFF
+      hash1, hash0 = hash0, value
+    major, minor = (hash0 << 1) & 0xFFFFFFFF, 0
+  elif hash_version in (DxHash.HALF_MD4, DxHash.HALF_MD4_UNSIGNED):
+    for i in range(0, len(name), 32):
+      _half_md4_transform(buf, _str2hashbuf(name[i:], 8, unsigned))
+    major, minor = buf[1], buf[2]
+  elif hash_version in (DxHash.TEA, DxHash.TEA_UNSIGNED):
+    for i in range(0, len(name), 16):
+      _tea_transform(buf, _str2hashbuf(name[i:], 4, unsigned))
+    major, minor = buf[0], buf[1]
+  else:
+    raise NotImplementedError(f"Directory hash version {hash_version:d} is not implemented yet.")
+
+  major &= ~1
+  if major == 0x7FFFFFFF << 1:
+    major = 0x7FFFFFFE << 1
+
+  return (major, minor)
+
+
 ########################################################################################################################
 ####################################################   EXCEPTIONS   ####################################################
 ########################################################################################################################
@@ -113,6 +243,35 @@ class ext4_dir_entry_2 (ext4_struct):
     struct.name = raw[offset + 0x8: offset + 0x8 + struct.name_len]
     return struct
 
+  def _from_buffer(raw, offset=0, platform64=True):
+    struct = _struct_from(ext4_dir_entry_2, raw, offset)
+    struct.name = bytes(raw[offset + 0x8: offset + 0x8 + struct.name_len])
+    return struct
+
+
+class ext4_dx_countlimit (ext4_struct):
+  _fields_ = [
+    ("limit", ctypes.c_ushort),  # 0x0
+    ("count", ctypes.c_ushort)   # 0x2
+  ]
+
+
+class ext4_dx_entry (ext4_struct):
+  _fields_ = [
+    ("hash", ctypes.c_uint),   # 0x0, Overlaid by ext4_dx_countlimit in the first entry
+    ("block", ctypes.c_uint)   # 0x4
+  ]
+
+
+class ext4_dx_root_info (ext4_struct):
+  _fields_ = [
+    ("reserved_zero", ctypes.c_uint),     # 0x0
+    ("hash_version", ctypes.c_ubyte),     # 0x4
+    ("info_length", ctypes.c_ubyte),      # 0x5
+    ("indirect_levels", ctypes.c_ubyte),  # 0x6
+    ("unused_flags", ctypes.c_ubyte)      # 0x7
+  ]
+
 
 class ext4_extent (ext4_struct):
   _fields_ = [
@@ -278,6 +437,10 @@ class ext4_superblock (ext4_struct):
   # Directory entries record file type (instead of inode flags)
   INCOMPAT_FILETYPE = 0x2
 
+  # s_flags
+  # Directory hashes treat name bytes as unsigned char
+  EXT2_FLAGS_UNSIGNED_HASH = 0x2
+
   _fields_ = [
     ("s_inodes_count", ctypes.c_uint),                 # 0x0000
     ("s_blocks_count_lo", ctypes.c_uint),              # 0x0004
@@ -446,6 +609,11 @@ class ext4_xattr_entry (ext4_struct):
     struct.e_name = raw[offset + 0x10: offset + 0x10 + struct.e_name_len]
     return struct
 
+  def _from_buffer(raw, offset=0, platform64=True):
+    struct = _struct_from(ext4_xattr_entry, raw, offset)
+    struct.e_name = bytes(raw[offset + 0x10: offset + 0x10 + struct.e_name_len])
+    return struct
+
   @property
   def _size(self): return 4 * ((ctypes.sizeof(type(self)) +
                                 self.e_name_len + 3) // 4)  # 4-byte alignment
@@ -468,6 +636,16 @@ class ext4_xattr_ibody_header (ext4_struct):
   ]
 
 
+class DxHash:
+  LEGACY = 0x0  # Legacy
+  HALF_MD4 = 0x1  # Half MD4
+  TEA = 0x2  # Tea
+  LEGACY_UNSIGNED = 0x3  # Legacy, unsigned
+  HALF_MD4_UNSIGNED = 0x4  # Half MD4, unsigned
+  TEA_UNSIGNED = 0x5  # Tea, unsigned
+  SIPHASH = 0x6  # Siphash (casefolded directories)
+
+
 class InodeType:
   UNKNOWN = 0x0  # Unknown file type
   FILE = 0x1  # Regular file
@@ -542,6 +720,64 @@ class MappingEntry:
 
       idx += 1
 
+class LRUCache:
+  """
+  Helper class: Bounded mapping that evicts the least recently used entry and counts hits and misses.
+  """
+
+  def __init__(self, max_size):
+    """
+    Initializes an empty cache holding at most max_size entries. A max_size of 0 disables caching.
+    """
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self._entries = collections.OrderedDict()
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __repr__(self):
+    return f"{type(self).__name__:s}(size = {len(self):d}/{self.max_size:d}, hits = {self.hits:d}, misses = {self.misses:d})"
+
+  def clear(self):
+    """
+    Removes all entries and resets the counters.
+    """
+    self._entries.clear()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key, default=None):
+    """
+    Returns the entry for key (marking it as most recently used) or default, if key is not cached.
+    """
+    try:
+      value = self._entries[key]
+    except KeyError:
+      self.misses += 1
+      return default
+
+    self._entries.move_to_end(key)
+    self.hits += 1
+    return value
+
+  def put(self, key, value):
+    """
+    Adds or replaces the entry for key and evicts the least recently used entries above max_size.
+    """
+    if self.max_size <= 0:
+      return
+
+    self._entries[key] = value
+    self._entries.move_to_end(key)
+
+    while len(self._entries) > self.max_size:
+      self._entries.popitem(last=False)
+
 # None of the following classes preserve the underlying stream's current seek.
 
 
@@ -552,12 +788,23 @@ class Volume:
 
   ROOT_INODE = 2
 
-  def __init__(self, stream, offset=0, ignore_flags=False, ignore_magic=False):
+  def __init__(self, stream, offset=0, ignore_flags=False, ignore_magic=False, cache_size=4096,
+               inode_readahead_blks=0, use_mmap=False):
     """
     Initializes a new ext4 reader at a given offset in stream. If ignore_magic is True, no exception will be thrown,
     when a structure with wrong magic number is found. Analogously passing True to ignore_flags suppresses Exception
     caused by wrong flags.
-    """
+    cache_size bounds the LRU caches of parsed inodes (inode_cache) and resolved extent maps (extent_cache), 0
+    disables them. If inode_readahead_blks is not 0, a cache miss reads that many blocks of the group's inode table at
+    once and caches every inode in them.
+    If use_mmap is True, stream (which must have a fileno) is mapped into memory: read returns memoryview slices of the
+    mapping and structures without fixups are parsed in place instead of being copied. The mapping is private, so
+    the image file is never modified.
+    """
+    self.mmap = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_COPY) if use_mmap else None
+    self.inode_cache = LRUCache(cache_size)
+    self.extent_cache = LRUCache(cache_size)
+    self.inode_readahead_blks = inode_readahead_blks
     self.ignore_flags = ignore_flags
     self.ignore_magic = ignore_magic
     self.offset = offset
@@ -585,6 +832,32 @@ class Volume:
       self.group_descriptors[group_desc_idx] = self.read_struct(
         ext4_group_descriptor, group_desc_offset)
 
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def close(self):
+    """
+    Releases the memory mapping of the image (see use_mmap), the stream is left open. The caches and the structures
+    parsed in place are dropped with it, so the volume can't be read afterwards. While inodes, structures or views
+    read from the mapping are still referenced, the mapping is unmapped once the last of them is collected.
+    """
+    if self.mmap is None:
+      return
+
+    self.inode_cache.clear()
+    self.extent_cache.clear()
+    self.superblock = None
+    self.group_descriptors = None
+    mapping, self.mmap = self.mmap, None
+    try:
+      mapping.close()
+    except BufferError:
+      # exported pointers exist, the mapping is closed when it is garbage collected
+      pass
+
   def __repr__(self):
     return f"{type(self).__name__:s}(volume_name = {self.superblock.s_volume_name!r:s}, uuid = {self.uuid!r:s}, last_mounted = {self.superblock.s_last_mounted!r:s})"
 
@@ -605,7 +878,44 @@ class Volume:
     inode_offset = inode_table_offset + \
       inode_table_entry_idx * self.superblock.s_inode_size
 
-    return Inode(self, inode_offset, inode_idx, file_type)
+    inode = self.inode_cache.get(inode_idx)
+    if inode is None:
+      if self.inode_readahead_blks > 0 and self.superblock.s_inode_size >= ctypes.sizeof(ext4_inode):
+        inode = self._read_inode_table(inode_idx)
+      else:
+        inode = self.read_struct(ext4_inode, inode_offset)
+        self.inode_cache.put(inode_idx, inode)
+
+    return Inode(self, inode_offset, inode_idx, file_type, inode)
+
+  def _read_inode_table(self, inode_idx):
+    """
+    Reads inode_readahead_blks blocks of the inode table starting at the block holding inode_idx with a single read,
+    caches all inodes within and returns the ext4_inode of inode_idx.
+    """
+    group_idx, inode_table_entry_idx = self.get_inode_group(inode_idx)
+    inode_size = self.superblock.s_inode_size
+    inodes_per_block = self.block_size // inode_size
+
+    first_entry_idx = inode_table_entry_idx - inode_table_entry_idx % inodes_per_block
+    entry_count = min(self.inode_readahead_blks * inodes_per_block,
+                      self.superblock.s_inodes_per_group - first_entry_idx)
+
+    table_offset = self.group_descriptors[group_idx].bg_inode_table * self.block_size
+    raw = self.read(table_offset + first_entry_idx * inode_size, entry_count * inode_size)
+
+    first_inode_idx = group_idx * self.superblock.s_inodes_per_group + first_entry_idx + 1
+    result = None
+    for i in range(len(raw) // inode_size):
+      inode = ext4_inode.from_buffer_copy(raw, i * inode_size)
+      self.inode_cache.put(first_inode_idx + i, inode)
+      if first_inode_idx + i == inode_idx:
+        result = inode
+
+    if result is None:
+      raise EndOfStreamError(f"The volume's underlying stream ended before inode {inode_idx:d}.")
+
+    return result
 
   def get_inode_group(self, inode_idx):
     """
@@ -618,17 +928,48 @@ class Volume:
 
   def read(self, offset, byte_len):
     """
-    Returns byte_len bytes at offset within this volume.
+    Returns byte_len bytes at offset within this volume (a memoryview, if the volume is memory-mapped).
     """
+    if self.mmap is not None:
+      start = min(self.offset + offset, len(self.mmap))
+      return memoryview(self.mmap)[start: start + byte_len]
+
     if self.offset + offset != self.stream.tell():
       self.stream.seek(self.offset + offset, io.SEEK_SET)
 
     return self.stream.read(byte_len)
 
+  def readinto(self, offset, buffer):
+    """
+    Reads len(buffer) bytes at offset within this volume into buffer and returns the number of bytes read, which is
+    only less than len(buffer) if the underlying stream ended.
+    """
+    if self.mmap is not None:
+      data = self.read(offset, len(buffer))
+      memoryview(buffer).cast("B")[:len(data)] = data
+      return len(data)
+
+    if self.offset + offset != self.stream.tell():
+      self.stream.seek(self.offset + offset, io.SEEK_SET)
+
+    view = memoryview(buffer).cast("B")
+    pos = 0
+    while pos < len(view):
+      got = self.stream.readinto(view[pos:])
+      if not got:
+        break
+      pos += got
+
+    return pos
+
   def read_struct(self, structure, offset, platform64=None):
     """
     Interprets the bytes at offset as structure and returns the interpreted instance
     """
+    if self.mmap is not None and not hasattr(structure, "_from_buffer_copy") \
+        and self.offset + offset + ctypes.sizeof(structure) <= len(self.mmap):
+      return structure.from_buffer(self.mmap, self.offset + offset)
+
     raw = self.read(offset, ctypes.sizeof(structure))
 
     if hasattr(structure, "_from_buffer_copy"):
@@ -658,17 +999,18 @@ class Inode:
   Provides functionality for parsing inodes and accessing their raw data
   """
 
-  def __init__(self, volume, offset, inode_idx, file_type=InodeType.UNKNOWN):
+  def __init__(self, volume, offset, inode_idx, file_type=InodeType.UNKNOWN, inode=None):
     """
     Initializes a new inode parser at the specified offset within the specified volume. file_type is the file type
-    of the inode as given by the directory entry referring to this inode.
+    of the inode as given by the directory entry referring to this inode. inode is an already parsed ext4_inode
+    structure (e.g. from Volume.inode_cache), if None it is read from offset.
     """
     self.inode_idx = inode_idx
     self.offset = offset
     self.volume = volume
 
     self.file_type = file_type
-    self.inode = volume.read_struct(ext4_inode, offset)
+    self.inode = inode if inode is not None else volume.read_struct(ext4_inode, offset)
 
   def __len__(self):
     """
@@ -707,7 +1049,7 @@ class Inode:
     # Iterator over ext4_xattr_entry structures
     i = 0
     while i < len(raw_data):
-      xattr_entry = ext4_xattr_entry._from_buffer_copy(
+      xattr_entry = ext4_xattr_entry._from_buffer(
         raw_data, i, platform64=self.volume.platform64)
 
       if (xattr_entry.e_name_len | xattr_entry.e_name_index | xattr_entry.e_value_offs | xattr_entry.e_value_inum) == 0:
@@ -733,8 +1075,8 @@ class Inode:
         xattr_value = xattr_inode.open_read().read()
       else:
         # internal xattr
-        xattr_value = raw_data[xattr_entry.e_value_offs +
-                               offset: xattr_entry.e_value_offs + offset + xattr_entry.e_value_size]
+        xattr_value = bytes(raw_data[xattr_entry.e_value_offs +
+                                     offset: xattr_entry.e_value_offs + offset + xattr_entry.e_value_size])
 
       yield (xattr_name, xattr_value)
 
@@ -778,8 +1120,7 @@ class Inode:
         raise Ext4Error(
           f"{current_path!r:s} (Inode {inode_idx:d}) is not a directory.")
 
-      file_name, inode_idx, file_type = next(filter(
-        lambda entry: entry[0] == part, current_inode.open_dir(decode_name)), (None, None, None))
+      file_name, inode_idx, file_type = current_inode.lookup(part, decode_name)
 
       if inode_idx == None:
         current_path = "/".join(relative_path[:i])
@@ -896,6 +1237,8 @@ class Inode:
     special cases (e.g. invalid utf8 characters in entry names) you can try a different decoder (e.g.
     decode_name = lambda raw: raw).
     Default of decode_name = lambda raw: raw.decode("utf8")
+    NOTE: For hash tree directories "." and ".." are yielded first, followed by the entries of the leaf blocks in the
+    order of the hash tree index.
     """
     # Parse args
     if decode_name == None:
@@ -904,28 +1247,194 @@ class Inode:
     if not self.volume.ignore_flags and not self.is_dir:
       raise Ext4Error(f"Inode ({self.inode_idx:d}) is not a directory.")
 
-    # # Hash trees are compatible with linear arrays
-    if (self.inode.i_flags & ext4_inode.EXT4_INDEX_FL) != 0:
-      raise NotImplementedError("Hash trees are not implemented yet.")
+    if self.is_htree:
+      reader = self.open_read()
+      root_block, info, entries = self._dx_root(reader)
 
-    # Read raw directory content
-    raw_data = self.open_read().read()
+      # "." and ".." are the fake directory entries covering the dx_root
+      for dirent in self._parse_dirents(root_block[:0x18]):
+        yield (decode_name(dirent.name), dirent.inode, dirent.file_type)
+
+      for leaf_block in self._dx_leaf_blocks(reader, info, entries):
+        for dirent in self._parse_dirents(self._read_dir_block(reader, leaf_block)):
+          yield (decode_name(dirent.name), dirent.inode, dirent.file_type)
+      return
+
+    yield from self._scan_dir(decode_name)
+
+  def _scan_dir(self, decode_name):
+    """
+    Generator: Yields the directory entries like open_dir, in the order of the directory's blocks without using a hash
+    tree index (its dx_root and dx_node blocks hold no entries in use).
+    """
+    # Read raw directory content into a writable buffer, so the entries are parsed in place
+    raw_data = bytearray(len(self))
+    del raw_data[self.open_read().readinto(raw_data):]
+    for dirent in self._parse_dirents(raw_data):
+      yield (decode_name(dirent.name), dirent.inode, dirent.file_type)
+
+  def _parse_dirents(self, raw_data):
+    """
+    Generator: Parses raw_data (bytes) as a linear array of ext4_dir_entry_2 structures and yields all entries that are
+    in use and are not checksum entries.
+    """
     offset = 0
 
-    while offset < len(raw_data):
-      dirent = ext4_dir_entry_2._from_buffer_copy(
+    while offset + ctypes.sizeof(ext4_dir_entry_2) <= len(raw_data):
+      dirent = ext4_dir_entry_2._from_buffer(
         raw_data, offset, platform64=self.volume.platform64)
 
-      if dirent.file_type != InodeType.CHECKSUM:
-        yield (decode_name(dirent.name), dirent.inode, dirent.file_type)
+      if dirent.rec_len == 0:
+        break
+
+      if dirent.inode != 0 and dirent.file_type != InodeType.CHECKSUM:
+        yield dirent
 
       offset += dirent.rec_len
 
+  @property
+  def is_htree(self):
+    """
+    Indicates whether the directory is indexed by a hash tree.
+    """
+    return (self.inode.i_flags & ext4_inode.EXT4_INDEX_FL) != 0
+
+  def _read_dir_block(self, reader, block_idx):
+    """
+    Returns the directory's file block block_idx
+    """
+    reader.seek(block_idx * self.volume.block_size)
+    raw_block = bytearray(self.volume.block_size)
+    del raw_block[reader.readinto(raw_block):]
+    return raw_block
+
+  def _dx_entries(self, raw_block, offset):
+    """
+    Returns the ext4_dx_entry structures at offset of a dx_root or dx_node block as a list of tuples (hash, block). The
+    first entry has an implicit hash of 0.
+    """
+    count = ext4_dx_countlimit.from_buffer_copy(raw_block, offset).count
+    entries = (ext4_dx_entry * count).from_buffer_copy(raw_block, offset)
+    return [(0 if i == 0 else entry.hash, entry.block & 0x0FFFFFFF) for i, entry in enumerate(entries)]
+
+  def _dx_root(self, reader):
+    """
+    Returns a tuple (raw_block, ext4_dx_root_info, entries) of the hash tree's root block
+    """
+    root_block = self._read_dir_block(reader, 0)
+    info = ext4_dx_root_info.from_buffer_copy(root_block, 0x18)
+
+    if not self.volume.ignore_magic and info.reserved_zero != 0:
+      raise MagicError(f"Invalid dx_root of inode {self.inode_idx:d}: reserved_zero is 0x{info.reserved_zero:X}")
+
+    return (root_block, info, self._dx_entries(root_block, 0x18 + info.info_length))
+
+  def _dx_leaf_blocks(self, reader, info, entries, level=0):
+    """
+    Generator: Yields the file block indices of the hash tree's leaf blocks in index order
+    """
+    for _, block in entries:
+      if level < info.indirect_levels:
+        # dx_node blocks start with a fake directory entry spanning the whole block
+        node_entries = self._dx_entries(self._read_dir_block(reader, block), 0x8)
+        yield from self._dx_leaf_blocks(reader, info, node_entries, level + 1)
+      else:
+        yield block
+
+  def _dx_lookup(self, name):
+    """
+    Looks up name (bytes) through the hash tree index and returns the matching ext4_dir_entry_2 or None. Only the leaf
+    blocks whose hash range covers the name's hash are read.
+    """
+    reader = self.open_read()
+    _, info, entries = self._dx_root(reader)
+
+    hash_version = info.hash_version
+    if hash_version <= DxHash.TEA and \
+        (self.volume.superblock.s_flags & ext4_superblock.EXT2_FLAGS_UNSIGNED_HASH) != 0:
+      hash_version += DxHash.LEGACY_UNSIGNED
+
+    name_hash, _ = dx_hash(name, hash_version, self.volume.superblock.s_hash_seed)
+
+    # (entries, idx) of the root and dx_node blocks down to the leaf block
+    path = []
+    for level in range(info.indirect_levels + 1):
+      idx = bisect.bisect_right([entry_hash for entry_hash, _ in entries], name_hash) - 1
+      path.append((entries, idx))
+      if level < info.indirect_levels:
+        entries = self._dx_entries(self._read_dir_block(reader, entries[idx][1]), 0x8)
+
+    while True:
+      entries, idx = path[-1]
+      for dirent in self._parse_dirents(self._read_dir_block(reader, entries[idx][1])):
+        if dirent.name == name:
+          return dirent
+
+      if not self._dx_next_leaf(reader, path, name_hash):
+        return None
+
+  def _dx_next_leaf(self, reader, path, name_hash):
+    """
+    Advances path (the (entries, idx) of each index level) to the next leaf block like ext4_htree_next_block: names
+    with colliding hashes may continue there (marked by the low hash bit), also across dx_node blocks. Returns False,
+    if there is no next leaf block or it can't hold name_hash.
+    """
+    level = len(path) - 1
+    while path[level][1] + 1 >= len(path[level][0]):
+      if level == 0:
+        return False
+      level -= 1
+
+    entries, idx = path[level]
+    idx += 1
+    path[level] = (entries, idx)
+    if (entries[idx][0] & ~1) != name_hash:
+      return False
+
+    # descend through the first entries of the following dx_node blocks
+    for lower in range(level + 1, len(path)):
+      entries = self._dx_entries(self._read_dir_block(reader, entries[idx][1]), 0x8)
+      idx = 0
+      path[lower] = (entries, idx)
+    return True
+
+  def lookup(self, name, decode_name=None):
+    """
+    Returns the directory entry name as a tuple (decode_name(name), inode, file_type) or (None, None, None), if there is
+    no such entry. name is either the raw on-disk name (bytes) or the name decoded by decode_name (utf8 by default).
+    Hash tree directories are searched through their index only, if name is bytes or decode_name is None. The
+    directory entries are scanned otherwise, or if the index can't be used (invalid dx_root or unknown hash version).
+    """
+    use_index = self.is_htree and (isinstance(name, bytes) or decode_name is None)
+
+    # entries are compared to name as it is passed, bytes names match the raw on-disk names
+    if decode_name is None:
+      def decode_name(raw): return raw if isinstance(name, bytes) else raw.decode("utf8")
+
+    if use_index:
+      raw_name = name if isinstance(name, bytes) else name.encode("utf8")
+
+      try:
+        dirent = self._dx_lookup(raw_name)
+      except (MagicError, NotImplementedError):
+        return next(filter(lambda entry: entry[0] == name, self._scan_dir(decode_name)), (None, None, None))
+
+      if dirent is None:
+        return (None, None, None)
+      file_name = dirent.name if isinstance(name, bytes) else name
+      return (file_name, dirent.inode, dirent.file_type)
+
+    return next(filter(lambda entry: entry[0] == name, self.open_dir(decode_name)), (None, None, None))
+
   def open_read(self):
     """
     Returns an BlockReader instance for reading this inode's raw content.
     """
     if (self.inode.i_flags & ext4_inode.EXT4_EXTENTS_FL) != 0:
+      mapping = self.volume.extent_cache.get(self.inode_idx) if self.inode_idx is not None else None
+      if mapping is not None:
+        return BlockReader(self.volume, len(self), mapping)
+
       # Obtain mapping from extents
       mapping = []  # List of MappingEntry instances
 
@@ -953,6 +1462,8 @@ class Inode:
               extent.ee_block, extent.ee_start, extent.ee_len))
 
       MappingEntry.optimize(mapping)
+      if self.inode_idx is not None:
+        self.volume.extent_cache.put(self.inode_idx, mapping)
       return BlockReader(self.volume, len(self), mapping)
     else:
       # Inode uses inline data
@@ -1033,6 +1544,9 @@ class BlockReader:
   # OSError
   EINVAL = 22
 
+  # Shared source for filling unmapped (sparse) file blocks
+  ZERO_BUFFER = bytes(1 << 20)
+
   def __init__(self, volume, byte_size, block_map):
     """
     Initializes a new block reader on the specified volume. mapping must be a list of MappingEntry instances. If
@@ -1050,6 +1564,9 @@ class BlockReader:
     MappingEntry.optimize(block_map)
     self.block_map = block_map
 
+    # Sorted file_block_idx of every entry, used to bisect the mapping
+    self.block_index = [entry.file_block_idx for entry in block_map]
+
   def __repr__(self):
     return f"{type(self).__name__:s}(byte_size = {self.byte_size!r:s}, block_map = {self.block_map!r:s}, volume_uuid = {self.volume.uuid!r:s})"
 
@@ -1057,16 +1574,47 @@ class BlockReader:
     """
     Returns the disk block index of the file block specified by file_block_idx.
     """
-    disk_block_idx = None
+    idx = bisect.bisect_right(self.block_index, file_block_idx) - 1
 
-    # Find disk block
-    for entry in self.block_map:
-      if entry.file_block_idx <= file_block_idx < entry.file_block_idx + entry.block_count:
-        block_diff = file_block_idx - entry.file_block_idx
-        disk_block_idx = entry.disk_block_idx + block_diff
-        break
+    if idx >= 0:
+      entry = self.block_map[idx]
+      if file_block_idx < entry.file_block_idx + entry.block_count:
+        return entry.disk_block_idx + (file_block_idx - entry.file_block_idx)
 
-    return disk_block_idx
+    return None
+
+  def get_runs(self, offset=None, byte_len=-1):
+    """
+    Generator: Resolves byte_len bytes starting at the file offset (the cursor's position if offset is None) to runs
+    and yields tuples (file_offset, disk_offset, run_len). disk_offset is the byte offset within the volume of a run of
+    contiguous disk blocks or None, if the run is an unmapped (sparse) range. The runs never exceed the inode's size
+    and do not move the cursor.
+    """
+    if offset is None:
+      offset = self.cursor
+
+    bytes_remaining = max(0, self.byte_size - offset)
+    byte_len = bytes_remaining if byte_len == -1 else max(0, min(byte_len, bytes_remaining))
+
+    block_size = self.volume.block_size
+    end = offset + byte_len
+
+    while offset < end:
+      idx = bisect.bisect_right(self.block_index, offset // block_size) - 1
+      entry = self.block_map[idx] if idx >= 0 else None
+
+      if entry is not None and offset < (entry.file_block_idx + entry.block_count) * block_size:
+        # Mapped run up to the end of the entry
+        run_len = min((entry.file_block_idx + entry.block_count) * block_size, end) - offset
+        disk_offset = (entry.disk_block_idx - entry.file_block_idx) * block_size + offset
+        yield (offset, disk_offset, run_len)
+      else:
+        # Hole up to the start of the next entry
+        next_start = self.block_index[idx + 1] * block_size if idx + 1 < len(self.block_index) else end
+        run_len = min(next_start, end) - offset
+        yield (offset, None, run_len)
+
+      offset += run_len
 
   def read(self, byte_len=-1):
     """
@@ -1077,37 +1625,45 @@ class BlockReader:
     if byte_len < -1:
       raise ValueError("byte_len must be non-negative or -1")
 
-    bytes_remaining = self.byte_size - self.cursor
+    bytes_remaining = max(0, self.byte_size - self.cursor)
     byte_len = bytes_remaining if byte_len == - \
       1 else max(0, min(byte_len, bytes_remaining))
 
     if byte_len == 0:
       return b""
 
-    # Reading blocks
-    start_block_idx = self.cursor // self.volume.block_size
-    end_block_idx = (self.cursor + byte_len - 1) // self.volume.block_size
-    end_of_stream_check = byte_len
+    result = bytearray(byte_len)
+    self.readinto(result)
+    return bytes(result)
 
-    blocks = [self.read_block(i) for i in range(
-      start_block_idx, end_block_idx - start_block_idx + 1)]
+  def readinto(self, buffer):
+    """
+    Reads up to len(buffer) bytes beginning at the cursor's current position into the preallocated buffer and returns
+    the number of bytes read. Each run of contiguous disk blocks is read with a single call to Volume.readinto, unmapped
+    ranges are filled with zeros.
+    """
+    view = memoryview(buffer).cast("B")
+    pos = 0
 
-    start_offset = self.cursor % self.volume.block_size
-    if start_offset != 0:
-      blocks[0] = blocks[0][start_offset:]
-    byte_len = (byte_len + start_offset - self.volume.block_size -
-                1) % self.volume.block_size + 1
-    blocks[-1] = blocks[-1][:byte_len]
+    for _, disk_offset, run_len in self.get_runs(self.cursor, len(view)):
+      if disk_offset is not None:
+        got = self.volume.readinto(disk_offset, view[pos: pos + run_len])
 
-    result = b"".join(blocks)
+        if got != run_len:
+          raise EndOfStreamError(
+            f"The volume's underlying stream ended {run_len - got:d} bytes before EOF.")
+      else:
+        hole_end = pos + run_len
+        fill_pos = pos
+        while fill_pos < hole_end:
+          fill_len = min(hole_end - fill_pos, len(BlockReader.ZERO_BUFFER))
+          view[fill_pos: fill_pos + fill_len] = BlockReader.ZERO_BUFFER[:fill_len]
+          fill_pos += fill_len
 
-    # Check read
-    if len(result) != end_of_stream_check:
-      raise EndOfStreamError(
-        f"The volume's underlying stream ended {byte_len - len(result):d} bytes before EOF.")
+      pos += run_len
 
-    self.cursor += len(result)
-    return result
+    self.cursor += pos
+    return pos
 
   def read_block(self, file_block_idx):
     """
@@ -1118,7 +1674,7 @@ class BlockReader:
     if disk_block_idx != None:
       return self.volume.read(disk_block_idx * self.volume.block_size, self.volume.block_size)
     else:
-      return bytes([0] * self.volume.block_size)
+      return bytes(self.volume.block_size)
 
   def seek(self, seek, seek_mode=io.SEEK_SET):
     """
@@ -1228,3 +1784,41 @@ class Tools:
         file_type=file_type,
         file_type_str=file_types[file_type] if file_type in file_types else "?"
       ))
+
+  def block_map(volume, mount_point="/", decode_name=None):
+    """
+    Generator: Walks all regular files of volume and yields tuples (path, runs). path is the file's path below
+    mount_point (e.g. "/vendor/bin/sh") and runs is a list of (first_disk_block, last_disk_block) tuples covering the
+    file's data in file order, like the block list written by "e2fsdroid -B". Holes are left out and files without
+    data blocks (empty or inline data) are skipped.
+    """
+    prefix = mount_point.rstrip("/")
+
+    def scan_dir(dir_inode, dir_path):
+      for file_name, inode_idx, file_type in dir_inode.open_dir(decode_name):
+        if file_name in (".", ".."):
+          continue
+
+        inode = volume.get_inode(inode_idx, file_type)
+        path = dir_path + "/" + file_name
+
+        if inode.is_dir:
+          yield from scan_dir(inode, path)
+        elif inode.is_file:
+          reader = inode.open_read()
+          if not isinstance(reader, BlockReader):
+            continue
+
+          runs = []
+          for entry in reader.block_map:
+            start = entry.disk_block_idx
+            end = start + entry.block_count - 1
+            if runs and runs[-1][1] + 1 == start:
+              runs[-1] = (runs[-1][0], end)
+            else:
+              runs.append((start, end))
+
+          if runs:
+            yield (path, runs)
+
+    yield from scan_dir(volume.root, prefix)
@@ -25,11 +25,14 @@ import sys
 
 import ext4
 
+# inode table blocks read at once while walking the tree
+INODE_READAHEAD_BLKS = 32
+
 
 class ReadExt4():
-  def __init__(self):
-    self.image_name = os.path.realpath(sys.argv[1])
-    self.out_dir = os.path.realpath(sys.argv[2])
+  def __init__(self, image_name, out_dir):
+    self.image_name = os.path.realpath(image_name)
+    self.out_dir = os.path.realpath(out_dir)
     self.fs_context = []
     self.fs_config = []
     self.fetures = []
@@ -143,43 +146,80 @@ class ReadExt4():
     # write config list to file
     self.__appendf('\n'.join(self.fs_config), self.fs_config_file)
 
-  def __write_fetures(self):
-    # if os.name == 'posix':
-    #   cmd = ['tune2fs', '-l', self.image_name]
-    #   p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-    #                        stderr=subprocess.STDOUT, universal_newlines=True)
-    #   output, _ = p.communicate()
-
-    #   with open(self.file_features, 'w') as file:
-    #     for line in output:
-    #       file.write(line)
-    #     file.write('Partition Size: {}'.format(
-    #       os.stat(self.image_name).st_size))
+  def __write_fetures(self, volume):
+    superblock = volume.superblock
+    self.fetures.append('Filesystem volume name:'+' '*4 +
+                        superblock.s_volume_name.decode())
+    self.fetures.append('Last mounted on:'+' '*11 +
+                        superblock.s_last_mounted.decode())
+    self.fetures.append('Filesystem UUID:'+' '*11 +
+                        volume.uuid.lower())
+    self.fetures.append('Filesystem magic number:   ' +
+                        hex(superblock.s_magic))
+    self.fetures.append('Reserved block count:'+' '*6 +
+                        str(superblock.s_reserved_pad))
+    self.fetures.append('Inode size:'+' '*16 +
+                        str(superblock.s_inode_size))
+    self.fetures.append('Block size:'+' '*16 +
+                        str(volume.block_size))
+    self.fetures.append('Inode count:'+' '*15 +
+                        str(superblock.s_inodes_count))
+    self.fetures.append('Partition Size:' + ' '*12 +
+                        f'{os.stat(self.image_name).st_size}')
+    # self.fetures.append('Inodes per group:'+' '*10 +
+    #                     str(superblock.s_inodes_per_group))
+    # write to file
+    self.__appendf('\n'.join(self.fetures), self.file_features)
+
+  def add_entry(self, entry_inode, entry_inode_path, link_target=None):
+    """
+    record config and context of one entry (path relative to the image root)
+    """
+    mode = self.__get_octal_perm(entry_inode.mode_str)
+    uid = entry_inode.inode.i_uid
+    gid = entry_inode.inode.i_gid
+    con = ''
+
+    # loop over xattr ('security.selinux', b'u:object_r:vendor_file:s0\x00')
+    for i in list(entry_inode.xattrs()):
+      if i[0] == 'security.selinux':
+        con = i[1].decode('utf-8')  # decode context
+        con = con[:-1]  # remove last car from context '\x00'
+      else:
+        pass
+
+    file_name_context = '/'+self.file_name + entry_inode_path
+    file_name_config = self.file_name + entry_inode_path
 
-    # else:
-    with open(self.image_name, 'rb') as file:
-      self.fetures.append('Filesystem volume name:'+' '*4 +
-                          ext4.Volume(file).superblock.s_volume_name.decode())
-      self.fetures.append('Last mounted on:'+' '*11 +
-                          ext4.Volume(file).superblock.s_last_mounted.decode())
-      self.fetures.append('Filesystem UUID:'+' '*11 +
-                          ext4.Volume(file).uuid.lower())
-      self.fetures.append('Filesystem magic number:   ' +
-                          hex(ext4.Volume(file).superblock.s_magic))
-      self.fetures.append('Reserved block count:'+' '*6 +
-                          str(ext4.Volume(file).superblock.s_reserved_pad))
-      self.fetures.append('Inode size:'+' '*16 +
-                          str(ext4.Volume(file).superblock.s_inode_size))
-      self.fetures.append('Block size:'+' '*16 +
-                          str(ext4.Volume(file).block_size))
-      self.fetures.append('Inode count:'+' '*15 +
-                          str(ext4.Volume(file).superblock.s_inodes_count))
-      self.fetures.append('Partition Size:' + ' '*12 +
-                          f'{os.stat(self.image_name).st_size}')
-      # self.fetures.append('Inodes per group:'+' '*10 +
-      #                     str(ext4.Volume(file).superblock.s_inodes_per_group))
-      # write to file
-      self.__appendf('\n'.join(self.fetures), self.file_features)
+    if self.file_name in ('system'):
+      file_name_context = entry_inode_path
+      file_name_config = entry_inode_path[entry_inode_path.startswith(
+        '/') and len('/'):]
+
+    if entry_inode.is_dir:
+      self.num_dirs += 1
+      self.fs_config.append(f'{file_name_config} {uid} {gid} {mode}')
+      self.fs_context.append(f'{file_name_context} {con}')
+
+    elif entry_inode.is_file:
+      self.num_files += 1
+      self.fs_config.append(f'{file_name_config} {uid} {gid} {mode}')
+      self.fs_context.append(f'{file_name_context} {con}')
+
+    elif entry_inode.is_symlink:
+      self.num_links += 1
+      if link_target is None:
+        link_target = entry_inode.open_read().read().decode("utf-8")
+      self.fs_config.append(f'{file_name_config} {uid} {gid} {mode} {link_target}')
+      self.fs_context.append(f'{file_name_context} {con}')
+
+  def write_info(self, volume):
+    """
+    write contexts, config and features collected by add_entry
+    """
+    self.__write_context()
+    self.__write_config()
+    self.__write_fetures(volume)
 
   def read_ext4(self):
     def scan_dir(root_inode, root_path=""):
@@ -190,55 +230,32 @@ class ReadExt4():
 
         entry_inode = root_inode.volume.get_inode(entry_inode_idx, entry_type)
         entry_inode_path = root_path + '/' + entry_name
-        mode = self.__get_octal_perm(entry_inode.mode_str)
-        uid = entry_inode.inode.i_uid
-        gid = entry_inode.inode.i_gid
-        con = ''
-
-        # loop over xattr ('security.selinux', b'u:object_r:vendor_file:s0\x00')
-        for i in list(entry_inode.xattrs()):
-          if i[0] == 'security.selinux':
-            con = i[1].decode('utf-8')  # decode context
-            con = con[:-1]  # remove last car from context '\x00'
-          else:
-            pass
-
-        file_name_context = '/'+self.file_name + entry_inode_path
-        file_name_config = self.file_name + entry_inode_path
-
-        if self.file_name in ('system'):
-          file_name_context = entry_inode_path
-          file_name_config = entry_inode_path[entry_inode_path.startswith(
-            '/') and len('/'):]
+        self.add_entry(entry_inode, entry_inode_path)
 
         if entry_inode.is_dir:
-          self.num_dirs += 1
           scan_dir(entry_inode, entry_inode_path)  # loop inside the directory
-          self.fs_config.append(f'{file_name_config} {uid} {gid} {mode}')
-          self.fs_context.append(f'{file_name_context} {con}')
-
-        elif entry_inode.is_file:
-          self.num_files += 1
-          self.fs_config.append(f'{file_name_config} {uid} {gid} {mode}')
-          self.fs_context.append(f'{file_name_context} {con}')
-
-        elif entry_inode.is_symlink:
-          self.num_links += 1
-          link_target = entry_inode.open_read().read().decode("utf-8")
-          self.fs_config.append(f'{file_name_config} {uid} {gid} {mode} {link_target}')
-          self.fs_context.append(f'{file_name_context} {con}')
 
     # open image
     with open(self.image_name, 'rb') as file:
-      root = ext4.Volume(file).root
-      scan_dir(root)
+      volume = ext4.Volume(file, inode_readahead_blks=INODE_READAHEAD_BLKS)
+      scan_dir(volume.root)
+      self.write_info(volume)
 
-    self.__write_context()
-    self.__write_config()
-    self.__write_fetures()
     print(f'{self.num_dirs} DIR {self.num_files} FILE {self.num_links} LINKS')
 
 
+def write_block_map(image_name, map_file, mount_point='/'):
+  """
+  write the block map of the files in a raw ext4 image (same format as
+  e2fsdroid -B) so img2sdat can diff the image file by file
+  """
+  with open(image_name, 'rb') as file, open(map_file, 'w') as out:
+    volume = ext4.Volume(file, inode_readahead_blks=INODE_READAHEAD_BLKS)
+    for path, runs in ext4.Tools.block_map(volume, mount_point):
+      ranges = ' '.join(f'{s}-{e}' if s != e else f'{s}' for s, e in runs)
+      out.write(f'{path} {ranges}\n')
+
+
 class FsFetures():
   def __init__(self):
     pass
@@ -248,9 +265,10 @@ if __name__ == '__main__':
   if sys.argv.__len__() < 3:
     print(f'USAGE: {sys.argv[0]} image_path info_path')
   else:
+    read = ReadExt4(sys.argv[1], sys.argv[2])
     print(
-      f':: Save Information {ReadExt4().file_name}.img...',
-      f':: Image path -> {ReadExt4().image_name}',
-      f':: Info dir   -> {ReadExt4().out_dir}',
+      f':: Save Information {read.file_name}.img...',
+      f':: Image path -> {read.image_name}',
+      f':: Info dir   -> {read.out_dir}',
       sep='\n', end='\n\n')
-    ReadExt4().read_ext4()
+    read.read_ext4()
@@ -20,17 +20,113 @@
   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import argparse
+import errno
 import os
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import ext4
+from ext4_info import ReadExt4
+
+# default size of one copy/read request while streaming file data
+CHUNK_SIZE = 8 << 20
+
+# inode table blocks read at once while walking the tree
+INODE_READAHEAD_BLKS = 32
+
+# errors meaning the kernel can't do an in-kernel copy between these fds
+COPY_UNSUPPORTED = (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                    errno.EOPNOTSUPP, errno.EBADF)
+
+_use_copy_file_range = hasattr(os, 'copy_file_range')
+_use_sendfile = hasattr(os, 'sendfile')
+
+
+def copy_run(in_fd, in_offset, out_fd, out_offset, length, chunk_size=CHUNK_SIZE, buffer=None):
+  """copy length bytes from in_fd at in_offset to out_fd at out_offset
+
+  Tries os.copy_file_range, then os.sendfile and falls back to preadv/pwrite
+  through buffer. No file position is shared, so fds can be used from
+  several threads.
+  """
+  global _use_copy_file_range, _use_sendfile
+
+  while length > 0 and _use_copy_file_range:
+    try:
+      done = os.copy_file_range(in_fd, out_fd, min(length, chunk_size),
+                                in_offset, out_offset)
+    except OSError as err:
+      if err.errno not in COPY_UNSUPPORTED:
+        raise
+      _use_copy_file_range = False
+      break
+    if done == 0:
+      raise ext4.EndOfStreamError(f'Image ended {length} bytes before EOF.')
+    in_offset += done
+    out_offset += done
+    length -= done
+
+  if length > 0 and _use_sendfile:
+    try:
+      os.lseek(out_fd, out_offset, os.SEEK_SET)
+      while length > 0:
+        done = os.sendfile(out_fd, in_fd, in_offset, min(length, chunk_size))
+        if done == 0:
+          raise ext4.EndOfStreamError(f'Image ended {length} bytes before EOF.')
+        in_offset += done
+        out_offset += done
+        length -= done
+    except OSError as err:
+      if err.errno not in COPY_UNSUPPORTED:
+        raise
+      _use_sendfile = False
+
+  if length > 0:
+    if buffer is None:
+      buffer = bytearray(min(length, chunk_size))
+    view = memoryview(buffer)
+    while length > 0:
+      done = os.preadv(in_fd, [view[:min(length, len(view))]], in_offset)
+      if done == 0:
+        raise ext4.EndOfStreamError(f'Image ended {length} bytes before EOF.')
+      written = 0
+      while written < done:
+        written += os.pwrite(out_fd, view[written:done], out_offset + written)
+      in_offset += done
+      out_offset += done
+      length -= done
+
+
+def copy_inode(in_fd, in_offset, runs, byte_size, file_target, chunk_size=CHUNK_SIZE, buffer=None):
+  """write the runs of one file to file_target
+
+  runs are (file_offset, disk_offset, run_len) tuples as yielded by
+  ext4.BlockReader.get_runs. Unmapped runs are skipped and left as holes by
+  truncating the file to its final size.
+  """
+  out_fd = os.open(file_target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+  try:
+    for file_offset, disk_offset, run_len in runs:
+      if disk_offset is not None:
+        copy_run(in_fd, in_offset + disk_offset, out_fd, file_offset,
+                 run_len, chunk_size, buffer)
+    os.ftruncate(out_fd, byte_size)
+  finally:
+    os.close(out_fd)
 
 
 class ExtractExt4():
-  def __init__(self):
-    self.image_name = os.path.realpath(sys.argv[1])
+  def __init__(self, image_name, out_dir, chunk_size=CHUNK_SIZE, jobs=1, info_dir=None, use_mmap=False):
+    self.image_name = os.path.realpath(image_name)
     self.file_name = self.__file_name(os.path.basename(self.image_name))
-    self.out_dir = os.path.realpath(sys.argv[2])
+    self.out_dir = os.path.realpath(out_dir)
+    self.chunk_size = chunk_size
+    self.jobs = max(1, jobs)
+    self.use_mmap = use_mmap
+    # collect contexts/config/features in the same walk
+    self.info = ReadExt4(image_name, info_dir) if info_dir else None
     self.num_files = 0
     self.num_dirs = 0
     self.num_links = 0
@@ -39,7 +135,41 @@ class ExtractExt4():
     name = os.path.basename(file_path).split('.')[0]
     return name
 
+  def __write_files(self, volume_offset, pending):
+    """write pending (file_target, runs, byte_size) on self.jobs threads
+
+    every worker reads the image through its own fd with positional I/O,
+    the copy syscalls release the GIL so threads scale with the device.
+    """
+    local = threading.local()
+    worker_fds = []
+    lock = threading.Lock()
+
+    def write_file(job):
+      if not hasattr(local, 'fd'):
+        local.fd = os.open(self.image_name, os.O_RDONLY)
+        local.buffer = bytearray(self.chunk_size)
+        with lock:
+          worker_fds.append(local.fd)
+
+      file_target, runs, byte_size = job
+      copy_inode(local.fd, volume_offset, runs, byte_size,
+                 file_target, self.chunk_size, local.buffer)
+
+    # biggest files first so one huge file doesn't finish last on its own
+    pending.sort(key=lambda job: job[2], reverse=True)
+    try:
+      with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+        for _ in pool.map(write_file, pending):
+          pass
+    finally:
+      for fd in worker_fds:
+        os.close(fd)
+
   def extract_ext4(self):
+    buffer = bytearray(self.chunk_size)
+    # files collected by the metadata pass when running with several jobs
+    pending = []
 
     def scan_dir(root_inode, root_path=""):
       for entry_name, entry_inode_idx, entry_type in root_inode.open_dir():
@@ -52,6 +182,8 @@ class ExtractExt4():
 
         if entry_inode.is_dir:
           self.num_dirs += 1
+          if self.info:
+            self.info.add_entry(entry_inode, entry_inode_path)
           dir_target = self.out_dir + \
             entry_inode_path.replace('"permissions"', 'permissions')
 
@@ -62,21 +194,32 @@ class ExtractExt4():
 
         elif entry_inode.is_file:
           self.num_files += 1
-          # extract files
-          raw = entry_inode.open_read().read()
-
+          if self.info:
+            self.info.add_entry(entry_inode, entry_inode_path)
           file_target = os.path.join(self.out_dir + entry_inode_path)
 
           if os.path.isfile(file_target):
             os.remove(file_target)
 
-          # write to new file
-          with open(file_target, 'wb') as out:
-            out.write(raw)
+          # stream extents to new file
+          reader = entry_inode.open_read()
+          if isinstance(reader, ext4.BlockReader):
+            volume = root_inode.volume
+            if self.jobs > 1:
+              pending.append((file_target, list(reader.get_runs(0)), reader.byte_size))
+            else:
+              copy_inode(volume.stream.fileno(), volume.offset, reader.get_runs(0),
+                         reader.byte_size, file_target, self.chunk_size, buffer)
+          else:
+            # inline data
+            with open(file_target, 'wb') as out:
+              out.write(reader.read())
 
         elif entry_inode.is_symlink:
           self.num_links += 1
           link_target = entry_inode.open_read().read().decode("utf-8")
+          if self.info:
+            self.info.add_entry(entry_inode, entry_inode_path, link_target)
           target = self.out_dir + entry_inode_path
 
           # check if file exist and remove it
@@ -87,20 +230,39 @@ class ExtractExt4():
           os.symlink(link_target, target)
 
     # open image
-    with open(self.image_name, 'rb') as file:
-      root = ext4.Volume(file).root
-      scan_dir(root)
+    with open(self.image_name, 'rb') as file, \
+        ext4.Volume(file, inode_readahead_blks=INODE_READAHEAD_BLKS,
+                    use_mmap=self.use_mmap) as volume:
+      scan_dir(volume.root)
+
+      if self.info:
+        self.info.write_info(volume)
+
+    if pending:
+      self.__write_files(volume.offset, pending)
 
     print(f'{self.num_dirs} DIR {self.num_files} FILE {self.num_links} LINKS')
 
 
 if __name__ == '__main__':
-  if len(sys.argv) < 3:
-    print(f'USAGE: {sys.argv[0]} image_path out_path')
-  else:
-    print(
-      f':: Extract {ExtractExt4().file_name}.img...',
-      f':: Image path -> {ExtractExt4().image_name}',
-      f':: out dir   -> {ExtractExt4().out_dir}',
-      sep='\n', end='\n\n')
-    ExtractExt4().extract_ext4()
+  parser = argparse.ArgumentParser()
+  parser.add_argument('image_path', help='ext4 image')
+  parser.add_argument('out_path', help='output directory')
+  parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=CHUNK_SIZE,
+                      help=f'bytes per copy request (default {CHUNK_SIZE})')
+  parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                      help='number of threads writing files (default 1)')
+  parser.add_argument('--info', dest='info_dir',
+                      help='also write file_contexts/filesystem_config/filesystem_features to this directory')
+  parser.add_argument('--mmap', dest='use_mmap', action='store_true',
+                      help='read metadata through a memory map of the image')
+  args = parser.parse_args()
+
+  extract = ExtractExt4(args.image_path, args.out_path, args.chunk_size, args.jobs,
+                        args.info_dir, args.use_mmap)
+  print(
+    f':: Extract {extract.file_name}.img...',
+    f':: Image path -> {extract.image_name}',
+    f':: out dir   -> {extract.out_dir}',
+    sep='\n', end='\n\n')
+  extract.extract_ext4()
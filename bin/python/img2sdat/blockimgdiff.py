@@ -15,6 +15,7 @@
 from __future__ import print_function
 
 import array
+import bisect
 import copy
 import functools
 import heapq
@@ -24,15 +25,23 @@ import multiprocessing
 import os
 import os.path
 import re
+import shutil
 import sys
+import tempfile
 import threading
 import zlib
 from collections import deque, namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 import common
-from images import EmptyImage
+from images import EmptyImage, ReadSpansInto
 from rangelib import RangeSet
 
+try:
+  import bsdiff4
+except ImportError:
+  bsdiff4 = None
+
 __all__ = ["BlockImageDiff"]
 
 logger = logging.getLogger(__name__)
@@ -40,6 +49,9 @@ logger = logging.getLogger(__name__)
 # The tuple contains the style and bytes of a bsdiff|imgdiff patch.
 PatchInfo = namedtuple("PatchInfo", ["imgdiff", "content"])
 
+# Patch jobs submitted ahead per worker process.
+PENDING_JOBS_PER_PROCESS = 2
+
 
 def compute_patch(srcfile, tgtfile, imgdiff=False):
   """Calls bsdiff|imgdiff to compute the patch data, returns a PatchInfo."""
@@ -60,6 +72,104 @@ def compute_patch(srcfile, tgtfile, imgdiff=False):
     return PatchInfo(imgdiff, f.read())
 
 
+def _MemFile(data):
+  """Returns an fd of an anonymous in-memory file holding data."""
+  fd = os.memfd_create("blockimgdiff")
+  view = memoryview(data)
+  while view:
+    view = view[os.write(fd, view):]
+  return fd
+
+
+def compute_patch_data(src_data, tgt_data, imgdiff=False):
+  """Computes the patch between two strings of data, returns a PatchInfo.
+
+  bsdiff patches are made in-process with the bsdiff4 module if installed
+  (same BSDIFF40 format as the bsdiff binary). Otherwise bsdiff|imgdiff
+  reads and writes memfd files through /dev/fd, falling back to temp files
+  where memfd is not available.
+  """
+  if not imgdiff and bsdiff4 is not None:
+    return PatchInfo(False, bsdiff4.diff(bytes(src_data), bytes(tgt_data)))
+
+  if not hasattr(os, "memfd_create"):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      src_file = os.path.join(tmp_dir, "src")
+      with open(src_file, "wb") as f:
+        f.write(src_data)
+      tgt_file = os.path.join(tmp_dir, "tgt")
+      with open(tgt_file, "wb") as f:
+        f.write(tgt_data)
+      patch_file = os.path.join(tmp_dir, "patch")
+      cmd = ['imgdiff', '-z'] if imgdiff else ['bsdiff']
+      proc = common.Run(cmd + [src_file, tgt_file, patch_file], verbose=False)
+      output, _ = proc.communicate()
+      if proc.returncode != 0:
+        raise ValueError(output)
+      with open(patch_file, "rb") as f:
+        return PatchInfo(imgdiff, f.read())
+
+  fds = [_MemFile(src_data), _MemFile(tgt_data), _MemFile(b"")]
+  try:
+    cmd = ['imgdiff', '-z'] if imgdiff else ['bsdiff']
+    cmd.extend("/dev/fd/%d" % fd for fd in fds)
+    proc = common.Run(cmd, verbose=False, pass_fds=fds)
+    output, _ = proc.communicate()
+
+    if proc.returncode != 0:
+      raise ValueError(output)
+
+    with os.fdopen(os.dup(fds[2]), "rb") as f:
+      f.seek(0)
+      return PatchInfo(imgdiff, f.read())
+  finally:
+    for fd in fds:
+      os.close(fd)
+
+
+def _ReadSpans(source):
+  """Reads the data described by Image.GetRangeSpans().
+
+  The file is opened for each job: the worker may be the main process, which
+  must not keep the fd of an image path that can be rewritten later."""
+  if isinstance(source, bytes):
+    return source
+  path, spans = source
+  data = bytearray(sum(length for _, _, length in spans))
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    ReadSpansInto(fd, spans, data)
+  finally:
+    os.close(fd)
+  return data
+
+
+def _PatchWorker(job):
+  """Computes one patch in a worker process.
+
+  Returns:
+    A (patch_info, compressed_size, error) tuple, None for what was not
+    asked for (or on error).
+  """
+  src, tgt, imgdiff, compute, compress_target = job
+  try:
+    tgt_data = _ReadSpans(tgt)
+
+    patch_info = None
+    if compute:
+      patch_info = compute_patch_data(_ReadSpans(src), tgt_data, imgdiff)
+
+    compressed_size = None
+    if compress_target:
+      # Compresses with the default level
+      compress_obj = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+      compressed_size = (len(compress_obj.compress(tgt_data)) +
+                         len(compress_obj.flush()))
+  except Exception as e:  # pylint: disable=broad-except
+    return None, None, str(e)
+  return patch_info, compressed_size, None
+
+
 class Transfer(object):
   def __init__(self, tgt_name, src_name, tgt_ranges, src_ranges, tgt_sha1,
                src_sha1, style, by_id):
@@ -229,6 +339,9 @@ class BlockImageDiff(object):
      RangeSha1(): a function that returns (as a hex string) the SHA-1 hash of
          all the data in the specified range.
 
+     HashRanges(): a function that takes a list of RangeSets and a number of
+         threads and computes their RangeSha1() ahead of time.
+
      TotalSha1(): a function that returns (as a hex string) the SHA-1 hash of
          all the data in the image (ie, all the blocks in the care_map minus
          clobbered_blocks, or including the clobbered blocks if
@@ -236,22 +349,34 @@ class BlockImageDiff(object):
 
   When creating a BlockImageDiff, the src image may be None, in which case the
   list of transfers produced will never read from the original image.
+
+  open_new_data, if given, is called with the new.dat path and returns the
+  file object the new data is written to instead (e.g. a compressor, so the
+  uncompressed new.dat never hits the disk).
   """
 
   def __init__(self, tgt, src=None, threads=None, version=4,
-               disable_imgdiff=False):
+               disable_imgdiff=False, open_new_data=None):
     if threads is None:
       threads = multiprocessing.cpu_count() // 2
       if threads == 0:
         threads = 1
     self.threads = threads
     self.version = version
+    # opens the file object the new data goes to, given the new.dat path
+    self.open_new_data = open_new_data or (lambda path: open(path, "wb"))
     self.transfers = []
     self.src_basenames = {}
     self.src_numpatterns = {}
     self._max_stashed_size = 0
     self.touched_src_ranges = RangeSet()
     self.touched_src_sha1 = None
+    # imgdiff has no in-process fallback, diff every file with bsdiff
+    # without it
+    if (not disable_imgdiff and src is not None and src.total_blocks and
+        shutil.which("imgdiff") is None):
+      logger.warning("imgdiff not found in PATH, using bsdiff for all files")
+      disable_imgdiff = True
     self.disable_imgdiff = disable_imgdiff
     self.imgdiff_stats = ImgdiffStats() if not disable_imgdiff else None
 
@@ -386,11 +511,9 @@ class BlockImageDiff(object):
       assert style == "new" or style == "zero"
       blocks_limit = 1024
       total = 0
-      while target_blocks:
-        blocks_to_write = target_blocks.first(blocks_limit)
+      for blocks_to_write in target_blocks.split(blocks_limit):
         out.append("%s %s\n" % (style, blocks_to_write.to_string_raw()))
         total += blocks_to_write.size()
-        target_blocks = target_blocks.subtract(blocks_to_write)
       return total
 
     out = []
@@ -728,7 +851,7 @@ class BlockImageDiff(object):
     print("Reticulating splines...")
     diff_queue = []
     patch_num = 0
-    with open(prefix + ".new.dat", "wb") as new_f:
+    with self.open_new_data(prefix + ".new.dat") as new_f:
       for index, xf in enumerate(self.transfers):
         if xf.style == "zero":
           tgt_size = xf.tgt_ranges.size() * self.tgt.blocksize
@@ -780,13 +903,12 @@ class BlockImageDiff(object):
         else:
           assert False, "unknown style " + xf.style
         
-      print("Generated %s.new.dat success" % prefix)
-
-    patches = self.ComputePatchesForInputList(diff_queue, False)
+      print("Generated %s success" % new_f.name)
 
     offset = 0
     with open(prefix + ".patch.dat", "wb") as patch_fd:
-      for index, patch_info, _ in patches:
+      for index, patch_info, _ in self.IterPatchesForInputList(diff_queue,
+                                                               False):
         xf = self.transfers[index]
         xf.patch_len = len(patch_info.content)
         xf.patch_start = offset
@@ -809,15 +931,13 @@ class BlockImageDiff(object):
 
     Double check the SHA-1 value to avoid the issue in b/71908713, where
     SparseImage.RangeSha1() messed up with the hash calculation in multi-thread
-    environment. That specific problem has been fixed by protecting the
-    underlying generator function 'SparseImage._GetRangeData()' with lock.
+    environment. The images read with os.pread() and memoize the digests, so
+    this only checks that every diff transfer got the digests of its ranges.
     """
     for xf in self.transfers:
-      tgt_sha1 = self.tgt.RangeSha1(xf.tgt_ranges)
-      assert xf.tgt_sha1 == tgt_sha1
       if xf.style == "diff":
-        src_sha1 = self.src.RangeSha1(xf.src_ranges)
-        assert xf.src_sha1 == src_sha1
+        assert xf.tgt_sha1 == self.tgt.RangeSha1(xf.tgt_ranges)
+        assert xf.src_sha1 == self.src.RangeSha1(xf.src_ranges)
 
   def AssertSequenceGood(self):
     # Simulate the sequences of transfers we will output, and check that:
@@ -1107,30 +1227,47 @@ class BlockImageDiff(object):
     logger.info("Generating digraph...")
     print("Generating digraph...")
 
-    # Each item of source_ranges will be:
-    #   - None, if that block is not used as a source,
-    #   - an ordered set of transfers.
-    source_ranges = []
-    for b in self.transfers:
+    # Cut the source ranges of all transfers into disjoint segments, each
+    # with the (ordered) list of transfers reading it. Walking the segments
+    # of a target range in block order, and the transfers of a segment in
+    # transfer order, gives every transfer at the first block it shares with
+    # the target range, same as looking at each block on its own. Time and
+    # memory depend on the number of ranges, not blocks.
+    events = []
+    for order, b in enumerate(self.transfers):
       for s, e in b.src_ranges:
-        if e > len(source_ranges):
-          source_ranges.extend([None] * (e-len(source_ranges)))
-        for i in range(s, e):
-          if source_ranges[i] is None:
-            source_ranges[i] = OrderedDict.fromkeys([b])
-          else:
-            source_ranges[i][b] = None
+        events.append((s, 1, order))
+        events.append((e, -1, order))
+    events.sort()
+
+    seg_starts = []
+    seg_ends = []
+    seg_transfers = []
+    active = {}
+    start = None
+    for pos, delta, order in events:
+      if active and pos > start:
+        seg_starts.append(start)
+        seg_ends.append(pos)
+        seg_transfers.append([self.transfers[i] for i in sorted(active)])
+      start = pos
+      count = active.get(order, 0) + delta
+      if count:
+        active[order] = count
+      else:
+        del active[order]
 
     for a in self.transfers:
       intersections = OrderedDict()
       for s, e in a.tgt_ranges:
-        for i in range(s, e):
-          if i >= len(source_ranges):
-            break
-          # Add all the Transfers in source_ranges[i] to the (ordered) set.
-          if source_ranges[i] is not None:
-            for j in source_ranges[i]:
-              intersections[j] = None
+        k = bisect.bisect_right(seg_starts, s) - 1
+        if k < 0 or seg_ends[k] <= s:
+          k += 1
+        while k < len(seg_starts) and seg_starts[k] < e:
+          # Add all the Transfers in the segment to the (ordered) set.
+          for j in seg_transfers[k]:
+            intersections[j] = None
+          k += 1
 
       for b in intersections:
         if a is b:
@@ -1159,85 +1296,75 @@ class BlockImageDiff(object):
       Returns:
         A list of (transfer order, patch_info, compressed_size) tuples.
     """
+    return list(self.IterPatchesForInputList(diff_queue, compress_target))
+
+  def IterPatchesForInputList(self, diff_queue, compress_target):
+    """Yields the (transfer order, patch_info, compressed_size) tuples of
+    ComputePatchesForInputList() in order, as soon as they are computed.
+
+    The patches are computed by a pool of self.threads processes. Each job
+    only carries the file positions of its source and target ranges (see
+    Image.GetRangeSpans()), the workers read the data with os.pread() and
+    diff it in memory, so there are no temp files and no shared lock.
+    """
 
     if not diff_queue:
-      return []
+      return
 
-    if self.threads > 1:
-      logger.info("Computing patches (using %d threads)...", self.threads)
+    processes = min(self.threads, len(diff_queue))
+    if processes > 1:
+      logger.info("Computing patches (using %d processes)...", processes)
     else:
       logger.info("Computing patches...")
 
-    diff_total = len(diff_queue)
-    patches = [None] * diff_total
+    def RangeSource(image, ranges):
+      spans = image.GetRangeSpans(ranges)
+      if spans is None:
+        return b"".join(image.ReadRangeSet(ranges))
+      return spans
+
+    def Jobs(queue):
+      for xf_index, imgdiff, _ in queue:
+        xf = self.transfers[xf_index]
+        compute = not xf.patch_info
+        src = RangeSource(self.src, xf.src_ranges) if compute else None
+        tgt = (RangeSource(self.tgt, xf.tgt_ranges)
+               if compute or compress_target else b"")
+        yield src, tgt, imgdiff, compute, compress_target
+
+    queue = sorted(diff_queue, key=lambda item: item[2])
     error_messages = []
 
-    # Using multiprocessing doesn't give additional benefits, due to the
-    # pattern of the code. The diffing work is done by subprocess.call, which
-    # already runs in a separate process (not affected much by the GIL -
-    # Global Interpreter Lock). Using multiprocess also requires either a)
-    # writing the diff input files in the main process before forking, or b)
-    # reopening the image file (SparseImage) in the worker processes. Doing
-    # neither of them further improves the performance.
-    lock = threading.Lock()
-
-    def diff_worker():
-      while True:
-        with lock:
-          if not diff_queue:
-            return
-          xf_index, imgdiff, patch_index = diff_queue.pop()
-          xf = self.transfers[xf_index]
-
-        message = []
-        compressed_size = None
-
-        patch_info = xf.patch_info
-        if not patch_info:
-          src_file = common.MakeTempFile(prefix="src-")
-          with open(src_file, "wb") as fd:
-            self.src.WriteRangeDataToFd(xf.src_ranges, fd)
-
-          tgt_file = common.MakeTempFile(prefix="tgt-")
-          with open(tgt_file, "wb") as fd:
-            self.tgt.WriteRangeDataToFd(xf.tgt_ranges, fd)
-
-          try:
-            patch_info = compute_patch(src_file, tgt_file, imgdiff)
-          except ValueError as e:
-            message.append(
-                "Failed to generate %s for %s: tgt=%s, src=%s:\n%s" % (
-                    "imgdiff" if imgdiff else "bsdiff",
-                    xf.tgt_name if xf.tgt_name == xf.src_name else
-                    xf.tgt_name + " (from " + xf.src_name + ")",
-                    xf.tgt_ranges, xf.src_ranges, e.message))
-
-        if compress_target:
-          tgt_data = self.tgt.ReadRangeSet(xf.tgt_ranges)
-          try:
-            # Compresses with the default level
-            compress_obj = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
-            compressed_data = (compress_obj.compress("".join(tgt_data))
-                               + compress_obj.flush())
-            compressed_size = len(compressed_data)
-          except zlib.error as e:
-            message.append(
-                "Failed to compress the data in target range {} for {}:\n"
-                "{}".format(xf.tgt_ranges, xf.tgt_name, e.message))
-
-        if message:
-          with lock:
-            error_messages.extend(message)
-
-        with lock:
-          patches[patch_index] = (xf_index, patch_info, compressed_size)
-
-    threads = [threading.Thread(target=diff_worker)
-               for _ in range(self.threads)]
-    for th in threads:
-      th.start()
-    while threads:
-      threads.pop().join()
+    def Submit(jobs):
+      # Executor.map() would submit every job (and its data, for images
+      # without spans) at once, keep a few per process in flight instead.
+      pending = deque()
+      for job in jobs:
+        pending.append(executor.submit(_PatchWorker, job))
+        if len(pending) >= processes * PENDING_JOBS_PER_PROCESS:
+          yield pending.popleft().result()
+      while pending:
+        yield pending.popleft().result()
+
+    executor = ProcessPoolExecutor(processes) if processes > 1 else None
+    try:
+      results = (Submit(Jobs(queue)) if executor else
+                 map(_PatchWorker, Jobs(queue)))
+      for (xf_index, imgdiff, _), result in zip(queue, results):
+        xf = self.transfers[xf_index]
+        patch_info, compressed_size, error = result
+        if error is not None:
+          error_messages.append(
+              "Failed to generate %s for %s: tgt=%s, src=%s:\n%s" % (
+                  "imgdiff" if imgdiff else "bsdiff",
+                  xf.tgt_name if xf.tgt_name == xf.src_name else
+                  xf.tgt_name + " (from " + xf.src_name + ")",
+                  xf.tgt_ranges, xf.src_ranges, error))
+          continue
+        yield xf_index, patch_info or xf.patch_info, compressed_size
+    finally:
+      if executor:
+        executor.shutdown()
 
     if error_messages:
       logger.error('ERROR:')
@@ -1245,8 +1372,6 @@ class BlockImageDiff(object):
       logger.error('\n\n\n')
       sys.exit(1)
 
-    return patches
-
   def SelectAndConvertDiffTransfersToNew(self, violated_stash_blocks):
     """Converts the diff transfers to reduce the max simultaneous stash.
 
@@ -1352,8 +1477,7 @@ class BlockImageDiff(object):
         src_first = src_ranges.first(max_blocks_per_transfer)
 
         Transfer(tgt_split_name, src_split_name, tgt_first, src_first,
-                 self.tgt.RangeSha1(tgt_first), self.src.RangeSha1(src_first),
-                 style, by_id)
+                 None, None, style, by_id)
 
         tgt_ranges = tgt_ranges.subtract(tgt_first)
         src_ranges = src_ranges.subtract(src_first)
@@ -1366,8 +1490,7 @@ class BlockImageDiff(object):
         tgt_split_name = "%s-%d" % (tgt_name, pieces)
         src_split_name = "%s-%d" % (src_name, pieces)
         Transfer(tgt_split_name, src_split_name, tgt_ranges, src_ranges,
-                 self.tgt.RangeSha1(tgt_ranges), self.src.RangeSha1(src_ranges),
-                 style, by_id)
+                 None, None, style, by_id)
 
     def AddSplitTransfers(tgt_name, src_name, tgt_ranges, src_ranges, style,
                           by_id):
@@ -1385,8 +1508,7 @@ class BlockImageDiff(object):
       if (tgt_ranges.size() <= max_blocks_per_transfer and
           src_ranges.size() <= max_blocks_per_transfer):
         Transfer(tgt_name, src_name, tgt_ranges, src_ranges,
-                 self.tgt.RangeSha1(tgt_ranges), self.src.RangeSha1(src_ranges),
-                 style, by_id)
+                 None, None, style, by_id)
         return
 
       # Split large APKs with imgdiff, if possible. We're intentionally checking
@@ -1409,8 +1531,7 @@ class BlockImageDiff(object):
       # otherwise add the Transfer() as is.
       if style != "diff" or not split:
         Transfer(tgt_name, src_name, tgt_ranges, src_ranges,
-                 self.tgt.RangeSha1(tgt_ranges), self.src.RangeSha1(src_ranges),
-                 style, by_id)
+                 None, None, style, by_id)
         return
 
       # Handle .odex files specially to analyze the block-wise difference. If
@@ -1660,11 +1781,25 @@ class BlockImageDiff(object):
     for (tgt_name, src_name, tgt_ranges, src_ranges,
          patch) in split_large_apks:
       transfer_split = Transfer(tgt_name, src_name, tgt_ranges, src_ranges,
-                                self.tgt.RangeSha1(tgt_ranges),
-                                self.src.RangeSha1(src_ranges),
-                                "diff", self.transfers)
+                                None, None, "diff", self.transfers)
       transfer_split.patch_info = PatchInfo(True, patch)
 
+    self.HashTransfers()
+
+  def HashTransfers(self):
+    """Fills in the SHA-1s of the diff transfers.
+
+    Only the diff transfers write their hashes to the transfer list. Their
+    ranges are hashed up front on self.threads threads; the images memoize
+    the digests, so the stash and check passes that follow hash nothing
+    twice."""
+    diffs = [xf for xf in self.transfers if xf.style == "diff"]
+    self.tgt.HashRanges([xf.tgt_ranges for xf in diffs], self.threads)
+    self.src.HashRanges([xf.src_ranges for xf in diffs], self.threads)
+    for xf in diffs:
+      xf.tgt_sha1 = self.tgt.RangeSha1(xf.tgt_ranges)
+      xf.src_sha1 = self.src.RangeSha1(xf.src_ranges)
+
   def AbbreviateSourceNames(self):
     for k in self.src.file_map.keys():
       b = os.path.basename(k)
@@ -12,18 +12,196 @@
 # See the License for the specific
 
 import os
-import threading
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha1
 
 from rangelib import RangeSet
 
 __all__ = ["EmptyImage", "DataImage", "FileImage"]
 
+# max bytes returned by one piece of _GetRangeData() for file backed images
+READ_SIZE = 1 << 20
+# bytes read at a time when looking for the zero blocks of a file
+SCAN_SIZE = 16 << 20
+# blocks compared at once while extending a run of zero blocks
+ZERO_RUN_STEP = 64
+
+
+def CoalesceSpans(spans):
+  """Merges (filepos, fill_data, length) spans that continue each other:
+  file data that is contiguous in the file, or the same fill pattern."""
+  out = []
+  for filepos, fill_data, length in spans:
+    if out:
+      last_pos, last_fill, last_len = out[-1]
+      if (filepos is not None and last_pos is not None and
+          last_pos + last_len == filepos) or (
+              filepos is None and last_pos is None and last_fill == fill_data):
+        out[-1] = (last_pos, last_fill, last_len + length)
+        continue
+    out.append((filepos, fill_data, length))
+  return out
+
+
+def IterSpans(fd, spans, chunk_size=READ_SIZE):
+  """Generator that produces the data of the (filepos, fill_data, length)
+  spans in pieces of at most chunk_size bytes.
+
+  Reads with os.pread(), which does not use the file position of fd, so any
+  number of these generators can run on the same fd at once without a lock.
+  """
+  for filepos, fill_data, length in CoalesceSpans(spans):
+    while length > 0:
+      n = min(length, chunk_size)
+      if filepos is not None:
+        data = os.pread(fd, n, filepos)
+        if len(data) != n:
+          raise ValueError("Unexpected end of file at %d" % (filepos + len(data),))
+        filepos += n
+      else:
+        data = fill_data * (n >> 2)
+      yield data
+      length -= n
+
+
+def ReadSpansInto(fd, spans, buf):
+  """Reads the data of the spans into the writable buffer buf, which must
+  be large enough. Like IterSpans() it needs no lock.
+
+  Returns:
+    The number of bytes read.
+  """
+  view = memoryview(buf).cast("B")
+  pos = 0
+  for filepos, fill_data, length in CoalesceSpans(spans):
+    end = pos + length
+    if filepos is None:
+      view[pos:end] = fill_data * (length >> 2)
+      pos = end
+    while pos < end:
+      n = os.preadv(fd, [view[pos:end]], filepos)
+      if n <= 0:
+        raise ValueError("Unexpected end of file at %d" % (filepos,))
+      pos += n
+      filepos += n
+  return pos
+
+
+def ZeroBlockRuns(data, blocksize, nblocks=None):
+  """Splits data into alternating runs of zero and non-zero blocks.
+
+  Every compare is a bytes.startswith() against a zero buffer, which is
+  memcmp() in C: zero runs are extended ZERO_RUN_STEP blocks per compare,
+  and the compare of a non-zero block stops at its first non-zero byte.
+
+  Args:
+    data: A bytes or bytearray holding nblocks whole blocks.
+    blocksize: The block size.
+    nblocks: Number of blocks of data to classify. Default all of data.
+
+  Yields:
+    (is_zero, start, end) tuples in block numbers relative to data.
+  """
+  if nblocks is None:
+    nblocks = len(data) // blocksize
+  if not isinstance(data, (bytes, bytearray)):
+    data = bytes(data)
+  zero_block = bytes(blocksize)
+  zero_step = bytes(blocksize * ZERO_RUN_STEP)
+  startswith = data.startswith
+
+  b = 0
+  while b < nblocks:
+    e = b + 1
+    if startswith(zero_block, b * blocksize):
+      while (e + ZERO_RUN_STEP <= nblocks and
+             startswith(zero_step, e * blocksize)):
+        e += ZERO_RUN_STEP
+      while e < nblocks and startswith(zero_block, e * blocksize):
+        e += 1
+      yield True, b, e
+    else:
+      while e < nblocks and not startswith(zero_block, e * blocksize):
+        e += 1
+      yield False, b, e
+    b = e
+
+
+def FileZeroBlockRuns(fd, blocksize, nblocks, offset=0, chunk_size=SCAN_SIZE):
+  """Reads nblocks blocks of fd at offset with os.preadv() and yields the
+  (is_zero, start, end) runs of ZeroBlockRuns() over them, in block numbers
+  relative to offset. Runs are not merged across reads."""
+  chunk_blocks = max(chunk_size // blocksize, 1)
+  buf = bytearray(min(chunk_blocks, max(nblocks, 1)) * blocksize)
+  view = memoryview(buf)
+
+  for first in range(0, nblocks, chunk_blocks):
+    n = min(chunk_blocks, nblocks - first)
+    length = n * blocksize
+    done = 0
+    while done < length:
+      r = os.preadv(fd, [view[done:length]], offset + first * blocksize + done)
+      if r <= 0:
+        raise ValueError("Unexpected end of file at block %d" % (first + n,))
+      done += r
+    for is_zero, start, end in ZeroBlockRuns(buf, blocksize, n):
+      yield is_zero, first + start, first + end
+
+
+def FindZeroBlocks(fd, blocksize, nblocks, chunk_size=SCAN_SIZE):
+  """Reads the first nblocks blocks of fd and returns the (zero, nonzero)
+  RangeSets of them, built from the runs of FileZeroBlockRuns()."""
+  runs = ([], [])
+  for is_zero, start, end in FileZeroBlockRuns(fd, blocksize, nblocks,
+                                               chunk_size=chunk_size):
+    runs[is_zero].extend((start, end))
+
+  # adjacent runs of two reads are merged by RangeSet
+  return RangeSet(data=runs[True]), RangeSet(data=runs[False])
+
 
 class Image(object):
-  def RangeSha1(self, ranges):
+  def _RangeSha1(self, ranges):
     raise NotImplementedError
 
+  def _Sha1Cache(self):
+    cache = self.__dict__.get("_sha1_cache")
+    if cache is None:
+      # setdefault() is atomic, threads can race here
+      cache = self.__dict__.setdefault("_sha1_cache", {})
+    return cache
+
+  def RangeSha1(self, ranges):
+    """Returns the SHA-1 (hex) of the data in 'ranges'.
+
+    The digests are memoized per RangeSet, asking again for the same blocks
+    (stash slots, the checks in BlockImageDiff) is a dict lookup."""
+    cache = self._Sha1Cache()
+    key = ranges.data.tobytes()
+    digest = cache.get(key)
+    if digest is None:
+      digest = cache[key] = self._RangeSha1(ranges)
+    return digest
+
+  def HashRanges(self, ranges_list, threads=1):
+    """Computes RangeSha1() of every RangeSet in ranges_list on 'threads'
+    threads. os.pread() and hashlib release the GIL for large buffers, so
+    the ranges are hashed on several cores; the results go to the cache."""
+    cache = self._Sha1Cache()
+    todo = {}
+    for ranges in ranges_list:
+      key = ranges.data.tobytes()
+      if key not in cache:
+        todo[key] = ranges
+    # largest first, so one big file does not end up last on a thread
+    keys = sorted(todo, key=lambda k: todo[k].size(), reverse=True)
+    if threads > 1 and len(keys) > 1:
+      with ThreadPoolExecutor(max_workers=threads) as pool:
+        digests = list(pool.map(lambda k: self._RangeSha1(todo[k]), keys))
+    else:
+      digests = [self._RangeSha1(todo[k]) for k in keys]
+    cache.update(zip(keys, digests))
+
   def ReadRangeSet(self, ranges):
     raise NotImplementedError
 
@@ -33,6 +211,18 @@ class Image(object):
   def WriteRangeDataToFd(self, ranges, fd):
     raise NotImplementedError
 
+  def GetRangeSpans(self, ranges):
+    """Returns (path, spans) to read the data in 'ranges' with os.pread(),
+    e.g. from another process. spans is a list of (filepos, fill_data,
+    length) tuples, filepos being None for a fill pattern of 4 bytes.
+    Returns None if the data is not backed by a file."""
+    return None
+
+  def ReadRangeSetInto(self, ranges, buf):
+    """Reads the data in 'ranges' into the writable buffer buf, returns the
+    number of bytes read."""
+    raise NotImplementedError
+
 
 class EmptyImage(Image):
   """A zero-length image."""
@@ -46,7 +236,7 @@ class EmptyImage(Image):
     self.file_map = {}
     self.hashtree_info = None
 
-  def RangeSha1(self, ranges):
+  def _RangeSha1(self, ranges):
     return sha1().hexdigest()
 
   def ReadRangeSet(self, ranges):
@@ -61,6 +251,9 @@ class EmptyImage(Image):
   def WriteRangeDataToFd(self, ranges, fd):
     raise ValueError("Can't write data from EmptyImage to file")
 
+  def ReadRangeSetInto(self, ranges, buf):
+    return 0
+
 
 class DataImage(Image):
   """An image wrapped around a single string of data."""
@@ -77,7 +270,7 @@ class DataImage(Image):
       if trim:
         self.data = self.data[:-partial]
       elif pad:
-        self.data += '\0' * (self.blocksize - partial)
+        self.data += bytes(self.blocksize - partial)
         padded = True
       else:
         raise ValueError(("data for DataImage must be multiple of %d bytes "
@@ -102,16 +295,10 @@ class DataImage(Image):
 
     zero_blocks = []
     nonzero_blocks = []
-    reference = '\0' * self.blocksize
-
-    for i in range(self.total_blocks-1 if padded else self.total_blocks):
-      d = self.data[i*self.blocksize: (i+1)*self.blocksize]
-      if d == reference:
-        zero_blocks.append(i)
-        zero_blocks.append(i+1)
-      else:
-        nonzero_blocks.append(i)
-        nonzero_blocks.append(i+1)
+    for is_zero, start, end in ZeroBlockRuns(
+        self.data, self.blocksize,
+        self.total_blocks-1 if padded else self.total_blocks):
+      (zero_blocks if is_zero else nonzero_blocks).extend((start, end))
 
     assert zero_blocks or nonzero_blocks or clobbered_blocks
 
@@ -127,7 +314,7 @@ class DataImage(Image):
     for s, e in ranges:
       yield self.data[s*self.blocksize:e*self.blocksize]
 
-  def RangeSha1(self, ranges):
+  def _RangeSha1(self, ranges):
     h = sha1()
     for data in self._GetRangeData(ranges):  # pylint: disable=not-an-iterable
       h.update(data)
@@ -145,6 +332,14 @@ class DataImage(Image):
     for data in self._GetRangeData(ranges):  # pylint: disable=not-an-iterable
       fd.write(data)
 
+  def ReadRangeSetInto(self, ranges, buf):
+    view = memoryview(buf).cast("B")
+    pos = 0
+    for data in self._GetRangeData(ranges):  # pylint: disable=not-an-iterable
+      view[pos:pos + len(data)] = data
+      pos += len(data)
+    return pos
+
 
 class FileImage(Image):
   """An image wrapped around a raw image file."""
@@ -164,32 +359,19 @@ class FileImage(Image):
     self.clobbered_blocks = RangeSet()
     self.extended = RangeSet()
 
-    self.generator_lock = threading.Lock()
-
     self.hashtree_info = None
     if hashtree_info_generator:
       self.hashtree_info = hashtree_info_generator.Generate(self)
 
-    zero_blocks = []
-    nonzero_blocks = []
-    reference = '\0' * self.blocksize
-
-    for i in range(self.total_blocks):
-      d = self._file.read(self.blocksize)
-      if d == reference:
-        zero_blocks.append(i)
-        zero_blocks.append(i+1)
-      else:
-        nonzero_blocks.append(i)
-        nonzero_blocks.append(i+1)
-
+    zero_blocks, nonzero_blocks = FindZeroBlocks(
+        self._file.fileno(), self.blocksize, self.total_blocks)
     assert zero_blocks or nonzero_blocks
 
     self.file_map = {}
     if zero_blocks:
-      self.file_map["__ZERO"] = RangeSet(data=zero_blocks)
+      self.file_map["__ZERO"] = zero_blocks
     if nonzero_blocks:
-      self.file_map["__NONZERO"] = RangeSet(data=nonzero_blocks)
+      self.file_map["__NONZERO"] = nonzero_blocks
     if self.hashtree_info:
       self.file_map["__HASHTREE"] = self.hashtree_info.hashtree_range
 
@@ -197,15 +379,10 @@ class FileImage(Image):
     self._file.close()
 
   def _GetRangeData(self, ranges):
-    # Use a lock to protect the generator so that we will not run two
-    # instances of this generator on the same object simultaneously.
-    with self.generator_lock:
-      for s, e in ranges:
-        self._file.seek(s * self.blocksize)
-        for _ in range(s, e):
-          yield self._file.read(self.blocksize)
+    # Reads with os.pread(), several generators can run at once.
+    return IterSpans(self._file.fileno(), self.GetRangeSpans(ranges)[1])
 
-  def RangeSha1(self, ranges):
+  def _RangeSha1(self, ranges):
     h = sha1()
     for data in self._GetRangeData(ranges):  # pylint: disable=not-an-iterable
       h.update(data)
@@ -221,3 +398,27 @@ class FileImage(Image):
   def WriteRangeDataToFd(self, ranges, fd):
     for data in self._GetRangeData(ranges):  # pylint: disable=not-an-iterable
       fd.write(data)
+
+  def GetRangeSpans(self, ranges):
+    return self.path, [(s * self.blocksize, None, (e - s) * self.blocksize)
+                       for s, e in ranges]
+
+  def ReadRangeSetInto(self, ranges, buf):
+    return ReadSpansInto(self._file.fileno(), self.GetRangeSpans(ranges)[1],
+                         buf)
+
+  def IterRangeData(self, ranges, chunk_size=READ_SIZE):
+    return IterSpans(self._file.fileno(), self.GetRangeSpans(ranges)[1],
+                     chunk_size)
+
+  def CopyRangeDataToFd(self, ranges, fd, offset, chunk_size=SCAN_SIZE):
+    """Writes the data in 'ranges' to the file descriptor fd at offset and
+    returns the number of bytes written."""
+    start = offset
+    for data in self.IterRangeData(ranges, chunk_size):
+      view = memoryview(data)
+      written = 0
+      while written < len(view):
+        written += os.pwrite(fd, view[written:], offset + written)
+      offset += written
+    return offset - start
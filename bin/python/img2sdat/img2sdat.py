@@ -25,17 +25,213 @@ from __future__ import print_function
 
 import argparse
 import os
+import queue
+import subprocess
 import sys
 import tempfile
+import threading
 
 import sparse_img
 import common
 import blockimgdiff
-from images import EmptyImage
+from images import EmptyImage, FileImage
+from rangelib import RangeSet
 
+try:
+  import brotli
+except ImportError:
+  brotli = None
 
-def main(input_image, prefix, cache_size, out_dir, version):
-  """Convert image to new.dat format."""
+# max blocks per 'new'/'zero' command, same limit as BlockImageDiff
+BLOCKS_LIMIT = 1024
+# chunks queued for the compressor thread of a pipelined BrotliWriter
+PIPE_DEPTH = 8
+
+
+def write_full_sdat(image, path, version, brotli_quality=None,
+                    brotli_bin='brotli', pipelined=False):
+  """Write path.{transfer.list,new.dat,patch.dat} of a full image.
+
+  Writes the same files as BlockImageDiff(image, EmptyImage(), version)
+  without building the transfer graph or hashing the image: with an empty
+  source every domain of the file map becomes a 'new' (or '__ZERO' a 'zero')
+  transfer, and their sequence is the reversed sorted file map. The data is
+  copied from the image in one pass.
+
+  Args:
+    image: SparseImage or FileImage to convert.
+    path: Output prefix (out_dir/partition).
+    version: Transfer list version (3 or 4).
+    brotli_quality: Write path.new.dat.br compressed with this quality in
+        the same pass instead of path.new.dat.
+    brotli_bin: brotli binary used when the brotli module is not installed.
+    pipelined: Compress on a second thread, see BrotliWriter.
+  """
+  assert version in (3, 4)
+  assert image.blocksize == 4096
+  assert not image.hashtree_info
+
+  transfers = [('zero' if name == '__ZERO' else 'new', image.file_map[name])
+               for name in sorted(image.file_map, reverse=True)
+               if name != '__HASHTREE']
+
+  out = []
+  total = 0
+  for style, ranges in transfers:
+    for piece in ranges.split(BLOCKS_LIMIT):
+      out.append('%s %s\n' % (style, piece.to_string_raw()))
+    total += ranges.size()
+
+  # Zero out extended blocks as a workaround for bug 20881595.
+  for piece in image.extended.split(BLOCKS_LIMIT):
+    out.append('zero %s\n' % (piece.to_string_raw(),))
+  total += image.extended.size()
+
+  all_tgt = RangeSet(data=(0, image.total_blocks))
+  erase = all_tgt.subtract(image.extended).subtract(image.care_map)
+  if erase:
+    out.insert(0, 'erase %s\n' % (erase.to_string_raw(),))
+
+  out[0:0] = ['%d\n' % (version,), '%d\n' % (total,), '0\n', '0\n']
+
+  new_ranges = [ranges for style, ranges in transfers if style == 'new']
+  if brotli_quality is None:
+    with open(path + '.new.dat', 'wb') as new_f:
+      offset = 0
+      for ranges in new_ranges:
+        offset += image.CopyRangeDataToFd(ranges, new_f.fileno(), offset)
+    print('Generated %s.new.dat success' % path)
+  else:
+    with BrotliWriter(path + '.new.dat.br', brotli_quality, brotli_bin,
+                      pipelined) as new_f:
+      for ranges in new_ranges:
+        for data in image.IterRangeData(ranges):
+          new_f.write(data)
+    print('Generated %s.new.dat.br success' % path)
+
+  # a full image has no patches
+  open(path + '.patch.dat', 'wb').close()
+  print('Generated %s.patch.dat success' % path)
+
+  with open(path + '.transfer.list', 'w') as f:
+    f.writelines(out)
+  print('Generated %s.transfer.list success' % path)
+
+
+class BrotliWriter(object):
+  """Write-only file object that brotli compresses into br_file.
+
+  Uses the brotli module, or pipes into brotli_bin when the module is not
+  installed. With pipelined the module compresses on a second thread that
+  takes the written data from a bounded queue, so reading the image and
+  compressing overlap (both release the GIL). The output is one brotli
+  stream either way: the updater can't decode concatenated streams, so the
+  data can't be compressed in independent windows.
+  """
+
+  def __init__(self, br_file, quality, brotli_bin='brotli', pipelined=False):
+    self.name = br_file
+    self._out = open(br_file, 'wb')
+    self._proc = None
+    self._thread = None
+    self._error = None
+    if brotli is None:
+      self._proc = subprocess.Popen([brotli_bin, '-q', str(quality), '-c'],
+                                    stdin=subprocess.PIPE, stdout=self._out)
+      return
+    self._compressor = brotli.Compressor(quality=quality)
+    if pipelined:
+      self._queue = queue.Queue(PIPE_DEPTH)
+      self._thread = threading.Thread(target=self._Compress)
+      self._thread.start()
+
+  def _Compress(self):
+    try:
+      for data in iter(self._queue.get, None):
+        self._out.write(self._compressor.process(data))
+    except Exception as e:  # pylint: disable=broad-except
+      self._error = e
+      # keep taking data so write() never blocks on a full queue
+      for _ in iter(self._queue.get, None):
+        pass
+
+  def write(self, data):
+    if self._proc is not None:
+      self._proc.stdin.write(data)
+    elif self._thread is not None:
+      if self._error is not None:
+        raise self._error
+      # the caller may reuse its buffer once write() returns
+      self._queue.put(data if isinstance(data, bytes) else bytes(data))
+    else:
+      self._out.write(self._compressor.process(data))
+    return len(data)
+
+  def close(self):
+    try:
+      if self._proc is not None:
+        self._proc.stdin.close()
+        if self._proc.wait() != 0:
+          raise RuntimeError('%s failed to compress %s' % (
+            self._proc.args[0], self.name))
+        return
+      if self._thread is not None:
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+          raise self._error
+      self._out.write(self._compressor.finish())
+    finally:
+      self._out.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+def load_image(image_path, file_map=None):
+  """Open a sparse or raw image for BlockImageDiff.
+
+  Args:
+    image_path: Sparse or raw image.
+    file_map: Block map of the files in the image (path ranges per line, as
+        written by e2fsdroid -B). Without a map every non zero block ends up
+        in one __NONZERO (or __DATA) domain and is diffed as a whole.
+  """
+  if not sparse_img.IsSparseImage(image_path):
+    if file_map is None:
+      return FileImage(image_path)
+    # only SparseImage loads file maps, a temp copy in sparse format is
+    # written at disk speed and leaves the zero blocks out
+    sparse_path = common.MakeTempFile(suffix='.sparse')
+    sparse_img.SparsifyImage(image_path, sparse_path)
+    image_path = sparse_path
+
+  if file_map is None:
+    file_map = tempfile.mkstemp()[1]
+  return sparse_img.SparseImage(image_path, file_map, '0')
+
+
+def main(input_image, prefix, cache_size, out_dir, version,
+         use_blockimgdiff=False, brotli_quality=None, source_image=None,
+         source_map=None, target_map=None, brotli_bin='brotli',
+         pipelined=False):
+  """Convert image to new.dat format.
+
+  A full image is written by write_full_sdat(), use_blockimgdiff runs the
+  generic BlockImageDiff pipeline instead (same output, much slower).
+
+  With source_image an incremental transfer list is written instead: the
+  blocks shared with the source image become move/stash commands and the
+  files changed between both become bsdiff/imgdiff patches in
+  prefix.patch.dat, so only new files end up in prefix.new.dat. The file
+  maps let BlockImageDiff pair the files of both images by name.
+
+  With brotli_quality prefix.new.dat.br is written while the data is
+  produced, prefix.new.dat never touches the disk.
+  """
 
   if sys.hexversion < 0x02070000:
     print('Python 2.7 or newer is required.', file=sys.stderr)
@@ -47,12 +243,35 @@ def main(input_image, prefix, cache_size, out_dir, version):
   path = os.path.join(out_dir, prefix)
 
   if os.path.exists(out_dir):
-    image = sparse_img.SparseImage(input_image, tempfile.mkstemp()[1], '0')
+    try:
+      image = load_image(input_image, target_map)
 
-    common.OPTIONS.cache_size = cache_size
-    src = EmptyImage()
-    block_image_diff = blockimgdiff.BlockImageDiff(image, src, version)
-    block_image_diff.Compute(path)
+      if source_image is None and not use_blockimgdiff and \
+          isinstance(image, (sparse_img.SparseImage, FileImage)) and \
+          not image.hashtree_info:
+        write_full_sdat(image, path, version, brotli_quality, brotli_bin,
+                        pipelined)
+        return
+
+      if source_image is None:
+        src = EmptyImage()
+      else:
+        src = load_image(source_image, source_map)
+        if src.blocksize != image.blocksize:
+          raise ValueError('Block size of %s (%d) does not match %s (%d)' % (
+            source_image, src.blocksize, input_image, image.blocksize))
+
+      open_new_data = None
+      if brotli_quality is not None:
+        open_new_data = lambda new_dat: BrotliWriter(
+          new_dat + '.br', brotli_quality, brotli_bin, pipelined)
+
+      common.OPTIONS.cache_size = cache_size
+      block_image_diff = blockimgdiff.BlockImageDiff(
+        image, src, version=version, open_new_data=open_new_data)
+      block_image_diff.Compute(path)
+    finally:
+      common.Cleanup()
 
 
 if __name__ == '__main__':
@@ -65,6 +284,25 @@ if __name__ == '__main__':
     '-v', '--version', help='transfer list version number (3,4 default=4)')
   parser.add_argument(
     '-p', '--prefix', help='name of image (prefix.new.dat)')
+  parser.add_argument(
+    '-b', '--brotli', type=int, metavar='QUALITY',
+    help='write prefix.new.dat.br compressed with QUALITY (0-11) directly')
+  parser.add_argument(
+    '--brotli-bin', default='brotli',
+    help='brotli binary used when the brotli module is not installed')
+  parser.add_argument(
+    '--pipelined', action='store_true',
+    help='compress on a second thread while the image is read (with -b)')
+  parser.add_argument(
+    '--blockimgdiff', action='store_true',
+    help='use the generic BlockImageDiff pipeline instead of the full image writer')
+  parser.add_argument(
+    '-s', '--source', metavar='SRC_IMAGE',
+    help='build an incremental sdat from SRC_IMAGE (image of the previous build)')
+  parser.add_argument(
+    '--source-map', metavar='FILE_MAP', help='block map of SRC_IMAGE files')
+  parser.add_argument(
+    '--target-map', metavar='FILE_MAP', help='block map of the input image files')
 
   args = parser.parse_args()
 
@@ -87,4 +325,8 @@ if __name__ == '__main__':
   else:
     version = 4
 
-  main(image, prefix, cache_size, out_dir, version)
+  main(image, prefix, cache_size, out_dir, version,
+       use_blockimgdiff=args.blockimgdiff, brotli_quality=args.brotli,
+       source_image=args.source, source_map=args.source_map,
+       target_map=args.target_map, brotli_bin=args.brotli_bin,
+       pipelined=args.pipelined)
@@ -14,16 +14,81 @@
 
 from __future__ import print_function
 
+import bisect
 import heapq
 import itertools
+from array import array
 
 
 __all__ = ["RangeSet"]
 
 
+def _skip(data, x, lo=0):
+  """Return the index of the first pair in data (at or after index lo) that
+  ends after x, or len(data) if there is none."""
+  i = bisect.bisect_right(data, x, lo)
+  return i - (i & 1)
+
+
+def _intersect(a, b):
+  """Intersection of two sorted range arrays.
+
+  Pairs of one array lying inside a single pair of the other one are found
+  with bisect and copied in bulk, so a small set against a large one costs
+  about O(small * log(large)).
+  """
+  out = array('q')
+  na, nb = len(a), len(b)
+  i = j = 0
+  while i < na and j < nb:
+    i = _skip(a, b[j], i)
+    if i >= na:
+      break
+    j = _skip(b, a[i], j)
+    if j >= nb:
+      break
+    if b[j] >= a[i+1]:
+      continue
+
+    # a[i:i+2] and b[j:j+2] overlap
+    if a[i+1] <= b[j+1]:
+      out.append(max(a[i], b[j]))
+      out.append(a[i+1])
+      # the following pairs of a up to the end of b[j:j+2]
+      k = _skip(a, b[j+1], i + 2)
+      out.extend(a[i+2:k])
+      i = k
+      if i < na and a[i] < b[j+1]:
+        out.append(a[i])
+        out.append(b[j+1])
+      j += 2
+    else:
+      out.append(max(a[i], b[j]))
+      out.append(b[j+1])
+      k = _skip(b, a[i+1], j + 2)
+      out.extend(b[j+2:k])
+      j = k
+      if j < nb and b[j] < a[i+1]:
+        out.append(b[j])
+        out.append(a[i+1])
+      i += 2
+  return out
+
+
+def _complement(data, lo, hi):
+  """The ranges of [lo, hi) not in data; lo < data[0] and data[-1] < hi."""
+  out = array('q', (lo,))
+  out.extend(data)
+  out.append(hi)
+  return out
+
+
 class RangeSet(object):
   """A RangeSet represents a set of non-overlapping ranges on integers.
 
+  The ranges are kept as a sorted array of [start, end) integer pairs, the
+  set operations walk both arrays once and copy unchanged runs in bulk.
+
   Attributes:
     monotonic: Whether the input has all its integers in increasing order.
     extra: A dict that can be used by the caller, e.g. to store info that's
@@ -33,18 +98,27 @@ class RangeSet(object):
   def __init__(self, data=None):
     self.monotonic = False
     self._extra = {}
+    self._size = None
     if isinstance(data, str):
       self._parse_internal(data)
     elif data:
       assert len(data) % 2 == 0
-      self.data = tuple(self._remove_pairs(data))
+      self.data = array('q', self._remove_pairs(data))
       self.monotonic = all(x < y for x, y in zip(self.data, self.data[1:]))
     else:
-      self.data = ()
+      self.data = array('q')
+
+  @classmethod
+  def _from_sorted(cls, data):
+    """Wrap the output of a set operation, already sorted and merged."""
+    out = cls()
+    out.data = data
+    out.monotonic = bool(data)
+    return out
 
   def __iter__(self):
-    for i in range(0, len(self.data), 2):
-      yield self.data[i:i+2]
+    it = iter(self.data)
+    return zip(it, it)
 
   def __eq__(self, other):
     return self.data == other.data
@@ -123,7 +197,7 @@ class RangeSet(object):
         else:
           monotonic = False
     data.sort()
-    self.data = tuple(self._remove_pairs(data))
+    self.data = array('q', self._remove_pairs(data))
     self.monotonic = monotonic
 
   @staticmethod
@@ -165,14 +239,14 @@ class RangeSet(object):
     >>> RangeSet("10-19 30-34").union(RangeSet("22 32"))
     <RangeSet("10-19 22 30-34")>
     """
-    out = []
-    z = 0
-    for p, d in heapq.merge(zip(self.data, itertools.cycle((+1, -1))),
-                            zip(other.data, itertools.cycle((+1, -1)))):
-      if (z == 0 and d == 1) or (z == 1 and d == -1):
-        out.append(p)
-      z += d
-    return RangeSet(data=out)
+    a, b = self.data, other.data
+    if not a or not b:
+      return RangeSet._from_sorted(a or b)
+    # the complement of the intersection of both complements
+    lo = min(a[0], b[0]) - 1
+    hi = max(a[-1], b[-1]) + 1
+    out = _intersect(_complement(a, lo, hi), _complement(b, lo, hi))
+    return RangeSet._from_sorted(out[1:-1])
 
   def intersect(self, other):
     """Return a new RangeSet representing the intersection of this
@@ -183,14 +257,7 @@ class RangeSet(object):
     >>> RangeSet("10-19 30-34").intersect(RangeSet("22-28"))
     <RangeSet("")>
     """
-    out = []
-    z = 0
-    for p, d in heapq.merge(zip(self.data, itertools.cycle((+1, -1))),
-                            zip(other.data, itertools.cycle((+1, -1)))):
-      if (z == 1 and d == 1) or (z == 2 and d == -1):
-        out.append(p)
-      z += d
-    return RangeSet(data=out)
+    return RangeSet._from_sorted(_intersect(self.data, other.data))
 
   def subtract(self, other):
     """Return a new RangeSet representing subtracting the argument
@@ -202,14 +269,13 @@ class RangeSet(object):
     <RangeSet("10-19 30-34")>
     """
 
-    out = []
-    z = 0
-    for p, d in heapq.merge(zip(self.data, itertools.cycle((+1, -1))),
-                            zip(other.data, itertools.cycle((-1, +1)))):
-      if (z == 0 and d == 1) or (z == 1 and d == -1):
-        out.append(p)
-      z += d
-    return RangeSet(data=out)
+    a, b = self.data, other.data
+    if not a or not b:
+      return RangeSet._from_sorted(a)
+    # the intersection with the complement of other
+    out = _intersect(a, _complement(b, min(a[0], b[0]) - 1,
+                                    max(a[-1], b[-1]) + 1))
+    return RangeSet._from_sorted(out)
 
   def overlaps(self, other):
     """Returns true if the argument has a nonempty overlap with this
@@ -223,12 +289,16 @@ class RangeSet(object):
 
     # This is like intersect, but we can stop as soon as we discover the
     # output is going to be nonempty.
-    z = 0
-    for _, d in heapq.merge(zip(self.data, itertools.cycle((+1, -1))),
-                            zip(other.data, itertools.cycle((+1, -1)))):
-      if (z == 1 and d == 1) or (z == 2 and d == -1):
+    a, b = self.data, other.data
+    na, nb = len(a), len(b)
+    i = j = 0
+    while i < na and j < nb:
+      i = _skip(a, b[j], i)
+      if i >= na:
+        break
+      if a[i] < b[j+1]:
         return True
-      z += d
+      j = _skip(b, a[i], j)
     return False
 
   def size(self):
@@ -239,13 +309,9 @@ class RangeSet(object):
     15
     """
 
-    total = 0
-    for i, p in enumerate(self.data):
-      if i % 2:
-        total += p
-      else:
-        total -= p
-    return total
+    if self._size is None:
+      self._size = sum(self.data[1::2]) - sum(self.data[0::2])
+    return self._size
 
   def map_within(self, other):
     """'other' should be a subset of 'self'.  Returns a RangeSet
@@ -290,13 +356,15 @@ class RangeSet(object):
     >>> RangeSet("10-19 30-39").extend(10)
     <RangeSet("0-49")>
     """
-    out = self
-    for i in range(0, len(self.data), 2):
-      s, e = self.data[i:i+2]
-      s1 = max(0, s - n)
-      e1 = e + n
-      out = out.union(RangeSet(str(s1) + "-" + str(e1-1)))
-    return out
+    out = array('q')
+    for s, e in self:
+      s = max(0, s - n)
+      if out and s <= out[-1]:
+        out[-1] = e + n
+      else:
+        out.append(s)
+        out.append(e + n)
+    return RangeSet._from_sorted(out)
 
   def first(self, n):
     """Return the RangeSet that contains at most the first 'n' integers.
@@ -320,15 +388,47 @@ class RangeSet(object):
     if self.size() <= n:
       return self
 
-    out = []
+    out = array('q')
     for s, e in self:
+      if n <= 0:
+        break
       if e - s >= n:
-        out += (s, s+n)
+        out.append(s)
+        out.append(s+n)
         break
       else:
-        out += (s, e)
+        out.append(s)
+        out.append(e)
         n -= e - s
-    return RangeSet(data=out)
+    return RangeSet._from_sorted(out)
+
+  def split(self, n):
+    """Yield the consecutive RangeSets of at most 'n' integers this RangeSet
+    splits into, same as repeating first(n) and subtract() in one pass.
+
+    >>> list(RangeSet("0-9").split(4))
+    [<RangeSet("0-3")>, <RangeSet("4-7")>, <RangeSet("8-9")>]
+    >>> list(RangeSet("10-12 20-29 40").split(5))
+    [<RangeSet("10-12 20-21")>, <RangeSet("22-26")>, <RangeSet("27-29 40")>]
+    >>> list(RangeSet("").split(5))
+    []
+    """
+    assert n > 0
+    out = array('q')
+    count = 0
+    for s, e in self:
+      while s < e:
+        step = min(e - s, n - count)
+        out.append(s)
+        out.append(s + step)
+        count += step
+        s += step
+        if count == n:
+          yield RangeSet._from_sorted(out)
+          out = array('q')
+          count = 0
+    if out:
+      yield RangeSet._from_sorted(out)
 
   def next_item(self):
     """Return the next integer represented by the RangeSet.
@@ -18,18 +18,37 @@ from __future__ import print_function
 
 import argparse
 import bisect
+import errno
 import logging
 import os
 import struct
-import threading
 from hashlib import sha1
 
 import rangelib
+from images import (FileZeroBlockRuns, Image, IterSpans, ReadSpansInto,
+                    ZeroBlockRuns)
 
 logger = logging.getLogger(__name__)
 
+SPARSE_HEADER_MAGIC = 0xED26FF3A
+SPARSE_HEADER_SIZE = 28
+CHUNK_HEADER_SIZE = 12
 
-class SparseImage(object):
+CHUNK_TYPE_RAW = 0xCAC1
+CHUNK_TYPE_FILL = 0xCAC2
+CHUNK_TYPE_DONT_CARE = 0xCAC3
+CHUNK_TYPE_CRC32 = 0xCAC4
+
+# Size of the reads/writes used when streaming between raw and sparse images.
+STREAM_CHUNK_SIZE = 16 << 20
+
+# errno values that mean os.copy_file_range() can't be used for this pair of
+# files, so we fall back to pread/pwrite.
+COPY_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                    errno.EBADF, errno.EPERM)
+
+
+class SparseImage(Image):
   """Wraps a sparse image file into an image object.
 
   Wraps a sparse image file (and optional file map and clobbered_blocks) into
@@ -121,7 +140,7 @@ class SparseImage(object):
         # Fills the don't care data ranges with zeros.
         # TODO(xunchang) pass the care_map to hashtree info generator.
         if hashtree_info_generator:
-          fill_data = '\x00' * 4
+          fill_data = b'\x00' * 4
           # In order to compute verity hashtree on device, we need to write
           # zeros explicitly to the don't care ranges. Because these ranges may
           # contain non-zero data from the previous build.
@@ -138,8 +157,6 @@ class SparseImage(object):
         raise ValueError("Unknown chunk type 0x%04X not supported" %
                          (chunk_type,))
 
-    self.generator_lock = threading.Lock()
-
     self.care_map = rangelib.RangeSet(care_data)
     self.offset_index = [i[0] for i in offset_map]
 
@@ -178,7 +195,7 @@ class SparseImage(object):
     f.seek(16, os.SEEK_SET)
     f.write(struct.pack("<2I", self.total_blocks, self.total_chunks))
 
-  def RangeSha1(self, ranges):
+  def _RangeSha1(self, ranges):
     h = sha1()
     for data in self._GetRangeData(ranges):
       h.update(data)
@@ -201,44 +218,88 @@ class SparseImage(object):
     for data in self._GetRangeData(ranges):
       fd.write(data)
 
+  def _GetRangeSpans(self, ranges):
+    """Generator that produces (filepos, fill_data, length) for the image
+    data in 'ranges', one tuple per chunk piece. filepos is the offset of
+    the data in the sparse file for raw chunks and None for fill chunks.
+    Reads nothing, so it needs no lock."""
+    for s, e in ranges:
+      idx = bisect.bisect_right(self.offset_index, s) - 1
+      while s < e:
+        chunk_start, chunk_len, filepos, fill_data = self.offset_map[idx]
+        this_read = min(chunk_start + chunk_len, e) - s
+        if filepos is not None:
+          filepos += (s - chunk_start) * self.blocksize
+        yield filepos, fill_data, this_read * self.blocksize
+        s += this_read
+        idx += 1
+
+  def GetRangeSpans(self, ranges):
+    return self.simg_f.name, list(self._GetRangeSpans(ranges))
+
+  def IterRangeData(self, ranges, chunk_size=STREAM_CHUNK_SIZE):
+    """Generator that produces the image data in 'ranges' in pieces of at
+    most chunk_size bytes, read with os.pread() (no shared file position,
+    so no lock)."""
+    return IterSpans(self.simg_f.fileno(), self._GetRangeSpans(ranges),
+                     chunk_size)
+
+  def ReadRangeSetInto(self, ranges, buf):
+    """Reads the image data in 'ranges' into the writable buffer buf, which
+    must hold ranges.size() blocks. Returns the number of bytes read."""
+    return ReadSpansInto(self.simg_f.fileno(), self._GetRangeSpans(ranges), buf)
+
+  def CopyRangeDataToFd(self, ranges, fd, offset, chunk_size=STREAM_CHUNK_SIZE):
+    """Writes the image data in 'ranges' to the file descriptor fd at
+    offset. Raw chunks are copied with os.copy_file_range() where the kernel
+    supports it.
+
+    Returns:
+      The number of bytes written.
+    """
+    in_fd = self.simg_f.fileno()
+    buf = None
+    start = offset
+    for filepos, fill_data, length in self._GetRangeSpans(ranges):
+      if filepos is not None:
+        if buf is None and not _use_copy_file_range:
+          buf = bytearray(chunk_size)
+        _CopyData(in_fd, filepos, fd, offset, length, buf)
+      else:
+        pattern = memoryview(fill_data * (min(length, chunk_size) >> 2))
+        written = 0
+        while written < length:
+          written += os.pwrite(fd, pattern[:length - written], offset + written)
+      offset += length
+    return offset - start
+
   def _GetRangeData(self, ranges):
     """Generator that produces all the image data in 'ranges'.  The
     number of individual pieces returned is arbitrary (and in
     particular is not necessarily equal to the number of ranges in
     'ranges'.
 
-    Use a lock to protect the generator so that we will not run two
-    instances of this generator on the same object simultaneously."""
-
-    f = self.simg_f
-    with self.generator_lock:
-      for s, e in ranges:
-        to_read = e-s
-        idx = bisect.bisect_right(self.offset_index, s) - 1
-        chunk_start, chunk_len, filepos, fill_data = self.offset_map[idx]
-
-        # for the first chunk we may be starting partway through it.
-        remain = chunk_len - (s - chunk_start)
-        this_read = min(remain, to_read)
-        if filepos is not None:
-          p = filepos + ((s - chunk_start) * self.blocksize)
-          f.seek(p, os.SEEK_SET)
-          yield f.read(this_read * self.blocksize)
+    The data is read with os.pread(), so several instances of this
+    generator can run on the same object simultaneously without a lock."""
+    return IterSpans(self.simg_f.fileno(), self._GetRangeSpans(ranges))
+
+  def _ZeroBlockRuns(self, ranges):
+    """Yields the (is_zero, start, end) block runs of 'ranges' in order.
+
+    Raw chunk data is read and classified by images.FileZeroBlockRuns(),
+    a fill chunk piece is one run."""
+    fd = self.simg_f.fileno()
+    zero_fill = bytes(4)
+    for s, e in ranges:
+      for filepos, fill_data, length in self._GetRangeSpans([(s, e)]):
+        n = length // self.blocksize
+        if filepos is None:
+          yield fill_data == zero_fill, s, s + n
         else:
-          yield fill_data * (this_read * (self.blocksize >> 2))
-        to_read -= this_read
-
-        while to_read > 0:
-          # continue with following chunks if this range spans multiple chunks.
-          idx += 1
-          chunk_start, chunk_len, filepos, fill_data = self.offset_map[idx]
-          this_read = min(chunk_len, to_read)
-          if filepos is not None:
-            f.seek(filepos, os.SEEK_SET)
-            yield f.read(this_read * self.blocksize)
-          else:
-            yield fill_data * (this_read * (self.blocksize >> 2))
-          to_read -= this_read
+          for is_zero, start, end in FileZeroBlockRuns(fd, self.blocksize, n,
+                                                       filepos):
+            yield is_zero, s + start, s + end
+        s += n
 
   def LoadFileBlockMap(self, fn, clobbered_blocks, allow_shared_blocks):
     """Loads the given block map file.
@@ -301,45 +362,36 @@ class SparseImage(object):
     # repeated bytes especially poorly.)
 
     zero_blocks = []
-    nonzero_blocks = []
-    reference = '\0' * self.blocksize
+    nonzero_runs = []
+    for is_zero, start, end in self._ZeroBlockRuns(remaining):
+      if is_zero:
+        zero_blocks.extend((start, end))
+      else:
+        nonzero_runs.append((start, end))
 
     # Workaround for bug 23227672. For squashfs, we don't have a system.map. So
     # the whole system image will be treated as a single file. But for some
     # unknown bug, the updater will be killed due to OOM when writing back the
     # patched image to flash (observed on lenok-userdebug MEA49). Prior to
     # getting a real fix, we evenly divide the non-zero blocks into smaller
-    # groups (currently 1024 blocks or 4MB per group).
+    # groups (MAX_BLOCKS_PER_GROUP entries of a flat list of per-block
+    # pairs, ie. 512 blocks or 2MB per group).
     # Bug: 23227672
     MAX_BLOCKS_PER_GROUP = 1024
+    group_blocks = MAX_BLOCKS_PER_GROUP // 2
     nonzero_groups = []
-
-    f = self.simg_f
-    for s, e in remaining:
-      for b in range(s, e):
-        idx = bisect.bisect_right(self.offset_index, b) - 1
-        chunk_start, _, filepos, fill_data = self.offset_map[idx]
-        if filepos is not None:
-          filepos += (b-chunk_start) * self.blocksize
-          f.seek(filepos, os.SEEK_SET)
-          data = f.read(self.blocksize)
-        else:
-          if fill_data == reference[:4]:   # fill with all zeros
-            data = reference
-          else:
-            data = None
-
-        if data == reference:
-          zero_blocks.append(b)
-          zero_blocks.append(b+1)
-        else:
-          nonzero_blocks.append(b)
-          nonzero_blocks.append(b+1)
-
-          if len(nonzero_blocks) >= MAX_BLOCKS_PER_GROUP:
-            nonzero_groups.append(nonzero_blocks)
-            # Clear the list.
-            nonzero_blocks = []
+    nonzero_blocks = []
+    count = 0
+    for s, e in nonzero_runs:
+      while s < e:
+        n = min(e - s, group_blocks - count)
+        nonzero_blocks.extend((s, s + n))
+        count += n
+        s += n
+        if count == group_blocks:
+          nonzero_groups.append(nonzero_blocks)
+          nonzero_blocks = []
+          count = 0
 
     if nonzero_blocks:
       nonzero_groups.append(nonzero_blocks)
@@ -371,6 +423,360 @@ def GetImagePartitionSize(img):
     return os.path.getsize(img)
 
 
+def IsSparseImage(fn, offset=0):
+  """Returns True if fn starts with the sparse image magic (at offset)."""
+  with open(fn, "rb") as f:
+    f.seek(offset)
+    header_bin = f.read(4)
+  return (len(header_bin) == 4 and
+          struct.unpack("<I", header_bin)[0] == SPARSE_HEADER_MAGIC)
+
+
+def ReadSparseHeader(f):
+  """Reads and checks the sparse header at the current position of f.
+
+  Returns:
+    A tuple of (blk_sz, total_blks, total_chunks).
+  """
+  header_bin = f.read(SPARSE_HEADER_SIZE)
+  if len(header_bin) != SPARSE_HEADER_SIZE:
+    raise ValueError("Truncated sparse header")
+  (magic, major_version, minor_version, file_hdr_sz, chunk_hdr_sz, blk_sz,
+   total_blks, total_chunks, _) = struct.unpack("<I4H4I", header_bin)
+
+  if magic != SPARSE_HEADER_MAGIC:
+    raise ValueError("Magic should be 0xED26FF3A but is 0x%08X" % (magic,))
+  if major_version != 1 or minor_version != 0:
+    raise ValueError("I know about version 1.0, but this is version %u.%u" %
+                     (major_version, minor_version))
+  if file_hdr_sz != SPARSE_HEADER_SIZE:
+    raise ValueError("File header size was expected to be 28, but is %u." %
+                     (file_hdr_sz,))
+  if chunk_hdr_sz != CHUNK_HEADER_SIZE:
+    raise ValueError("Chunk header size was expected to be 12, but is %u." %
+                     (chunk_hdr_sz,))
+  return blk_sz, total_blks, total_chunks
+
+
+def ReadChunkHeader(f):
+  """Reads a chunk header. Returns (chunk_type, chunk_sz, data_sz)."""
+  header_bin = f.read(CHUNK_HEADER_SIZE)
+  if len(header_bin) != CHUNK_HEADER_SIZE:
+    raise ValueError("Truncated chunk header")
+  chunk_type, _, chunk_sz, total_sz = struct.unpack("<2H2I", header_bin)
+  return chunk_type, chunk_sz, total_sz - CHUNK_HEADER_SIZE
+
+
+_use_copy_file_range = hasattr(os, "copy_file_range")
+
+
+def _CopyData(in_fd, in_offset, out_fd, out_offset, length, buf):
+  """Copies length bytes between two fds at the given offsets.
+
+  Uses os.copy_file_range() so the data stays in the kernel (and may be
+  reflinked), and falls back to preadv/pwrite through buf (allocated when
+  None)."""
+  global _use_copy_file_range
+
+  while length > 0 and _use_copy_file_range:
+    try:
+      copied = os.copy_file_range(in_fd, out_fd, length, in_offset, out_offset)
+    except OSError as e:
+      if e.errno not in COPY_UNSUPPORTED:
+        raise
+      _use_copy_file_range = False
+      break
+    if copied == 0:
+      raise ValueError("Unexpected end of sparse image")
+    in_offset += copied
+    out_offset += copied
+    length -= copied
+
+  if length <= 0:
+    return
+  if buf is None:
+    buf = bytearray(STREAM_CHUNK_SIZE)
+  view = memoryview(buf)
+  while length > 0:
+    n = os.preadv(in_fd, [view[:min(length, len(buf))]], in_offset)
+    if n == 0:
+      raise ValueError("Unexpected end of sparse image")
+    written = 0
+    while written < n:
+      written += os.pwrite(out_fd, view[written:n], out_offset + written)
+    in_offset += n
+    out_offset += n
+    length -= n
+
+
+def UnsparseImage(simg_fn, out_fn, progress=None,
+                  chunk_size=STREAM_CHUNK_SIZE, offset=0):
+  """Writes the raw image of the sparse image simg_fn to out_fn.
+
+  Raw chunks are copied with os.copy_file_range() where the kernel supports
+  it. "Don't care" chunks and zero fill chunks are not written at all, they
+  are left as holes in out_fn, which is then truncated to the full image size.
+
+  Args:
+    simg_fn: The filename of the sparse image.
+    out_fn: The filename of the raw image to write.
+    progress: Optional callable(done, total), called with the number of
+        output bytes handled after every chunk.
+    chunk_size: Size of the buffer used when copy_file_range() is not
+        available, and of the pattern written for non-zero fill chunks.
+    offset: Offset of the sparse image in simg_fn, e.g. the data of a
+        stored zip member.
+
+  Returns:
+    The size of the raw image in bytes.
+  """
+  with open(simg_fn, "rb") as f, open(out_fn, "wb") as out:
+    f.seek(offset)
+    blk_sz, total_blks, total_chunks = ReadSparseHeader(f)
+    total = blk_sz * total_blks
+    in_fd = f.fileno()
+    out_fd = out.fileno()
+    buf = bytearray(chunk_size)
+    zero_fill = bytes(4)
+
+    pos = 0   # in bytes
+    for _ in range(total_chunks):
+      chunk_type, chunk_sz, data_sz = ReadChunkHeader(f)
+      length = chunk_sz * blk_sz
+
+      if chunk_type == CHUNK_TYPE_RAW:
+        if data_sz != length:
+          raise ValueError(
+            "Raw chunk input size (%u) does not match output size (%u)" %
+            (data_sz, length))
+        _CopyData(in_fd, f.tell(), out_fd, pos, length, buf)
+        f.seek(data_sz, os.SEEK_CUR)
+
+      elif chunk_type == CHUNK_TYPE_FILL:
+        fill_data = f.read(4)
+        if fill_data != zero_fill:
+          pattern = memoryview(fill_data * (min(length, chunk_size) >> 2))
+          written = 0
+          while written < length:
+            written += os.pwrite(out_fd, pattern[:length - written],
+                                 pos + written)
+
+      elif chunk_type == CHUNK_TYPE_DONT_CARE:
+        if data_sz != 0:
+          raise ValueError("Don't care chunk input size is non-zero (%u)" %
+                           (data_sz))
+
+      elif chunk_type == CHUNK_TYPE_CRC32:
+        f.seek(data_sz, os.SEEK_CUR)
+
+      else:
+        raise ValueError("Unknown chunk type 0x%04X not supported" %
+                         (chunk_type,))
+
+      pos += length
+      if progress:
+        progress(pos, total)
+
+    if pos != total:
+      raise ValueError("Sparse image has %u blocks in its chunks, expected %u" %
+                       (pos // blk_sz, total_blks))
+    out.truncate(total)
+
+  return total
+
+
+class SparseImageWriter(object):
+  """Writes a sparse image sequentially, one run of blocks at a time.
+
+  Consecutive raw runs are merged into one raw chunk and consecutive fill runs
+  of the same value into one fill chunk, as libsparse does. The header of the
+  open raw chunk (and the file header) is patched in place once its size is
+  known, so raw data can be streamed straight to the output.
+  """
+
+  def __init__(self, f, blocksize=4096):
+    self.f = f
+    self.fd = f.fileno()
+    self.blocksize = blocksize
+    self.max_raw_blocks = (0xFFFFFFFF - CHUNK_HEADER_SIZE) // blocksize
+    self.total_blocks = 0
+    self.total_chunks = 0
+
+    # The chunk being built: its type, size in blocks, and either the file
+    # offset of its header (raw) or its fill value (fill).
+    self._type = None
+    self._blocks = 0
+    self._header_pos = 0
+    self._fill_data = None
+
+    f.write(bytes(SPARSE_HEADER_SIZE))
+
+  def _CloseChunk(self):
+    if self._type == CHUNK_TYPE_RAW:
+      os.pwrite(self.fd, struct.pack(
+        "<2H2I", CHUNK_TYPE_RAW, 0, self._blocks,
+        CHUNK_HEADER_SIZE + self._blocks * self.blocksize), self._header_pos)
+    elif self._type == CHUNK_TYPE_FILL:
+      self.f.write(struct.pack("<2H2I", CHUNK_TYPE_FILL, 0, self._blocks,
+                               CHUNK_HEADER_SIZE + 4) + self._fill_data)
+    elif self._type == CHUNK_TYPE_DONT_CARE:
+      self.f.write(struct.pack("<2H2I", CHUNK_TYPE_DONT_CARE, 0, self._blocks,
+                               CHUNK_HEADER_SIZE))
+    if self._type is not None:
+      self.total_chunks += 1
+    self._type = None
+    self._blocks = 0
+
+  def WriteRaw(self, data):
+    """Appends data (a whole number of blocks) as raw blocks."""
+    view = memoryview(data)
+    while view:
+      if (self._type != CHUNK_TYPE_RAW or
+          self._blocks == self.max_raw_blocks):
+        self._CloseChunk()
+        self._type = CHUNK_TYPE_RAW
+        self._header_pos = self.f.tell()
+        self.f.write(bytes(CHUNK_HEADER_SIZE))
+      blocks = min(len(view) // self.blocksize,
+                   self.max_raw_blocks - self._blocks)
+      piece = view[:blocks * self.blocksize]
+      written = 0
+      while written < len(piece):
+        written += self.f.write(piece[written:])
+      self._blocks += blocks
+      self.total_blocks += blocks
+      view = view[len(piece):]
+
+  def WriteFill(self, fill_data, blocks):
+    """Appends blocks blocks filled with the 4-byte value fill_data."""
+    fill_data = bytes(fill_data)
+    if self._type != CHUNK_TYPE_FILL or self._fill_data != fill_data:
+      self._CloseChunk()
+      self._type = CHUNK_TYPE_FILL
+      self._fill_data = fill_data
+    self._blocks += blocks
+    self.total_blocks += blocks
+
+  def Skip(self, blocks):
+    """Appends blocks "don't care" blocks."""
+    if self._type != CHUNK_TYPE_DONT_CARE:
+      self._CloseChunk()
+      self._type = CHUNK_TYPE_DONT_CARE
+    self._blocks += blocks
+    self.total_blocks += blocks
+
+  def Finish(self):
+    """Closes the last chunk and writes the sparse header."""
+    self._CloseChunk()
+    os.pwrite(self.fd, struct.pack(
+      "<I4H4I", SPARSE_HEADER_MAGIC, 1, 0, SPARSE_HEADER_SIZE,
+      CHUNK_HEADER_SIZE, self.blocksize, self.total_blocks, self.total_chunks,
+      0), 0)
+
+
+def ClassifyBlocks(data, blocksize, nblocks=None):
+  """Splits data into runs of raw blocks and blocks of one repeated word.
+
+  A block is a fill block when all its 32-bit words are equal, which is the
+  same test libsparse uses. Zero runs come from images.ZeroBlockRuns(), only
+  the non-zero blocks are checked one by one for another fill word, with a
+  bytes.startswith() of the block against itself shifted by one word, so
+  the compares run as memcmp() in C instead of a per-word Python loop.
+
+  Args:
+    data: A bytes-like object holding nblocks whole blocks.
+    blocksize: The block size.
+    nblocks: Number of blocks of data to classify. Default all of data.
+
+  Yields:
+    (fill_data, start, end) tuples in block numbers relative to data, where
+    fill_data is the 4-byte fill value or None for raw blocks.
+  """
+  if nblocks is None:
+    nblocks = len(data) // blocksize
+  if not isinstance(data, (bytes, bytearray)):
+    data = bytes(data)
+  view = memoryview(data)
+  zero_fill = bytes(4)
+
+  for is_zero, start, end in ZeroBlockRuns(data, blocksize, nblocks):
+    if is_zero:
+      yield zero_fill, start, end
+      continue
+
+    run_fill = None
+    run_start = start
+    for b in range(start, end):
+      s = b * blocksize
+      if data.startswith(view[s:s + blocksize - 4], s + 4):
+        fill_data = bytes(view[s:s + 4])
+      else:
+        fill_data = None
+
+      if b != run_start and fill_data != run_fill:
+        yield run_fill, run_start, b
+        run_start = b
+      run_fill = fill_data
+    yield run_fill, run_start, end
+
+
+def SparsifyImage(raw_fn, out_fn, blocksize=4096, progress=None,
+                  chunk_size=STREAM_CHUNK_SIZE):
+  """Converts the raw image raw_fn into the sparse image out_fn in one pass.
+
+  Blocks whose 32-bit words are all equal become fill chunks, everything else
+  raw chunks, like img2simg does. A trailing partial block is padded with
+  zeros.
+
+  Args:
+    raw_fn: The filename of the raw image.
+    out_fn: The filename of the sparse image to write.
+    blocksize: The block size of the sparse image.
+    progress: Optional callable(done, total), called with the number of input
+        bytes handled after every read.
+    chunk_size: Size of each read from raw_fn, rounded down to whole blocks.
+
+  Returns:
+    A tuple of (total_blocks, total_chunks) of the written image.
+  """
+  chunk_size = max(chunk_size // blocksize, 1) * blocksize
+  buf = bytearray(chunk_size)
+  view = memoryview(buf)
+
+  with open(raw_fn, "rb", buffering=0) as f, \
+      open(out_fn, "wb", buffering=0) as out:
+    total = os.fstat(f.fileno()).st_size
+    writer = SparseImageWriter(out, blocksize)
+
+    done = 0
+    while True:
+      n = 0
+      while n < chunk_size:
+        r = f.readinto(view[n:])
+        if not r:
+          break
+        n += r
+      if not n:
+        break
+      nblocks = -(-n // blocksize)
+      if n % blocksize:
+        view[n:nblocks * blocksize] = bytes(nblocks * blocksize - n)
+
+      for fill_data, start, end in ClassifyBlocks(buf, blocksize, nblocks):
+        if fill_data is None:
+          writer.WriteRaw(view[start * blocksize:end * blocksize])
+        else:
+          writer.WriteFill(fill_data, end - start)
+
+      done += n
+      if progress:
+        progress(done, total)
+
+    writer.Finish()
+
+  return writer.total_blocks, writer.total_chunks
+
+
 if __name__ == '__main__':
   parser = argparse.ArgumentParser()
   parser.add_argument('image')
@@ -0,0 +1,76 @@
+import os
+import tempfile
+import types
+import zlib
+
+import common  # imports blockimgdiff, which imports common
+import blockimgdiff
+from images import DataImage, EmptyImage
+from rangelib import RangeSet
+
+BLOCK_SIZE = 4096
+
+
+def test_read_spans_reopens_path():
+  with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, 'image')
+    with open(path, 'wb') as f:
+      f.write(b'a' * BLOCK_SIZE)
+    fds = len(os.listdir('/proc/self/fd'))
+    spans = [(0, None, BLOCK_SIZE)]
+    assert blockimgdiff._ReadSpans((path, spans)) == b'a' * BLOCK_SIZE
+
+    # a new file written to the same path is read, no fd is left open
+    os.remove(path)
+    with open(path, 'wb') as f:
+      f.write(b'b' * BLOCK_SIZE)
+    assert blockimgdiff._ReadSpans((path, spans)) == b'b' * BLOCK_SIZE
+    assert len(os.listdir('/proc/self/fd')) == fds
+
+
+class _CountingImage(DataImage):
+  """DataImage (no spans) counting the ranges read for the patch jobs"""
+
+  def __init__(self, data):
+    super().__init__(data)
+    self.reads = 0
+
+  def ReadRangeSet(self, ranges):
+    self.reads += 1
+    return super().ReadRangeSet(ranges)
+
+
+def _patch_jobs(threads, count=12):
+  tgt = _CountingImage(b''.join(bytes([i]) * BLOCK_SIZE for i in range(count)))
+  transfers = [types.SimpleNamespace(tgt_ranges=RangeSet(data=(i, i + 1)),
+                                     src_ranges=RangeSet(), patch_info=b'patch',
+                                     tgt_name='/f%d' % i, src_name='/f%d' % i)
+               for i in range(count)]
+  diff = types.SimpleNamespace(threads=threads, transfers=transfers,
+                               src=EmptyImage(), tgt=tgt)
+  diff_queue = [(i, False, count - i) for i in range(count)]
+  return diff, diff_queue
+
+
+def _compressed_size(data):
+  compress_obj = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+  return len(compress_obj.compress(data)) + len(compress_obj.flush())
+
+
+def test_patch_jobs_bounded():
+  for threads in (1, 2):
+    diff, diff_queue = _patch_jobs(threads)
+    results = blockimgdiff.BlockImageDiff.IterPatchesForInputList(
+        diff, diff_queue, True)
+
+    first = next(results)
+    # only the jobs in flight have their data read
+    assert diff.tgt.reads <= threads * blockimgdiff.PENDING_JOBS_PER_PROCESS
+    rest = list(results)
+
+    assert diff.tgt.reads == len(diff_queue)
+    # in the order of the queue (sorted by the last item)
+    assert [first[0]] + [r[0] for r in rest] == list(range(11, -1, -1))
+    for xf_index, patch_info, compressed_size in [first] + rest:
+      assert patch_info == b'patch'
+      assert compressed_size == _compressed_size(bytes([xf_index]) * BLOCK_SIZE)
@@ -0,0 +1,129 @@
+import os
+import random
+import shutil
+import tempfile
+
+import pytest
+
+import img2sdat
+import test_sparse_img
+from rangelib import RangeSet
+
+BLOCK_SIZE = 4096
+TOTAL_BLOCKS = 32
+
+
+def _write_image(path, blocks):
+  """blocks: block number -> data, the other blocks are zero"""
+  with open(path, 'wb') as f:
+    for b in range(TOTAL_BLOCKS):
+      f.write(blocks.get(b, bytes(BLOCK_SIZE)))
+
+
+def _write_map(path, files):
+  with open(path, 'w') as f:
+    for name, ranges in files:
+      f.write('%s %s\n' % (name, ranges))
+
+
+def _commands(transfer_list):
+  with open(transfer_list) as f:
+    lines = f.read().splitlines()[4:]
+  return [line.split(' ') for line in lines]
+
+
+@pytest.mark.skipif(shutil.which('bsdiff') is None, reason='needs bsdiff')
+def test_incremental_transfer_list():
+  rng = random.Random(12)
+  same = rng.randbytes(4 * BLOCK_SIZE)
+  changed = bytearray(rng.randbytes(4 * BLOCK_SIZE))
+  header = b'\x01' * BLOCK_SIZE
+
+  with tempfile.TemporaryDirectory() as tmp:
+    # source: /same at 1-4, /changed at 5-8, free nonzero blocks at 9-12
+    src_blocks = {0: header}
+    src_blocks.update({1 + i: same[i * BLOCK_SIZE:(i + 1) * BLOCK_SIZE]
+                       for i in range(4)})
+    src_blocks.update({5 + i: bytes(changed[i * BLOCK_SIZE:(i + 1) * BLOCK_SIZE])
+                       for i in range(4)})
+    src_blocks.update({9 + i: b'\x02' * BLOCK_SIZE for i in range(4)})
+    src_image = os.path.join(tmp, 'src.img')
+    src_map = os.path.join(tmp, 'src.map')
+    _write_image(src_image, src_blocks)
+    _write_map(src_map, [('/same', '1-4'), ('/changed', '5-8')])
+
+    # target: /same moved to 20-23, a few bytes of /changed edited and the
+    # free blocks 9-12 zeroed
+    changed[100:108] = b'modified'
+    changed[3 * BLOCK_SIZE + 7] ^= 0xff
+    tgt_blocks = {0: header}
+    tgt_blocks.update({20 + i: same[i * BLOCK_SIZE:(i + 1) * BLOCK_SIZE]
+                       for i in range(4)})
+    tgt_blocks.update({5 + i: bytes(changed[i * BLOCK_SIZE:(i + 1) * BLOCK_SIZE])
+                       for i in range(4)})
+    tgt_image = os.path.join(tmp, 'tgt.img')
+    tgt_map = os.path.join(tmp, 'tgt.map')
+    _write_image(tgt_image, tgt_blocks)
+    _write_map(tgt_map, [('/same', '20-23'), ('/changed', '5-8')])
+
+    out_dir = os.path.join(tmp, 'out')
+    img2sdat.main(tgt_image, 'system', 1 << 26, out_dir, 4,
+                  source_image=src_image, source_map=src_map,
+                  target_map=tgt_map)
+
+    commands = _commands(os.path.join(out_dir, 'system.transfer.list'))
+    by_style = {}
+    for cmd in commands:
+      by_style.setdefault(cmd[0], []).append(cmd)
+
+    zero = RangeSet()
+    for cmd in by_style['zero']:
+      zero = zero.union(RangeSet.parse_raw(cmd[1]))
+    assert zero.intersect(RangeSet('9-12')) == RangeSet('9-12')
+
+    # move <hash> <tgt ranges> <src blocks> <src ranges>
+    moves = [(RangeSet.parse_raw(cmd[2]), RangeSet.parse_raw(cmd[4]))
+             for cmd in by_style['move']]
+    assert (RangeSet('20-23'), RangeSet('1-4')) in moves
+
+    # bsdiff <offset> <len> <src hash> <tgt hash> <tgt ranges> ...
+    patched = [RangeSet.parse_raw(cmd[5]) for cmd in by_style['bsdiff']]
+    assert RangeSet('5-8') in patched
+
+    # only the clobbered block 0 is new data
+    assert [cmd[1] for cmd in by_style['new']] == ['2,0,1']
+    with open(os.path.join(out_dir, 'system.patch.dat'), 'rb') as f:
+      assert f.read()
+
+
+def _outputs(out_dir):
+  files = {}
+  for name in sorted(os.listdir(out_dir)):
+    with open(os.path.join(out_dir, name), 'rb') as f:
+      files[name] = f.read()
+  return files
+
+
+@pytest.mark.parametrize('sparse', [True, False])
+@pytest.mark.parametrize('brotli_quality', [None, 5])
+def test_full_sdat_matches_blockimgdiff(sparse, brotli_quality):
+  if brotli_quality is not None and img2sdat.brotli is None and \
+      shutil.which('brotli') is None:
+    pytest.skip('needs brotli')
+
+  with tempfile.TemporaryDirectory() as tmp:
+    simg, raw, _ = test_sparse_img._make_image(tmp)
+    image = simg if sparse else raw
+
+    full_dir = os.path.join(tmp, 'full')
+    img2sdat.main(image, 'system', 1 << 26, full_dir, 4,
+                  brotli_quality=brotli_quality)
+    generic_dir = os.path.join(tmp, 'generic')
+    img2sdat.main(image, 'system', 1 << 26, generic_dir, 4,
+                  use_blockimgdiff=True, brotli_quality=brotli_quality)
+
+    full = _outputs(full_dir)
+    assert sorted(full) == sorted(
+      ['system.transfer.list', 'system.patch.dat',
+       'system.new.dat' if brotli_quality is None else 'system.new.dat.br'])
+    assert full == _outputs(generic_dir)
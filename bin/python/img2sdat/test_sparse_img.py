@@ -0,0 +1,101 @@
+import os
+import struct
+import tempfile
+
+import images
+import sparse_img
+from rangelib import RangeSet
+
+BLOCK_SIZE = 4096
+
+
+def _block(byte):
+  return bytes([byte]) * BLOCK_SIZE
+
+
+def _write_sparse(path, chunks, total_blocks):
+  """chunks: ('raw', data) or ('fill', 4 bytes, blocks) in block order"""
+  with open(path, 'wb') as f:
+    f.write(struct.pack('<I4H4I', 0xED26FF3A, 1, 0, 28, 12, BLOCK_SIZE,
+                        total_blocks, len(chunks), 0))
+    for chunk in chunks:
+      if chunk[0] == 'raw':
+        data = chunk[1]
+        f.write(struct.pack('<2H2I', 0xCAC1, 0, len(data) // BLOCK_SIZE,
+                            12 + len(data)))
+        f.write(data)
+      else:
+        f.write(struct.pack('<2H2I', 0xCAC2, 0, chunk[2], 16))
+        f.write(chunk[1])
+
+
+def _make_image(tmp):
+  """Sparse image, the same image unsparsed and a block map of two files.
+
+  Zero blocks sit in raw chunks (inside and outside the files) and in a zero
+  fill chunk, 600 free nonzero blocks are split in two __NONZERO groups."""
+  raw_data = (
+    _block(1) +                            # 0: clobbered
+    _block(2) * 2 + _block(0) + _block(3) +  # 1-4: /a, zero block 3
+    _block(0) * 3 +                        # 5-7: free zero
+    _block(4) * 300 +                      # 8-307: free nonzero
+    _block(5) * 2 +                        # 308-309: /b
+    _block(0) + _block(6) + _block(0))     # 310-312: free
+  chunks = [
+    ('raw', raw_data),
+    ('fill', bytes(4), 20),                # 313-332: free zero
+    ('fill', b'\x07' * 4, 300),            # 333-632: free nonzero
+    ('raw', _block(0) * 2 + _block(8)),    # 633-635: /b 635, free zero
+  ]
+  total = 636
+  simg = os.path.join(tmp, 'system.img')
+  _write_sparse(simg, chunks, total)
+
+  raw = os.path.join(tmp, 'system.raw')
+  with open(raw, 'wb') as f:
+    for chunk in chunks:
+      f.write(chunk[1] if chunk[0] == 'raw' else chunk[1] * (BLOCK_SIZE // 4) * chunk[2])
+
+  block_map = os.path.join(tmp, 'system.map')
+  with open(block_map, 'w') as f:
+    f.write('/a 1-4\n/b 308-309 635\n')
+  return simg, raw, block_map
+
+
+def test_load_file_block_map_zero_blocks():
+  with tempfile.TemporaryDirectory() as tmp:
+    simg, raw, block_map = _make_image(tmp)
+    image = sparse_img.SparseImage(simg, block_map, '0')
+    file_image = images.FileImage(raw)
+
+    files = image.file_map['/a'].union(image.file_map['/b'])
+    free = image.care_map.subtract(files).subtract(image.file_map['__COPY'])
+    assert image.file_map['__ZERO'] == \
+        file_image.file_map['__ZERO'].intersect(free)
+    assert image.file_map['__ZERO'] == RangeSet('5-7 310 312-332 633-634')
+    assert image.file_map['/a'] == RangeSet('1-4')
+
+
+def test_load_file_block_map_nonzero_groups():
+  with tempfile.TemporaryDirectory() as tmp:
+    simg, _, block_map = _make_image(tmp)
+    image = sparse_img.SparseImage(simg, block_map, '0')
+
+    groups = sorted(k for k in image.file_map if k.startswith('__NONZERO'))
+    assert groups == ['__NONZERO-0', '__NONZERO-1']
+    assert image.file_map['__NONZERO-0'] == RangeSet('8-307 311 333-543')
+    assert image.file_map['__NONZERO-1'] == RangeSet('544-632')
+
+
+def test_load_image_sparsifies_raw_image():
+  import img2sdat
+
+  with tempfile.TemporaryDirectory() as tmp:
+    simg, raw, block_map = _make_image(tmp)
+    image = img2sdat.load_image(raw, block_map)
+    expected = sparse_img.SparseImage(simg, block_map, '0')
+    try:
+      for name in ('/a', '/b', '__ZERO', '__COPY'):
+        assert image.file_map[name] == expected.file_map[name]
+    finally:
+      img2sdat.common.Cleanup()
@@ -0,0 +1,709 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# File Name    :   lpunpack.py
+"""
+    Edit_OEM_ROM_Project
+    Copyright (C) <2022>  <Abdalrohman Alnasier>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Unpack the logical partitions of a super image, reads the LP metadata
+(liblp/include/liblp/metadata_format.h) and copies the extents of every
+partition to <output>/<name>.img.
+
+Raw and sparse images are read in place, a super image split in sparse
+chunks (super.img_sparsechunk.N) is read from all of them as one image.
+A super image that can only be decoded as a stream (gz, zstd, sdat, sparse
+data read from a compressed zip member) is written to a SuperWriter, which
+routes the data to the partition images as it arrives, so the whole super
+image is never written to disk.
+"""
+
+import argparse
+import bisect
+import hashlib
+import os
+import struct
+import sys
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+LP_SECTOR_SIZE = 512
+LP_PARTITION_RESERVED_BYTES = 4096
+LP_METADATA_GEOMETRY_SIZE = 4096
+# the metadata slots start after the reserved bytes and both geometries
+LP_METADATA_START = LP_PARTITION_RESERVED_BYTES + 2 * LP_METADATA_GEOMETRY_SIZE
+LP_METADATA_GEOMETRY_MAGIC = 0x616c4467
+LP_METADATA_HEADER_MAGIC = 0x414c5030
+LP_METADATA_MAJOR_VERSION = 10
+LP_TARGET_TYPE_LINEAR = 0
+LP_TARGET_TYPE_ZERO = 1
+
+# magic, struct_size, checksum, metadata_max_size, metadata_slot_count,
+# logical_block_size
+GEOMETRY = struct.Struct('<II32sIII')
+# magic, major, minor, header_size, header_checksum, tables_size,
+# tables_checksum, then (offset, num_entries, entry_size) of the partition,
+# extent, group and block device tables
+HEADER = struct.Struct('<IHHI32sI32s12I')
+# name, attributes, first_extent_index, num_extents, group_index
+PARTITION = struct.Struct('<36sIIII')
+# num_sectors, target_type, target_data, target_source
+EXTENT = struct.Struct('<QIQI')
+
+SPARSE_HEADER_MAGIC = 0xED26FF3A
+# magic, major, minor, file_hdr_sz, chunk_hdr_sz, blk_sz, total_blks,
+# total_chunks, image_checksum
+SPARSE_HEADER = struct.Struct('<I4H4I')
+# chunk_type, reserved, chunk_sz, total_sz
+SPARSE_CHUNK_HEADER = struct.Struct('<2H2I')
+CHUNK_TYPE_RAW = 0xCAC1
+CHUNK_TYPE_FILL = 0xCAC2
+CHUNK_TYPE_DONT_CARE = 0xCAC3
+CHUNK_TYPE_CRC32 = 0xCAC4
+
+# bytes copied at a time when copy_file_range can't be used
+COPY_SIZE = 4 << 20
+
+Geometry = namedtuple('Geometry', 'metadata_max_size metadata_slot_count '
+                      'logical_block_size')
+# offset and size in bytes, offset is None for a zero extent
+Extent = namedtuple('Extent', 'offset size')
+Partition = namedtuple('Partition', 'name attributes extents')
+
+
+class LpError(Exception):
+  pass
+
+
+class RawSource:
+  """Raw super image at `offset` of a file (eg: a stored zip member)"""
+
+  def __init__(self, path, offset=0):
+    self.path = path
+    self.offset = offset
+    self.fd = os.open(path, os.O_RDONLY)
+
+  def read(self, offset, size):
+    data = os.pread(self.fd, size, self.offset + offset)
+    if len(data) != size:
+      raise LpError('%s is truncated' % self.path)
+    return data
+
+  def copy(self, offset, size, fd, out_offset):
+    """Copy size bytes at offset of the image to fd at out_offset"""
+    copy_file_range(self.fd, self.offset + offset, fd, out_offset, size)
+
+  def close(self):
+    os.close(self.fd)
+
+
+class SparseSource:
+  """Sparse super image read in place
+
+  images are the (path, offset) of one sparse image, or of the sparse
+  chunks a super image was split in, which hold the data of different
+  ranges of the same image (like simg2img with several inputs). The
+  offset is where the image starts in the file (eg: a stored zip member).
+
+  Only the chunk headers are read up front, the data of raw chunks is
+  copied from the sparse images when a partition is unpacked.
+  """
+
+  def __init__(self, images):
+    self.path = images[0][0]
+    self.size = 0
+    self.fds = {}
+    chunks = []
+    try:
+      for path, offset in images:
+        if path not in self.fds:
+          self.fds[path] = os.open(path, os.O_RDONLY)
+        fd = self.fds[path]
+        size, image_chunks = read_sparse_chunks(fd, offset, path)
+        self.size = max(self.size, size)
+        chunks.extend(chunk + (fd,) for chunk in image_chunks)
+    except BaseException:
+      self.close()
+      raise
+
+    chunks.sort(key=lambda chunk: chunk[0])
+    for prev, chunk in zip(chunks, chunks[1:]):
+      if prev[0] + prev[1] > chunk[0]:
+        self.close()
+        raise LpError('Sparse images overlap at offset %d' % chunk[0])
+    self.chunks = chunks
+    self.starts = [chunk[0] for chunk in chunks]
+
+  def pieces(self, offset, size):
+    """Yield (offset, size, chunk) of the chunks that hold data in range"""
+    if offset + size > self.size:
+      raise LpError('%s is truncated' % self.path)
+    index = max(0, bisect.bisect_right(self.starts, offset) - 1)
+    end = offset + size
+    for chunk in self.chunks[index:]:
+      start, length = chunk[0], chunk[1]
+      if start >= end:
+        break
+      lo, hi = max(start, offset), min(start + length, end)
+      if lo < hi:
+        yield lo, hi - lo, chunk
+
+  def read(self, offset, size):
+    data = bytearray(size)
+    for lo, n, (start, _, kind, value, fd) in self.pieces(offset, size):
+      if kind == CHUNK_TYPE_RAW:
+        piece = os.pread(fd, n, value + lo - start)
+        if len(piece) != n:
+          raise LpError('%s is truncated' % self.path)
+      else:
+        piece = fill_pattern(value, lo - start, n)
+      data[lo - offset:lo - offset + n] = piece
+    return bytes(data)
+
+  def copy(self, offset, size, fd, out_offset):
+    for lo, n, (start, _, kind, value, in_fd) in self.pieces(offset, size):
+      if kind == CHUNK_TYPE_RAW:
+        copy_file_range(in_fd, value + lo - start, fd,
+                        out_offset + lo - offset, n)
+      else:
+        write_fill(fd, value, lo - start, n, out_offset + lo - offset)
+
+  def close(self):
+    for fd in self.fds.values():
+      os.close(fd)
+    self.fds = {}
+
+
+def read_sparse_chunks(fd, offset, path):
+  """Read the chunk headers of a sparse image
+
+  Returns:
+      tuple: image size in bytes, list of (start, size, chunk_type, value)
+          of the raw chunks (value is the data offset in the file) and the
+          non-zero fill chunks (value is the 4 bytes fill pattern). Zero fill
+          and don't care chunks read back as zeros and are left out.
+  """
+  file_hdr_sz, chunk_hdr_sz, blk_sz, total_blks, total_chunks = \
+      parse_sparse_header(os.pread(fd, SPARSE_HEADER.size, offset), path)
+
+  chunks = []
+  pos = 0
+  offset += file_hdr_sz
+  for _ in range(total_chunks):
+    header = os.pread(fd, SPARSE_CHUNK_HEADER.size, offset)
+    if len(header) != SPARSE_CHUNK_HEADER.size:
+      raise LpError('%s is truncated' % path)
+    chunk_type, _, chunk_sz, total_sz = SPARSE_CHUNK_HEADER.unpack(header)
+    data_offset = offset + chunk_hdr_sz
+    length = chunk_sz * blk_sz
+    if chunk_type == CHUNK_TYPE_RAW:
+      if total_sz - chunk_hdr_sz != length:
+        raise LpError('Bad raw chunk size in %s' % path)
+      chunks.append((pos, length, CHUNK_TYPE_RAW, data_offset))
+    elif chunk_type == CHUNK_TYPE_FILL:
+      fill = os.pread(fd, 4, data_offset)
+      if fill != bytes(4):
+        chunks.append((pos, length, CHUNK_TYPE_FILL, fill))
+    elif chunk_type not in (CHUNK_TYPE_DONT_CARE, CHUNK_TYPE_CRC32):
+      raise LpError('Unknown chunk type 0x%04X in %s' % (chunk_type, path))
+    pos += length
+    offset += total_sz
+
+  if pos != blk_sz * total_blks:
+    raise LpError('%s has %d blocks in its chunks, expected %d' % (
+      path, pos // blk_sz, total_blks))
+  return pos, chunks
+
+
+def parse_sparse_header(header, path):
+  """Returns (file_hdr_sz, chunk_hdr_sz, blk_sz, total_blks, total_chunks)"""
+  if len(header) != SPARSE_HEADER.size:
+    raise LpError('%s is truncated' % path)
+  (magic, major, _, file_hdr_sz, chunk_hdr_sz, blk_sz, total_blks,
+   total_chunks, _) = SPARSE_HEADER.unpack(header)
+  if magic != SPARSE_HEADER_MAGIC or major != 1:
+    raise LpError('%s is not a sparse image' % path)
+  if file_hdr_sz < SPARSE_HEADER.size or \
+      chunk_hdr_sz < SPARSE_CHUNK_HEADER.size:
+    raise LpError('Bad sparse header sizes in %s' % path)
+  return file_hdr_sz, chunk_hdr_sz, blk_sz, total_blks, total_chunks
+
+
+def open_source(path, offset=0):
+  """RawSource or SparseSource of the super image at offset of path"""
+  with open(path, 'rb') as f:
+    magic = os.pread(f.fileno(), 4, offset)
+  if magic == struct.pack('<I', SPARSE_HEADER_MAGIC):
+    return SparseSource([(path, offset)])
+  return RawSource(path, offset)
+
+
+class BufferSource:
+  """Super image data held in memory (eg: the head of a stream)"""
+
+  def __init__(self, data):
+    self.data = data
+
+  def read(self, offset, size):
+    if offset + size > len(self.data):
+      raise LpError('LP metadata is truncated')
+    return bytes(self.data[offset:offset + size])
+
+
+def fill_pattern(fill, skip, size):
+  """size bytes of a repeated 4 bytes pattern, starting skip bytes in"""
+  skip %= 4
+  return (fill * ((skip + size + 3) // 4))[skip:skip + size]
+
+
+def write_fill(fd, fill, skip, size, out_offset):
+  pattern = fill_pattern(fill, skip, min(size, COPY_SIZE))
+  while size > 0:
+    n = os.pwrite(fd, pattern[:size], out_offset)
+    # keep the pattern aligned for the next write
+    pattern = pattern[n % 4:] + pattern[:n % 4]
+    out_offset += n
+    size -= n
+
+
+def copy_file_range(fd_in, offset, fd_out, out_offset, size):
+  """Copy in the kernel, pread/pwrite where copy_file_range can't be used"""
+  if hasattr(os, 'copy_file_range'):
+    try:
+      while size > 0:
+        n = os.copy_file_range(fd_in, fd_out, size, offset, out_offset)
+        if n == 0:
+          raise LpError('Unexpected end of image')
+        offset += n
+        out_offset += n
+        size -= n
+      return
+    except OSError:
+      pass
+  while size > 0:
+    data = os.pread(fd_in, min(size, COPY_SIZE), offset)
+    if not data:
+      raise LpError('Unexpected end of image')
+    os.pwrite(fd_out, data, out_offset)
+    offset += len(data)
+    out_offset += len(data)
+    size -= len(data)
+
+
+def read_geometry(source):
+  """Read the primary geometry, or the backup one if it is corrupt"""
+  for offset in (LP_PARTITION_RESERVED_BYTES,
+                 LP_PARTITION_RESERVED_BYTES + LP_METADATA_GEOMETRY_SIZE):
+    data = source.read(offset, GEOMETRY.size)
+    (magic, struct_size, checksum, max_size, slot_count,
+     block_size) = GEOMETRY.unpack(data)
+    if magic != LP_METADATA_GEOMETRY_MAGIC or struct_size != GEOMETRY.size:
+      continue
+    data = data[:8] + bytes(32) + data[40:]
+    if hashlib.sha256(data).digest() != checksum:
+      continue
+    return Geometry(max_size, slot_count, block_size)
+  raise LpError('No valid LP metadata geometry')
+
+
+def metadata_end(source):
+  """End offset of the backup metadata, all the LP metadata is before it"""
+  geometry = read_geometry(source)
+  return LP_METADATA_START + \
+      2 * geometry.metadata_max_size * geometry.metadata_slot_count
+
+
+def read_metadata(source, slot=0):
+  """Read the partition table of a slot
+
+  Returns:
+      list: Partition entries of the primary metadata, or of the backup
+          metadata if the primary is corrupt.
+  """
+  geometry = read_geometry(source)
+  if slot >= geometry.metadata_slot_count:
+    raise LpError('Invalid metadata slot %d' % slot)
+
+  primary = LP_METADATA_START
+  backup = primary + geometry.metadata_max_size * geometry.metadata_slot_count
+  error = None
+  for base in (primary, backup):
+    try:
+      return parse_metadata(
+        source.read(base + geometry.metadata_max_size * slot,
+                    geometry.metadata_max_size))
+    except LpError as e:
+      error = error or e
+  raise error
+
+
+def parse_metadata(data):
+  """Parse the header and tables of one metadata copy"""
+  fields = HEADER.unpack_from(data)
+  magic, major, _, header_size, header_checksum, tables_size, \
+      tables_checksum = fields[:7]
+  partitions_desc, extents_desc = fields[7:10], fields[10:13]
+
+  if magic != LP_METADATA_HEADER_MAGIC:
+    raise LpError('Invalid LP metadata header magic')
+  if major != LP_METADATA_MAJOR_VERSION:
+    raise LpError('Unsupported LP metadata version %d' % major)
+  if header_size < HEADER.size or header_size + tables_size > len(data):
+    raise LpError('Invalid LP metadata header size')
+
+  header = bytearray(data[:header_size])
+  header[12:44] = bytes(32)
+  if hashlib.sha256(header).digest() != header_checksum:
+    raise LpError('LP metadata header checksum mismatch')
+  tables = data[header_size:header_size + tables_size]
+  if hashlib.sha256(tables).digest() != tables_checksum:
+    raise LpError('LP metadata tables checksum mismatch')
+
+  extents = []
+  for offset in table(tables, extents_desc, EXTENT):
+    num_sectors, target_type, target_data, target_source = \
+        EXTENT.unpack_from(tables, offset)
+    size = num_sectors * LP_SECTOR_SIZE
+    if target_type == LP_TARGET_TYPE_ZERO:
+      extents.append(Extent(None, size))
+    elif target_type == LP_TARGET_TYPE_LINEAR and target_source == 0:
+      extents.append(Extent(target_data * LP_SECTOR_SIZE, size))
+    else:
+      # retrofit devices map extents on other block devices
+      raise LpError('Unsupported extent (type %d, block device %d)' % (
+        target_type, target_source))
+
+  partitions = []
+  for offset in table(tables, partitions_desc, PARTITION):
+    name, attributes, first, count, _ = PARTITION.unpack_from(tables, offset)
+    if first + count > len(extents):
+      raise LpError('Invalid extent index')
+    partitions.append(Partition(name.rstrip(b'\0').decode('ascii'),
+                                attributes, extents[first:first + count]))
+  return partitions
+
+
+def table(tables, desc, entry):
+  """Yield the offsets of the entries of a metadata table"""
+  offset, count, entry_size = desc
+  if entry_size < entry.size or offset + count * entry_size > len(tables):
+    raise LpError('Invalid LP metadata table')
+  for index in range(count):
+    yield offset + index * entry_size
+
+
+def select(entries, partitions):
+  """Partitions of entries in the allow-list partitions (None for all)"""
+  if partitions is None:
+    return entries
+  partitions = set(partitions)
+  return [p for p in entries if p.name in partitions]
+
+
+def unpack_partition(source, partition, output):
+  """Write a partition to <output>/<name>.img, zero extents are left as holes"""
+  path = os.path.join(output, partition.name + '.img')
+  fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+  try:
+    out_offset = 0
+    for extent in partition.extents:
+      if extent.offset is not None:
+        source.copy(extent.offset, extent.size, fd, out_offset)
+      out_offset += extent.size
+    os.ftruncate(fd, out_offset)
+  finally:
+    os.close(fd)
+  return path
+
+
+def unpack(source, output, partitions=None, slot=0, jobs=1):
+  """Unpack the logical partitions of a super image
+
+  Args:
+      source: RawSource or SparseSource of the super image.
+      output (str): output directory.
+      partitions (iterable, optional): names to unpack, all by default.
+      slot (int, optional): metadata slot. Defaults to 0.
+      jobs (int, optional): partitions copied at once. Defaults to 1.
+
+  Returns:
+      list: paths of the unpacked images.
+  """
+  entries = select(read_metadata(source, slot), partitions)
+  if not os.path.isdir(output):
+    os.makedirs(output)
+
+  # largest first, so the copies end at about the same time
+  entries.sort(key=lambda p: -sum(e.size for e in p.extents))
+  with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+    return list(pool.map(lambda p: unpack_partition(source, p, output),
+                         entries))
+
+
+class SuperWriter:
+  """Write-only super image that routes the data to the partition images
+
+  Takes the data of a super image decoded as a stream, with pwrite() at
+  any offset and zero() for ranges that read back as zeros. The data is
+  buffered until the LP metadata at the head of the image is complete,
+  which needs the data to come in order up to there, or the head passed
+  in (eg: read with a first pass over the stream). From then on every
+  write is copied to the partitions it lands in and the rest is dropped.
+
+  Args:
+      output (str): output directory.
+      partitions (iterable, optional): names to unpack, all by default.
+      slot (int, optional): metadata slot. Defaults to 0.
+      head (bytes, optional): the image up to metadata_end().
+  """
+
+  def __init__(self, output, partitions=None, slot=0, head=None):
+    self.output = output
+    self.partitions = partitions
+    self.slot = slot
+    self.paths = None
+    self._head = bytearray()
+    self._fds = []
+    self._extents = []
+    self._starts = []
+    self._end = 0
+    if head is not None:
+      self._open(bytes(head))
+
+  def _open(self, head):
+    entries = select(read_metadata(BufferSource(head), self.slot),
+                     self.partitions)
+    if not os.path.isdir(self.output):
+      os.makedirs(self.output)
+    self.paths = []
+    for partition in entries:
+      path = os.path.join(self.output, partition.name + '.img')
+      fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+      self._fds.append(fd)
+      self.paths.append(path)
+      out_offset = 0
+      for extent in partition.extents:
+        if extent.offset is not None:
+          self._extents.append((extent.offset, extent.size, fd, out_offset))
+        out_offset += extent.size
+      os.ftruncate(fd, out_offset)
+    self._extents.sort()
+    self._starts = [extent[0] for extent in self._extents]
+
+  def _head_done(self):
+    """Open the partitions once the buffered head holds all the metadata"""
+    if len(self._head) < LP_METADATA_START:
+      return
+    end = metadata_end(BufferSource(self._head))
+    if len(self._head) < end:
+      return
+    head, self._head = self._head, None
+    self._open(bytes(head[:end]))
+    self._route(memoryview(head)[end:], end)
+
+  def _skip_to(self, offset):
+    """The head bytes before offset that were not written are zeros
+
+    The head is padded up to the end of the metadata at most, so a write
+    far into the image does not grow the buffer.
+    """
+    while self.paths is None and len(self._head) < offset:
+      if len(self._head) < LP_METADATA_START:
+        limit = LP_METADATA_START
+      else:
+        limit = metadata_end(BufferSource(self._head))
+      self._head.extend(bytes(min(offset, limit) - len(self._head)))
+      self._head_done()
+
+  def pwrite(self, data, offset):
+    """Write data at offset of the super image"""
+    if self.paths is None:
+      self._skip_to(offset)
+    if self.paths is None:
+      end = offset + len(data)
+      if len(self._head) < end:
+        self._head.extend(bytes(end - len(self._head)))
+      self._head[offset:end] = data
+      self._head_done()
+    else:
+      self._route(memoryview(data), offset)
+    return len(data)
+
+  def zero(self, offset, size):
+    """Make size bytes at offset of the super image read back as zeros"""
+    if self.paths is None:
+      end = min(offset + size, len(self._head))
+      if offset < end:
+        self._head[offset:end] = bytes(end - offset)
+      return
+    # the partition images start as holes, only data written before is zeroed
+    zeros = bytes(min(size, COPY_SIZE))
+    size = min(offset + size, self._end) - offset
+    while size > 0:
+      n = min(size, len(zeros))
+      self._route(memoryview(zeros)[:n], offset)
+      offset += n
+      size -= n
+
+  def _route(self, data, offset):
+    end = offset + len(data)
+    self._end = max(self._end, end)
+    index = max(0, bisect.bisect_right(self._starts, offset) - 1)
+    for start, size, fd, out_offset in self._extents[index:]:
+      if start >= end:
+        break
+      lo, hi = max(start, offset), min(start + size, end)
+      if lo >= hi:
+        continue
+      piece = data[lo - offset:hi - offset]
+      pos = out_offset + lo - start
+      while piece:
+        n = os.pwrite(fd, piece, pos)
+        piece = piece[n:]
+        pos += n
+
+  def close(self):
+    """Finish the partition images
+
+    Returns:
+        list: paths of the unpacked images.
+    """
+    try:
+      if self.paths is None:
+        # the image ended inside the metadata area
+        head, self._head = self._head, None
+        self._open(bytes(head))
+    finally:
+      self._close_fds()
+    return self.paths
+
+  def _close_fds(self):
+    for fd in self._fds:
+      os.close(fd)
+    self._fds = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, *_):
+    if exc_type is None:
+      self.close()
+    else:
+      self._close_fds()
+
+
+def write_stream(f, writer, chunk_size=COPY_SIZE):
+  """Write the stream f of a super image to a SuperWriter in order"""
+  buf = bytearray(chunk_size)
+  view = memoryview(buf)
+  pos = 0
+  while True:
+    n = f.readinto(view)
+    if not n:
+      return pos
+    writer.pwrite(view[:n], pos)
+    pos += n
+
+
+def write_sparse_stream(f, writer, chunk_size=COPY_SIZE):
+  """Write a sparse image read in order from the stream f to a SuperWriter
+
+  Several sparse chunks of one super image can be written one after the
+  other, the ranges left out of a chunk are not touched.
+  """
+  name = getattr(f, 'name', 'sparse stream')
+  file_hdr_sz, chunk_hdr_sz, blk_sz, total_blks, total_chunks = \
+      parse_sparse_header(read_exact(f, SPARSE_HEADER.size, name), name)
+  read_exact(f, file_hdr_sz - SPARSE_HEADER.size, name)
+
+  view = memoryview(bytearray(chunk_size))
+  pos = 0
+  for _ in range(total_chunks):
+    chunk_type, _, chunk_sz, total_sz = SPARSE_CHUNK_HEADER.unpack_from(
+      read_exact(f, chunk_hdr_sz, name))
+    length = chunk_sz * blk_sz
+    data_sz = total_sz - chunk_hdr_sz
+    if chunk_type == CHUNK_TYPE_RAW:
+      if data_sz != length:
+        raise LpError('Bad raw chunk size in %s' % name)
+      done = 0
+      while done < length:
+        n = f.readinto(view[:min(length - done, len(view))])
+        if not n:
+          raise LpError('%s is truncated' % name)
+        writer.pwrite(view[:n], pos + done)
+        done += n
+    elif chunk_type == CHUNK_TYPE_FILL:
+      fill = read_exact(f, 4, name)
+      read_exact(f, data_sz - 4, name)
+      if fill == bytes(4):
+        writer.zero(pos, length)
+      else:
+        for done in range(0, length, chunk_size):
+          writer.pwrite(fill_pattern(fill, 0, min(chunk_size, length - done)),
+                        pos + done)
+    elif chunk_type in (CHUNK_TYPE_DONT_CARE, CHUNK_TYPE_CRC32):
+      read_exact(f, data_sz, name)
+    else:
+      raise LpError('Unknown chunk type 0x%04X in %s' % (chunk_type, name))
+    pos += length
+
+  if pos != blk_sz * total_blks:
+    raise LpError('%s has %d blocks in its chunks, expected %d' % (
+      name, pos // blk_sz, total_blks))
+
+
+def read_exact(f, size, name):
+  data = f.read(size)
+  if len(data) != size:
+    raise LpError('%s is truncated' % name)
+  return data
+
+
+def main(super_img, output, partitions=None, slot=0, jobs=1, offset=0):
+  """Unpack super_img, or the list of sparse chunks of a super image"""
+  if isinstance(super_img, str):
+    source = open_source(super_img, offset)
+  else:
+    source = SparseSource([(path, offset) for path in super_img])
+  try:
+    return unpack(source, output, partitions, slot, jobs)
+  finally:
+    source.close()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('super_img', nargs='+',
+                      help='raw or sparse super image, or its sparse chunks in order')
+  parser.add_argument('output', help='output directory')
+  parser.add_argument('-p', '--partition', action='append', dest='partitions',
+                      help='unpack only this partition (can be repeated)')
+  parser.add_argument('-S', '--slot', type=int, default=0,
+                      help='metadata slot (default=0)')
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+                      help='partitions copied at once (default=1)')
+  args = parser.parse_args()
+
+  try:
+    super_img = args.super_img
+    if len(super_img) == 1:
+      super_img = super_img[0]
+    for path in main(super_img, args.output, args.partitions,
+                     args.slot, args.jobs):
+      print(path)
+  except LpError as e:
+    print('lpunpack: %s' % e, file=sys.stderr)
+    sys.exit(1)
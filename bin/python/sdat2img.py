@@ -3,9 +3,28 @@
 # File Name    :   sdat2img.py
 
 import argparse
+import contextlib
+import ctypes
+import ctypes.util
+import io
 import os
+import shutil
+import subprocess
+import threading
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
 
 BLOCK_SIZE = 4096
+# size of the buffer used to copy `new` ranges from the data stream
+COPY_SIZE = 4 << 20
+# compressed bytes fed to the brotli decompressor at a time
+BROTLI_READ_SIZE = 64 << 10
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
 
 
 def range_set(src):
@@ -38,7 +57,188 @@ def transfer_list_file_to_commands(trans_list):
   return commands
 
 
-def main(transfer_list_file, new_dat_file, output_filename):
+class BrotliReader(io.RawIOBase):
+  """Raw stream of the data decompressed from a brotli file."""
+
+  def __init__(self, file):
+    self.file = file
+    self.decompressor = brotli.Decompressor()
+    self.pending = memoryview(b'')
+
+  def readable(self):
+    return True
+
+  def readinto(self, b):
+    while not self.pending:
+      data = self.file.read(BROTLI_READ_SIZE)
+      if not data:
+        return 0
+      self.pending = memoryview(self.decompressor.process(data))
+    n = min(len(b), len(self.pending))
+    b[:n] = self.pending[:n]
+    self.pending = self.pending[n:]
+    return n
+
+
+@contextlib.contextmanager
+def open_new_dat(new_dat, brotli_bin='brotli'):
+  """Open a .new.dat or .new.dat.br file as a stream of the new data.
+
+  A .br file is decompressed on the fly with the brotli module, or through
+  a pipe from the brotli binary when the module is not installed, so the
+  uncompressed .new.dat is never written to disk. new_dat may also be a
+  readable binary stream of .new.dat.br data (e.g. a zip member).
+  """
+  is_path = isinstance(new_dat, str)
+  if is_path and not new_dat.endswith('.br'):
+    with open(new_dat, 'rb') as f:
+      yield f
+  elif brotli is not None:
+    with contextlib.ExitStack() as stack:
+      f = stack.enter_context(open(new_dat, 'rb')) if is_path else new_dat
+      yield BrotliReader(f)
+  else:
+    proc = subprocess.Popen([brotli_bin, '-dc'] + ([new_dat] if is_path else []),
+                            stdin=None if is_path else subprocess.PIPE,
+                            stdout=subprocess.PIPE, bufsize=0)
+    feeder = None
+    if not is_path:
+      feeder = threading.Thread(target=_feed_pipe, args=(new_dat, proc.stdin))
+      feeder.start()
+    try:
+      yield proc.stdout
+    finally:
+      proc.stdout.close()
+      if feeder is not None:
+        feeder.join()
+      if proc.wait() not in (0, -13):  # SIGPIPE if we stopped reading early
+        raise RuntimeError(
+          '{} failed to decompress {}'.format(brotli_bin, new_dat))
+
+
+def _feed_pipe(src, pipe):
+  """Copy src into pipe until EOF or until the reader goes away."""
+  try:
+    shutil.copyfileobj(src, pipe, BROTLI_READ_SIZE)
+  except BrokenPipeError:
+    pass
+  finally:
+    try:
+      pipe.close()
+    except BrokenPipeError:
+      pass
+
+
+def _libc_fallocate():
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    func = libc.fallocate64
+  except (OSError, AttributeError):
+    return None
+  func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+  return func
+
+
+_fallocate = _libc_fallocate()
+
+
+def punch_hole(fd, offset, length):
+  """Make [offset, offset + length) of fd read back as zeros.
+
+  Deallocates the blocks with fallocate(PUNCH_HOLE) and falls back to
+  writing zeros where that is not supported.
+  """
+  if _fallocate is not None and _fallocate(
+      fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) == 0:
+    return
+
+  zero_buf = bytes(min(length, COPY_SIZE))
+  while length > 0:
+    written = os.pwrite(fd, zero_buf[:length], offset)
+    offset += written
+    length -= written
+
+
+class ImageFile(object):
+  """Output image of apply_commands(), an open file descriptor."""
+
+  def __init__(self, fd):
+    self.fd = fd
+    # blocks past the end of what was written so far are already holes
+    self.size = 0
+
+  def pwrite(self, data, offset):
+    written = 0
+    while written < len(data):
+      written += os.pwrite(self.fd, data[written:], offset + written)
+    self.size = max(self.size, offset + written)
+    return written
+
+  def zero(self, offset, length):
+    end = min(offset + length, self.size)
+    if offset < end:
+      punch_hole(self.fd, offset, end - offset)
+
+
+def copy_range(new_dat_file, out, offset, length, view):
+  """Copy length bytes of new_dat_file to out at offset through view."""
+  while length > 0:
+    n = new_dat_file.readinto(view[:min(length, len(view))])
+    if not n:
+      raise ValueError('Unexpected end of new data')
+    out.pwrite(view[:n], offset)
+    offset += n
+    length -= n
+
+
+def apply_commands(commands, new_dat_file, out, copy_size=COPY_SIZE):
+  """Write the image of a full transfer list to out.
+
+  out takes the data with pwrite(data, offset) and the erased or zeroed
+  ranges with zero(offset, length), like ImageFile.
+  """
+  view = memoryview(bytearray(copy_size))
+  for command in commands:
+    block_count = sum(end - begin for begin, end in command[1])
+    if command[0] == 'new':
+      print('Copying {} blocks in {} ranges...'.format(
+        block_count, len(command[1])))
+      for begin, end in command[1]:
+        copy_range(new_dat_file, out, begin * BLOCK_SIZE,
+                   (end - begin) * BLOCK_SIZE, view)
+    else:
+      print('Zeroing {} blocks for command {}'.format(
+        block_count, command[0]))
+      for begin, end in command[1]:
+        out.zero(begin * BLOCK_SIZE, (end - begin) * BLOCK_SIZE)
+
+
+def read_head(commands, new_dat_file, size, copy_size=COPY_SIZE):
+  """Read the first size bytes of the image of a full transfer list.
+
+  Reads new_dat_file only up to the last new range below size, the data
+  of earlier ranges past size is read and dropped.
+  """
+  head = bytearray(size)
+  ranges = [(begin * BLOCK_SIZE, end * BLOCK_SIZE)
+            for cmd, block_set in commands if cmd == 'new'
+            for begin, end in block_set]
+  needed = [i for i, (begin, _) in enumerate(ranges) if begin < size]
+  view = memoryview(bytearray(copy_size))
+  for begin, end in ranges[:needed[-1] + 1] if needed else ():
+    while begin < end:
+      n = new_dat_file.readinto(view[:min(end - begin, len(view))])
+      if not n:
+        raise ValueError('Unexpected end of new data')
+      if begin < size:
+        keep = min(n, size - begin)
+        head[begin:begin + keep] = view[:keep]
+      begin += n
+  return head
+
+
+def main(transfer_list_file, new_dat_file, output_filename,
+         copy_size=COPY_SIZE):
   commands = transfer_list_file_to_commands(transfer_list_file)
 
   if os.path.exists(output_filename):
@@ -50,33 +250,24 @@ def main(transfer_list_file, new_dat_file, output_filename):
     all_block_sets = [i for command in commands for i in command[1]]
     max_file_size = max(pair[1] for pair in all_block_sets) * BLOCK_SIZE
 
-    for command in commands:
-      if command[0] == 'new':
-        for block in command[1]:
-          begin = block[0]
-          end = block[1]
-          block_count = end - begin
-          print('Copying {} blocks to position {}...'.format(
-            block_count, begin))
-          output_img.seek(begin * BLOCK_SIZE)
-          while block_count > 0:
-            output_img.write(new_dat_file.read(BLOCK_SIZE))
-            block_count -= 1
-      else:
-        print('Skipping command {}'.format(command[0]))
+    out = ImageFile(output_img.fileno())
+    apply_commands(commands, new_dat_file, out, copy_size)
 
     # Make file larger if necessary
-    if (output_img.tell() < max_file_size):
+    if out.size < max_file_size:
       output_img.truncate(max_file_size)
 
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser()
   parser.add_argument('transfer_list', help='transfer list file')
-  parser.add_argument('new_dat', help='system new dat file')
+  parser.add_argument('new_dat', help='system new dat file (or .new.dat.br)')
   parser.add_argument('output', default='output.img',
                       help='output image')
+  parser.add_argument('--brotli', default='brotli',
+                      help='brotli binary used for .br input when the brotli '
+                      'python module is not installed')
   args = parser.parse_args()
   with open(args.transfer_list, 'r') as transfer_list_file:
-    with open(args.new_dat, 'rb') as new_dat_file:
+    with open_new_dat(args.new_dat, args.brotli) as new_dat_file:
       main(transfer_list_file, new_dat_file, args.output)
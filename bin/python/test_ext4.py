@@ -0,0 +1,278 @@
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+
+import pytest
+
+import ext4
+
+MKE2FS = shutil.which('mke2fs')
+E2FSCK = shutil.which('e2fsck')
+
+needs_mke2fs = pytest.mark.skipif(MKE2FS is None, reason='needs mke2fs')
+needs_e2fsck = pytest.mark.skipif(MKE2FS is None or E2FSCK is None, reason='needs mke2fs and e2fsck')
+
+
+def _write_tree(root):
+  """A small tree: plain, empty, multi block and sparse files, a directory of small files and a symlink"""
+  os.makedirs(os.path.join(root, 'etc', 'init'))
+  with open(os.path.join(root, 'etc', 'hosts'), 'w') as f:
+    f.write('127.0.0.1 localhost\n')
+  open(os.path.join(root, 'etc', 'empty'), 'w').close()
+  with open(os.path.join(root, 'etc', 'init', 'rand.bin'), 'wb') as f:
+    f.write(os.urandom(300000))
+  # data, a hole and data again, then a hole up to the end
+  with open(os.path.join(root, 'etc', 'sparse.bin'), 'wb') as f:
+    f.write(os.urandom(5000))
+    f.seek(1 << 20)
+    f.write(os.urandom(5000))
+    f.truncate(2 << 20)
+  os.makedirs(os.path.join(root, 'app'))
+  for i in range(100):
+    with open(os.path.join(root, 'app', 'file_%d' % i), 'w') as f:
+      f.write('%d\n' % i)
+  os.symlink('etc/hosts', os.path.join(root, 'hosts'))
+
+
+def _make_image(tmp, tree, block_size=4096, size='16M'):
+  image = os.path.join(tmp, 'system.img')
+  subprocess.run([MKE2FS, '-q', '-F', '-t', 'ext4', '-b', str(block_size), '-d', tree,
+                  image, size], check=True, stdout=subprocess.DEVNULL)
+  return image
+
+
+def _make_htree_image(tmp, names, block_size=4096):
+  """Image with the empty files names in /big, indexed by e2fsck -D (mke2fs -d writes linear directories)"""
+  tree = os.path.join(tmp, 'tree')
+  os.makedirs(os.path.join(tree, 'big'))
+  for name in names:
+    open(os.path.join(tree, 'big', name), 'w').close()
+  image = _make_image(tmp, tree, block_size, '8M')
+  result = subprocess.run([E2FSCK, '-fyD', image], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  # 1: the file system was modified
+  assert result.returncode in (0, 1)
+  return image
+
+
+@needs_mke2fs
+def test_close_with_live_inode():
+  with tempfile.TemporaryDirectory() as tmp:
+    tree = os.path.join(tmp, 'tree')
+    _write_tree(tree)
+    image = _make_image(tmp, tree)
+
+    with open(image, 'rb') as f:
+      volume = ext4.Volume(f, use_mmap=True)
+      mapping = volume.mmap
+      root = volume.root
+      assert root.lookup('etc')[1] is not None
+
+      volume.close()
+      assert volume.mmap is None
+      volume.close()
+
+      # the mapping is released once the last structure parsed in place is gone
+      del root
+      mapping.close()
+
+
+@needs_mke2fs
+def test_close_keeps_exception():
+  with tempfile.TemporaryDirectory() as tmp:
+    tree = os.path.join(tmp, 'tree')
+    _write_tree(tree)
+    image = _make_image(tmp, tree)
+
+    with open(image, 'rb') as f:
+      with pytest.raises(KeyError):
+        with ext4.Volume(f, use_mmap=True) as volume:
+          root = volume.root
+          raise KeyError(root.inode_idx)
+      assert volume.mmap is None
+
+
+@needs_e2fsck
+def test_htree_collision_across_dx_nodes():
+  # long names on 1k blocks give a two level hash tree with few files
+  names = ['n' * 200 + '%04d' % i for i in range(800)]
+  with tempfile.TemporaryDirectory() as tmp:
+    image = _make_htree_image(tmp, names, block_size=1024)
+
+    with open(image, 'rb') as f:
+      big = ext4.Volume(f).root.get_inode('big')
+      reader = big.open_read()
+      root_block, info, entries = big._dx_root(reader)
+      assert info.indirect_levels == 1 and len(entries) == 2
+      node_hash, node_block = entries[1]
+      first_leaf = big._dx_entries(big._read_dir_block(reader, node_block), 0x8)[0][1]
+      first_name = next(big._parse_dirents(big._read_dir_block(reader, first_leaf))).name
+
+    # mark the second dx_node as continuing the hash chain of the first one, so the lookup of its first name
+    # starts in the last leaf of the first dx_node
+    with open(image, 'r+b') as f:
+      offset = f.read().find(bytes(root_block))
+      f.seek(offset + 0x18 + info.info_length + 8)
+      f.write(struct.pack('<I', node_hash | 1))
+
+    with open(image, 'rb') as f:
+      big = ext4.Volume(f).root.get_inode('big')
+      assert big._dx_root(big.open_read())[2][1] == (node_hash | 1, node_block)
+      assert big.lookup(first_name)[0] == first_name
+      for name in names:
+        assert big.lookup(name)[0] == name
+
+
+SEED = (0x1e9c2a3f, 0x214d447b, 0xb2a10f9e, 0xf6e5d4c3)  # s_hash_seed of UUID 3f2a9c1e-7b44-4d21-9e0f-a1b2c3d4e5f6
+HASH_NAMES = [b'hello', b'caf\xc3\xa9_\xff', b'a_rather_long_file_name_of_more_than_32_bytes.txt']
+
+
+# (hash_version, [(hash, minor_hash) of HASH_NAMES without seed, with SEED]), from debugfs dx_hash
+@pytest.mark.parametrize('hash_version, expected', [
+  (ext4.DxHash.LEGACY, [
+    ((0x32252546, 0), (0x32252546, 0)),
+    ((0x4f86d7c4, 0), (0x4f86d7c4, 0)),
+    ((0x3e812994, 0), (0x3e812994, 0))]),
+  (ext4.DxHash.HALF_MD4, [
+    ((0x1746da32, 0x420013b5), (0xb9364926, 0xc0978648)),
+    ((0x30ff7e0c, 0x23244ee2), (0x8bda7cc8, 0xc55df7da)),
+    ((0x75777db0, 0x902ab502), (0x8605f428, 0x7ede9c15))]),
+  (ext4.DxHash.TEA, [
+    ((0x6f5bb1a8, 0x231917c2), (0xd8f88cb0, 0xc2983934)),
+    ((0xf1940044, 0xa7bd64b0), (0xd1f578ce, 0xf7b30a96)),
+    ((0x606512e6, 0xb0a6bc29), (0x4eabb832, 0x9f6df98f))]),
+  (ext4.DxHash.LEGACY_UNSIGNED, [
+    ((0x32252546, 0), (0x32252546, 0)),
+    ((0x6f76bb9c, 0), (0x6f76bb9c, 0)),
+    ((0x3e812994, 0), (0x3e812994, 0))]),
+  (ext4.DxHash.HALF_MD4_UNSIGNED, [
+    ((0x1746da32, 0x420013b5), (0xb9364926, 0xc0978648)),
+    ((0xea10bc34, 0xcd4b6099), (0xf5ec7992, 0x4912c7be)),
+    ((0x75777db0, 0x902ab502), (0x8605f428, 0x7ede9c15))]),
+  (ext4.DxHash.TEA_UNSIGNED, [
+    ((0x6f5bb1a8, 0x231917c2), (0xd8f88cb0, 0xc2983934)),
+    ((0x465b268a, 0x34ac99e9), (0x936f1154, 0xb1a38062)),
+    ((0x606512e6, 0xb0a6bc29), (0x4eabb832, 0x9f6df98f))]),
+])
+def test_dx_hash(hash_version, expected):
+  for name, (unseeded, seeded) in zip(HASH_NAMES, expected):
+    assert ext4.dx_hash(name, hash_version) == unseeded
+    assert ext4.dx_hash(name, hash_version, SEED) == seeded
+
+
+@needs_e2fsck
+def test_htree_lookup():
+  names = ['file_%d' % i for i in range(1500)]
+  with tempfile.TemporaryDirectory() as tmp:
+    image = _make_htree_image(tmp, names)
+
+    with open(image, 'rb') as f:
+      big = ext4.Volume(f).root.get_inode('big')
+      assert big.is_htree
+      for name in names:
+        _, inode_idx, file_type = big.lookup(name)
+        assert inode_idx is not None and file_type == ext4.InodeType.FILE
+        assert big.lookup(name.encode())[:2] == (name.encode(), inode_idx)
+
+      # a miss is answered by the index alone
+      big._scan_dir = big.open_dir = None
+      assert big.lookup('file_1500') == (None, None, None)
+      assert big.lookup(b'missing') == (None, None, None)
+
+
+@needs_mke2fs
+def test_lookup_bytes_linear_dir():
+  with tempfile.TemporaryDirectory() as tmp:
+    tree = os.path.join(tmp, 'tree')
+    _write_tree(tree)
+    image = _make_image(tmp, tree)
+
+    with open(image, 'rb') as f:
+      init = ext4.Volume(f).root.get_inode('etc', 'init')
+      assert not init.is_htree
+      _, inode_idx, _ = init.lookup('rand.bin')
+      assert inode_idx is not None
+      assert init.lookup(b'rand.bin') == (b'rand.bin', inode_idx, ext4.InodeType.FILE)
+      assert init.lookup(b'missing') == (None, None, None)
+
+
+def test_lru_cache():
+  cache = ext4.LRUCache(2)
+  cache.put(1, 'a')
+  cache.put(2, 'b')
+  assert cache.get(1) == 'a'
+  # 2 is the least recently used entry
+  cache.put(3, 'c')
+  assert 2 not in cache and 1 in cache and 3 in cache
+  assert cache.get(2) is None
+  assert cache.get(2, 'default') == 'default'
+  assert (cache.hits, cache.misses) == (1, 2)
+  cache.put(1, 'A')
+  assert len(cache) == 2 and cache.get(1) == 'A'
+
+  cache.clear()
+  assert (len(cache), cache.hits, cache.misses) == (0, 0, 0)
+
+  disabled = ext4.LRUCache(0)
+  disabled.put(1, 'a')
+  assert len(disabled) == 0 and disabled.get(1) is None
+
+
+def _walk(inode, path=''):
+  """Yields (path, inode) of every entry below inode"""
+  for name, inode_idx, file_type in inode.open_dir():
+    if name in ('.', '..', 'lost+found'):
+      continue
+    entry = inode.volume.get_inode(inode_idx, file_type)
+    yield path + '/' + name, entry
+    if entry.is_dir:
+      yield from _walk(entry, path + '/' + name)
+
+
+@needs_mke2fs
+def test_inode_readahead():
+  with tempfile.TemporaryDirectory() as tmp:
+    tree = os.path.join(tmp, 'tree')
+    _write_tree(tree)
+    image = _make_image(tmp, tree)
+
+    with open(image, 'rb') as f:
+      plain = ext4.Volume(f, cache_size=0)
+      expected = {path: bytes(entry.inode) for path, entry in _walk(plain.root)}
+
+      volume = ext4.Volume(f, inode_readahead_blks=4)
+      volume.get_inode(ext4.Volume.ROOT_INODE)
+      # one miss caches the inodes of the blocks read ahead
+      assert volume.inode_cache.misses == 1
+      assert len(volume.inode_cache) > 1
+      assert {path: bytes(entry.inode) for path, entry in _walk(volume.root)} == expected
+      assert volume.inode_cache.hits > volume.inode_cache.misses
+
+
+@needs_mke2fs
+@pytest.mark.parametrize('use_mmap', [False, True])
+def test_read_files(use_mmap):
+  with tempfile.TemporaryDirectory() as tmp:
+    tree = os.path.join(tmp, 'tree')
+    _write_tree(tree)
+    image = _make_image(tmp, tree)
+
+    with open(image, 'rb') as f, ext4.Volume(f, use_mmap=use_mmap) as volume:
+      for path, entry in _walk(volume.root):
+        if not entry.is_file:
+          continue
+        with open(tree + path, 'rb') as src:
+          data = src.read()
+        assert bytes(entry.open_read().read()) == data, path
+
+        # readinto in odd sized pieces
+        reader = entry.open_read()
+        buf = bytearray(len(data) + 10)
+        done = 0
+        while True:
+          n = reader.readinto(memoryview(buf)[done:done + 12345])
+          if not n:
+            break
+          done += n
+        assert done == len(data) and buf[:done] == data, path
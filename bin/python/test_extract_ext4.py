@@ -0,0 +1,86 @@
+import os
+import tempfile
+
+import pytest
+
+import extract_ext4
+from test_ext4 import _make_image, _write_tree, needs_mke2fs
+
+
+def _check_tree(tree, out_dir):
+  """out_dir holds the same directories, file data and symlinks as tree"""
+  for root, dirs, files in os.walk(tree):
+    out_root = os.path.join(out_dir, os.path.relpath(root, tree))
+    assert sorted(d for d in os.listdir(out_root) if d != 'lost+found') == sorted(dirs + files)
+    for name in files:
+      path, out_path = os.path.join(root, name), os.path.join(out_root, name)
+      if os.path.islink(path):
+        assert os.readlink(out_path) == os.readlink(path), path
+        continue
+      with open(path, 'rb') as f, open(out_path, 'rb') as out:
+        assert out.read() == f.read(), path
+
+
+def _extract(tmp, image, **kwargs):
+  out_dir = os.path.join(tmp, 'out')
+  os.makedirs(out_dir)
+  extract = extract_ext4.ExtractExt4(image, out_dir, **kwargs)
+  extract.extract_ext4()
+  return extract, out_dir
+
+
+@needs_mke2fs
+@pytest.mark.parametrize('jobs, use_mmap', [(1, False), (2, False), (1, True), (2, True)])
+def test_extract(jobs, use_mmap):
+  with tempfile.TemporaryDirectory() as tmp:
+    tree = os.path.join(tmp, 'tree')
+    _write_tree(tree)
+    image = _make_image(tmp, tree)
+
+    # small chunks, so files take several copy requests
+    extract, out_dir = _extract(tmp, image, chunk_size=65536, jobs=jobs, use_mmap=use_mmap)
+    _check_tree(tree, out_dir)
+    assert (extract.num_dirs, extract.num_files, extract.num_links) == (3, 104, 1)
+    # sparse.bin ends in a hole, its size comes from truncating the file
+    assert os.path.getsize(os.path.join(out_dir, 'etc', 'sparse.bin')) == 2 << 20
+
+
+@needs_mke2fs
+@pytest.mark.parametrize('copy_file_range, sendfile', [(True, False), (False, True), (False, False)])
+def test_extract_copy_paths(monkeypatch, copy_file_range, sendfile):
+  monkeypatch.setattr(extract_ext4, '_use_copy_file_range',
+                      copy_file_range and extract_ext4._use_copy_file_range)
+  monkeypatch.setattr(extract_ext4, '_use_sendfile', sendfile and extract_ext4._use_sendfile)
+  with tempfile.TemporaryDirectory() as tmp:
+    tree = os.path.join(tmp, 'tree')
+    _write_tree(tree)
+    image = _make_image(tmp, tree)
+
+    _, out_dir = _extract(tmp, image, chunk_size=65536)
+    _check_tree(tree, out_dir)
+
+
+@needs_mke2fs
+def test_extract_info():
+  with tempfile.TemporaryDirectory() as tmp:
+    tree = os.path.join(tmp, 'tree')
+    _write_tree(tree)
+    image = _make_image(tmp, tree)
+    info_dir = os.path.join(tmp, 'info')
+    os.makedirs(info_dir)
+
+    _extract(tmp, image, jobs=2, info_dir=info_dir)
+    with open(os.path.join(info_dir, 'system_filesystem_config.txt')) as f:
+      config = f.read().splitlines()
+    with open(os.path.join(info_dir, 'system_file_contexts.txt')) as f:
+      contexts = f.read().splitlines()
+    with open(os.path.join(info_dir, 'system_filesystem_features.txt')) as f:
+      features = f.read()
+
+    uid, gid = os.getuid(), os.getgid()
+    assert f'etc/init/rand.bin {uid} {gid} 0644' in config
+    assert f'etc/init {uid} {gid} 0755' in config
+    assert f'hosts {uid} {gid} 0777 etc/hosts' in config
+    assert len([line for line in config if line.startswith('app/file_')]) == 100
+    assert any(line.startswith(r'/etc/init/rand\.bin ') for line in contexts)
+    assert 'Block size:                4096' in features
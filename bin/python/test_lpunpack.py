@@ -0,0 +1,235 @@
+import hashlib
+import io
+import os
+import random
+import struct
+import tempfile
+
+import pytest
+
+import lpunpack
+
+SECTOR = 512
+BLOCK_SIZE = 4096
+SUPER_SIZE = 8 << 20
+MAX_SIZE = 65536
+SLOTS = 3
+METADATA_BASE = 12288
+# name, extents as (target type, sectors, physical sector or None)
+PARTITIONS = [
+  ('system_a', [(0, 2048, 2048), (1, 1024, None), (0, 512, 8192)]),
+  ('vendor_a', [(0, 4096, 8704)]),
+  ('product_a', [(0, 100, 13000)]),
+  ('system_b', []),
+]
+# blocks after the last extent, left out of the sparse image
+DONT_CARE_START = 1640
+
+
+def _geometry():
+  geometry = struct.pack('<II32sIII', 0x616c4467, 52, bytes(32), MAX_SIZE,
+                         SLOTS, BLOCK_SIZE)
+  return struct.pack('<II32sIII', 0x616c4467, 52,
+                     hashlib.sha256(geometry).digest(), MAX_SIZE, SLOTS,
+                     BLOCK_SIZE)
+
+
+def _metadata():
+  partitions = b''
+  extents = b''
+  index = 0
+  for name, partition_extents in PARTITIONS:
+    partitions += struct.pack('<36sIIII', name.encode(), 1, index,
+                              len(partition_extents), 0)
+    for target_type, sectors, physical in partition_extents:
+      extents += struct.pack('<QIQI', sectors, target_type, physical or 0, 0)
+      index += 1
+  groups = struct.pack('<36sIQ', b'default', 0, 0)
+  block_devices = struct.pack('<QIIQ36sI', 2048, 0, 0, SUPER_SIZE, b'super', 0)
+  tables = partitions + extents + groups + block_devices
+  descs = [(0, len(PARTITIONS), 52), (len(partitions), index, 24),
+           (len(partitions) + len(extents), 1, 48),
+           (len(partitions) + len(extents) + len(groups), 1, 64)]
+
+  def header(checksum):
+    data = struct.pack('<IHHI32sI32s', 0x414c5030, 10, 2, 256, checksum,
+                       len(tables), hashlib.sha256(tables).digest())
+    for desc in descs:
+      data += struct.pack('<III', *desc)
+    return data.ljust(256, b'\0')
+
+  return header(hashlib.sha256(header(bytes(32))).digest()) + tables
+
+
+def _super_image():
+  """Super image laid out like liblp writes it, random data elsewhere"""
+  data = bytearray(random.Random(23).randbytes(SUPER_SIZE))
+  geometry = _geometry().ljust(BLOCK_SIZE, b'\0')
+  data[4096:8192] = geometry
+  data[8192:12288] = geometry
+  metadata = _metadata().ljust(MAX_SIZE, b'\0')
+  for slot in range(2 * SLOTS):
+    offset = METADATA_BASE + slot * MAX_SIZE
+    data[offset:offset + MAX_SIZE] = metadata
+  # zero and fill blocks inside system_a and vendor_a
+  data[2048 * SECTOR + 8192:2048 * SECTOR + 8192 + 100 * BLOCK_SIZE] = \
+      bytes(100 * BLOCK_SIZE)
+  data[8704 * SECTOR + 5 * BLOCK_SIZE:8704 * SECTOR + 205 * BLOCK_SIZE] = \
+      b'\xab\xcd\xef\x01' * (1024 * 200)
+  return data
+
+
+def _expected(data, name):
+  for partition_name, extents in PARTITIONS:
+    if partition_name == name:
+      return b''.join(
+        bytes(sectors * SECTOR) if target_type == 1 else
+        bytes(data[physical * SECTOR:(physical + sectors) * SECTOR])
+        for target_type, sectors, physical in extents)
+
+
+def _sparse_image(data):
+  """data in sparse format: fill chunks for runs of repeated words, raw
+  chunks for the rest and a don't care chunk at the end"""
+  chunks = []
+  for block in range(DONT_CARE_START):
+    block_data = bytes(data[block * BLOCK_SIZE:(block + 1) * BLOCK_SIZE])
+    if block_data == block_data[:4] * (BLOCK_SIZE // 4):
+      kind, payload = 'fill', block_data[:4]
+    else:
+      kind, payload = 'raw', block_data
+    if chunks and chunks[-1][0] == kind and \
+        (kind == 'raw' or chunks[-1][1] == payload):
+      chunks[-1][2] += 1
+      if kind == 'raw':
+        chunks[-1][1] += payload
+    else:
+      chunks.append([kind, payload, 1])
+
+  out = io.BytesIO()
+  total_blocks = SUPER_SIZE // BLOCK_SIZE
+  out.write(struct.pack('<I4H4I', 0xED26FF3A, 1, 0, 28, 12, BLOCK_SIZE,
+                        total_blocks, len(chunks) + 1, 0))
+  for kind, payload, blocks in chunks:
+    chunk_type = 0xCAC1 if kind == 'raw' else 0xCAC2
+    out.write(struct.pack('<2H2I', chunk_type, 0, blocks, 12 + len(payload)))
+    out.write(payload)
+  out.write(struct.pack('<2H2I', 0xCAC3, 0, total_blocks - DONT_CARE_START, 12))
+  return out.getvalue()
+
+
+def _check_output(data, output, names):
+  assert sorted(os.listdir(output)) == sorted(name + '.img' for name in names)
+  for name in names:
+    with open(os.path.join(output, name + '.img'), 'rb') as f:
+      assert f.read() == _expected(data, name), name
+
+
+def test_geometry_checksum():
+  data = _super_image()
+  source = lpunpack.BufferSource(bytes(data))
+  assert lpunpack.read_geometry(source) == (MAX_SIZE, SLOTS, BLOCK_SIZE)
+  assert lpunpack.metadata_end(source) == METADATA_BASE + 2 * SLOTS * MAX_SIZE
+
+  # a corrupt primary geometry falls back to the backup one
+  data[4096 + 20] ^= 0xff
+  source = lpunpack.BufferSource(bytes(data))
+  assert lpunpack.read_geometry(source) == (MAX_SIZE, SLOTS, BLOCK_SIZE)
+
+  data[8192 + 20] ^= 0xff
+  with pytest.raises(lpunpack.LpError):
+    lpunpack.read_geometry(lpunpack.BufferSource(bytes(data)))
+
+
+def test_header_checksum():
+  metadata = bytearray(_metadata().ljust(MAX_SIZE, b'\0'))
+  assert [p.name for p in lpunpack.parse_metadata(bytes(metadata))] == \
+      [name for name, _ in PARTITIONS]
+
+  corrupt = bytearray(metadata)
+  corrupt[100] ^= 0xff
+  with pytest.raises(lpunpack.LpError, match='header checksum'):
+    lpunpack.parse_metadata(bytes(corrupt))
+
+  corrupt = bytearray(metadata)
+  corrupt[300] ^= 0xff
+  with pytest.raises(lpunpack.LpError, match='tables checksum'):
+    lpunpack.parse_metadata(bytes(corrupt))
+
+
+def test_backup_metadata():
+  data = _super_image()
+  data[METADATA_BASE + 100] ^= 0xff
+  source = lpunpack.BufferSource(bytes(data))
+  partitions = lpunpack.read_metadata(source, 0)
+  assert [p.name for p in partitions] == [name for name, _ in PARTITIONS]
+
+  backup = METADATA_BASE + SLOTS * MAX_SIZE
+  data[backup + 100] ^= 0xff
+  with pytest.raises(lpunpack.LpError):
+    lpunpack.read_metadata(lpunpack.BufferSource(bytes(data)), 0)
+  # the other slots are still valid
+  lpunpack.read_metadata(lpunpack.BufferSource(bytes(data)), 1)
+
+
+def test_unpack_raw_and_sparse():
+  data = _super_image()
+  names = [name for name, _ in PARTITIONS]
+  with tempfile.TemporaryDirectory() as tmp:
+    raw = os.path.join(tmp, 'super.raw')
+    with open(raw, 'wb') as f:
+      f.write(data)
+    sparse = os.path.join(tmp, 'super.img')
+    with open(sparse, 'wb') as f:
+      f.write(_sparse_image(data))
+
+    for path in (raw, sparse):
+      output = os.path.join(tmp, os.path.basename(path) + '.out')
+      lpunpack.main(path, output, jobs=2)
+      _check_output(data, output, names)
+
+    # the zero extent of system_a is a hole of zeros
+    with open(os.path.join(tmp, 'super.raw.out', 'system_a.img'), 'rb') as f:
+      f.seek(2048 * SECTOR)
+      assert f.read(1024 * SECTOR) == bytes(1024 * SECTOR)
+
+
+def test_allow_list():
+  data = _super_image()
+  with tempfile.TemporaryDirectory() as tmp:
+    raw = os.path.join(tmp, 'super.raw')
+    with open(raw, 'wb') as f:
+      f.write(data)
+    output = os.path.join(tmp, 'out')
+    paths = lpunpack.main(raw, output, ['vendor_a', 'product_a', 'odm_a'])
+    assert sorted(paths) == [os.path.join(output, 'product_a.img'),
+                             os.path.join(output, 'vendor_a.img')]
+    _check_output(data, output, ['vendor_a', 'product_a'])
+
+
+def test_super_writer_out_of_order():
+  data = _super_image()
+  end = METADATA_BASE + 2 * SLOTS * MAX_SIZE
+  pieces = list(range(0, SUPER_SIZE, 300000))
+  random.Random(4).shuffle(pieces)
+  with tempfile.TemporaryDirectory() as tmp:
+    with lpunpack.SuperWriter(tmp, head=bytes(data[:end])) as writer:
+      for offset in pieces:
+        writer.pwrite(bytes(data[offset:offset + 300000]), offset)
+    _check_output(data, tmp, [name for name, _ in PARTITIONS])
+
+
+def test_super_writer_streams():
+  data = _super_image()
+  names = ['system_a', 'vendor_a']
+  with tempfile.TemporaryDirectory() as tmp:
+    output = os.path.join(tmp, 'raw')
+    with lpunpack.SuperWriter(output, names) as writer:
+      lpunpack.write_stream(io.BytesIO(bytes(data)), writer, chunk_size=100000)
+    _check_output(data, output, names)
+
+    output = os.path.join(tmp, 'sparse')
+    with lpunpack.SuperWriter(output, names) as writer:
+      lpunpack.write_sparse_stream(io.BytesIO(_sparse_image(data)), writer,
+                                   chunk_size=100000)
+    _check_output(data, output, names)
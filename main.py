@@ -107,6 +107,12 @@ def parser():
                       help='Build Sparse image (linux only) with [-R]')
   parser.add_argument('-B', dest='brotli', action='store_true',
                       help='Build .sdat.br image (linux only) with [-RS]')
+  parser.add_argument('--incremental', dest='incremental', metavar='SOURCE_DIR',
+                      help='Build incremental sdat from the images of a previous build in SOURCE_DIR with [-B]')
+  parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                      help='Unpack up to JOBS partitions at once with [-i]')
+  parser.add_argument('--disk-jobs', dest='disk_jobs', type=int, default=None,
+                      help='Max disk heavy steps (unzip/extract) at once with [-j]')
   parser.add_argument('--clean', dest='clean',
                       action='store_true', help='Clean up projects dir')
   parser.add_argument('--version', dest='version',
@@ -171,8 +177,12 @@ if __name__ == '__main__':
   main_project = utils.load_config('MAIN', 'main_project')
 
   if args.input:
-    utils.extract_fw(args.input, os.path.join(main_project, 'Source'))
-    utils.extract_img(main_project)
+    scheduler = utils.Scheduler(args.jobs, disk_jobs=args.disk_jobs)
+    if not utils.extract_fw(args.input, os.path.join(
+        main_project, 'Source'), scheduler):
+      sys.exit(1)
+    utils.extract_img(main_project, scheduler)
+    scheduler.run()
     utils.display_rom_info(main_project)
 
   if args.raw:
@@ -191,7 +201,7 @@ if __name__ == '__main__':
     brotli = False
 
   if sparse or raw or brotli:
-    utils.create_ext4.main(raw, sparse, brotli)
+    utils.create_ext4.main(raw, sparse, brotli, args.incremental)
 
   runtime = (time.time() - start_time)
   from utils.print_wrapper import print
@@ -21,6 +21,8 @@
 """
 
 from .func import *
+from .scheduler import *
+from .firmware_plan import *
 from .config import *
 from .extract_firmware import *
 from .create_ext4 import *
@@ -72,7 +72,8 @@ def write_default_config():
   main = {
     'main_project': 'Projects/',
     'partitions': 'odm system vendor product system_ext cust odm_a vendor_a product_a system_ext_a system_a odm_dlkm vendor_dlkm my_bigball my_carrier my_engineering my_heytap my_manifest my_product my_region my_stock odm_dlkm_a vendor_dlkm_a my_bigball_a my_carrier_a my_engineering_a my_heytap_a my_manifest_a my_product_a my_region_a my_stock_a',
-    'proj_folders': 'Config Build Backup Source Output'
+    'proj_folders': 'Config Build Backup Source Output',
+    'brotli_quality': '6'
   }
 
   if check_arch() == "AMD64":
@@ -113,6 +114,7 @@ def write_default_config():
     'extract_ext4': 'bin/python/extract_ext4.py',
     'img2sdat': 'bin/python/img2sdat/img2sdat.py',
     'sdat2img': 'bin/python/sdat2img.py',
+    'lpunpack': 'bin/python/lpunpack.py',
     'check_super_erofs': 'bin/python/check_super_erofs.py'
   }
 
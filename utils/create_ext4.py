@@ -31,14 +31,16 @@ import time
 from loguru import logger
 
 from utils.config import load_config
-from utils.func import RunCommand, cat, remove
+from utils.func import RunCommand, cat, import_script, progress_logger, remove
 
 mke2fs = load_config('LINUX', 'mke2fs')
 mke2fs_conf = load_config('LINUX', 'mke2fs_conf')
 e2fsdroid = load_config('LINUX', 'e2fsdroid')
-img2simg = load_config('LINUX', 'img2simg')
 brotli_tool = load_config('LINUX', 'brotli')
+brotli_quality = load_config('MAIN', 'brotli_quality') or '6'
 img2sdat = load_config('PYTHON', 'img2sdat')
+sparse_img_py = os.path.join(os.path.dirname(img2sdat), 'sparse_img.py')
+ext4_info = load_config('PYTHON', 'ext4_info')
 config_dir = os.path.join(load_config('MAIN', 'main_project'), 'Config')
 build_dir = os.path.join(load_config('MAIN', 'main_project'), 'Build')
 out_dir = os.path.join(load_config('MAIN', 'main_project'), 'Output')
@@ -158,7 +160,41 @@ def run_command(cmd, env):
   return output, p.returncode
 
 
-def __make_ext4(raw=False, sparse=False, brotli=False):
+def __mount_point(part):
+  """mount point of part, the paths of its block map start with it"""
+  return '/' if part in ('system', 'system_a') else '/'+part
+
+
+def __incremental_args(source_dir, part):
+  """img2sdat arguments to diff part against the image in source_dir"""
+  for name in (part+'.sparse', part+'.img'):
+    source_img = os.path.join(source_dir, name)
+    if os.path.isfile(source_img):
+      break
+  else:
+    logger.warning(f"No {part} image in {source_dir}, build full sdat")
+    return []
+
+  args = ['-s', source_img]
+  source_map = os.path.join(source_dir, part+'.map')
+  target_map = os.path.join(build_dir, part+'.map')
+
+  # a raw source image (eg: from the stock firmware) has no block map yet
+  if not os.path.isfile(source_map) and \
+          not import_script(sparse_img_py).IsSparseImage(source_img):
+    source_map = os.path.join(build_dir, part+'.source.map')
+    logger.info(f'Generate block map of {source_img}...')
+    import_script(ext4_info).write_block_map(
+      source_img, source_map, __mount_point(part))
+
+  if os.path.isfile(source_map) and os.path.isfile(target_map):
+    args += ['--source-map', source_map, '--target-map', target_map]
+  else:
+    logger.warning(f"No block map for {part}, diff the image as a whole")
+  return args
+
+
+def __make_ext4(raw=False, sparse=False, brotli=False, source_dir=None):
   """Make ext4 filesystem"""
 
   images_build = __print_images()
@@ -240,6 +276,9 @@ def __make_ext4(raw=False, sparse=False, brotli=False):
               os.path.join(build_dir, part+'.img')
             ]
 
+        # block map of the files, used to diff incremental updates per file
+        e2fsdroid_cmd[-1:-1] = ['-B', os.path.join(build_dir, part+'.map')]
+
         output, ret = run_command(e2fsdroid_cmd, e2fsdroid_env)
         if ret != 0:
           logger.error(f"Failed to run e2fsdroid_cmd: {output}")
@@ -250,36 +289,45 @@ def __make_ext4(raw=False, sparse=False, brotli=False):
     if sparse:
       raw_img = os.path.join(build_dir, part+'.img')
       sparse_img = os.path.join(build_dir, part+'.sparse')
+      block_map = os.path.join(build_dir, part+'.map')
+      if os.path.exists(raw_img) and not os.path.isfile(block_map):
+        logger.info('Generate block map...')
+        import_script(ext4_info).write_block_map(
+          raw_img, block_map, __mount_point(part))
+
       if os.path.exists(raw_img):
         logger.info('Convert raw image to sparse...')
-        cmd = [img2simg, raw_img, sparse_img]
-        RunCommand(cmd, verbose=True)
+        import_script(sparse_img_py).SparsifyImage(
+          raw_img, sparse_img, progress=progress_logger(part+'.sparse'))
 
       if os.path.isfile(sparse_img):
         remove(raw_img)
 
     if brotli:
       sparse_img = os.path.join(build_dir, part+'.sparse')
-      sdat_img = os.path.join(build_dir, part+'.new.dat')
+      sdat_br = os.path.join(build_dir, part+'.new.dat.br')
       if os.path.exists(sparse_img):
-        logger.info('Convert sparse image to sdat...')
+        # img2sdat compresses new.dat while writing it
+        logger.info('Convert sparse image to sdat.br...')
         cmd = ['python', img2sdat, '-o', build_dir,
-               '-p', part, sparse_img, '402653184']
+               '-p', part, sparse_img, '402653184',
+               '-b', brotli_quality, '--brotli-bin', brotli_tool]
+        if (os.cpu_count() or 1) > 1:
+          cmd.append('--pipelined')
+        if source_dir:
+          cmd += __incremental_args(source_dir, part)
         RunCommand(cmd, verbose=True)
 
-        if os.path.isfile(sdat_img):
+        if os.path.isfile(sdat_br):
           remove(sparse_img)
 
-        logger.info('Compress with brotli...')
-        cmd = [brotli_tool, '-q', '6', '-v', '-f', sdat_img]
-        RunCommand(cmd, verbose=True)
-
-        if os.path.isfile(sdat_img+'.br'):
-          remove(sdat_img)
 
+def main(raw=False, sparse=False, brotli=False, source_dir=None):
+  """Main
 
-def main(raw=False, sparse=False, brotli=False):
-  """Main"""
+  With source_dir the sdat of every partition is an incremental update from
+  the <part>.sparse (or <part>.img) of a previous build found in source_dir.
+  """
   vendor_context = os.path.join(
     out_dir, 'vendor/etc/selinux/vendor_file_contexts')
   system_context = os.path.join(
@@ -303,4 +351,4 @@ def main(raw=False, sparse=False, brotli=False):
         f"{file_context} Not found!!")
       sys.exit(1)
 
-  __make_ext4(raw, sparse, brotli)
+  __make_ext4(raw, sparse, brotli, source_dir)
@@ -20,19 +20,24 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import contextlib
 import glob
 import gzip
+import io
 import os
 import re
 import shutil
+import threading
 import zipfile
 
 import zstandard
 from loguru import logger
 
 from utils.config import load_config, write_default_config
-from utils.func import RunCommand, mkdir, remove, rmdir
+from utils.firmware_plan import FirmwarePlan, zip_index
+from utils.func import RunCommand, import_script, mkdir, remove, rmdir
 from utils.print_wrapper import print
+from utils.scheduler import CPU, DISK, Scheduler
 
 # tools #################
 # generate config.ini if not exist
@@ -41,19 +46,129 @@ if not os.path.exists('./config.ini'):
   write_default_config()
 
 brotli = load_config('LINUX', 'brotli')
-simg2img = load_config('LINUX', 'simg2img')
-lpunpack = load_config('LINUX', 'lpunpack')
 payload = load_config('LINUX', 'payload')
 sdat2img = load_config('PYTHON', 'sdat2img')
+lpunpack = load_config('PYTHON', 'lpunpack') or 'bin/python/lpunpack.py'
 PARTITIONS = load_config('MAIN', 'partitions').split(' ')
 
+# bytes copied at a time from a zip member
+ZIP_COPY_SIZE = 4 << 20
+# head of a super.new.dat read for the LP metadata (grown when it is larger)
+SUPER_HEAD_SIZE = 1 << 20
+
 #########################
 
 
 # functions #############
+class FileSlice(io.RawIOBase):
+  """Read-only stream of `size` bytes at `offset` of a file.
+
+  Reads with os.pread(), so it keeps no shared file position and the zip
+  can be read by other tasks at the same time.
+  """
+
+  def __init__(self, path, offset, size):
+    super().__init__()
+    self._fd = os.open(path, os.O_RDONLY)
+    self._offset = offset
+    self._size = size
+    self._pos = 0
+
+  def readable(self):
+    return True
+
+  def seekable(self):
+    return True
+
+  def readinto(self, b):
+    n = min(len(b), self._size - self._pos)
+    if n <= 0:
+      return 0
+    n = os.preadv(self._fd, [memoryview(b)[:n]], self._offset + self._pos)
+    self._pos += n
+    return n
+
+  def seek(self, pos, whence=io.SEEK_SET):
+    if whence == io.SEEK_CUR:
+      pos += self._pos
+    elif whence == io.SEEK_END:
+      pos += self._size
+    self._pos = pos
+    return pos
+
+  def tell(self):
+    return self._pos
+
+  def close(self):
+    if not self.closed:
+      os.close(self._fd)
+    super().close()
+
+
+def zip_member_offset(input_zip, member):
+  """Find the data of a stored (uncompressed) zip member
+
+  Args:
+      input_zip: input zip
+      member: member name
+
+  Returns:
+      tuple: (offset, size) of the member data in the zip, None if the
+          member is compressed or encrypted.
+  """
+  info = zip_index(input_zip)[member]
+  if info.offset is None:
+    return None
+  return (info.offset, info.size)
+
+
+@contextlib.contextmanager
+def open_zip_member(input_zip, member):
+  """Open a zip member as a readable binary stream, nothing is written to disk
+
+  Stored members are read straight from their data in the zip, the others
+  are decompressed by ZipFile.open() while they are read.
+  """
+  span = zip_member_offset(input_zip, member)
+  if span is not None:
+    with io.BufferedReader(FileSlice(input_zip, *span), ZIP_COPY_SIZE) as f:
+      yield f
+  else:
+    with zipfile.ZipFile(input_zip, 'r') as zf, zf.open(member) as f:
+      yield f
+
+
+def copy_file_span(path, offset, size, output):
+  """Copy `size` bytes at `offset` of path to output
+
+  Uses os.copy_file_range(), so the data is copied in the kernel (or
+  reflinked) and falls back to reads and writes where it is not supported.
+  """
+  with open(path, 'rb') as src, open(output, 'wb') as dst:
+    done = 0
+    try:
+      while done < size:
+        n = os.copy_file_range(src.fileno(), dst.fileno(), size - done,
+                               offset + done)
+        if not n:
+          break
+        done += n
+    except (AttributeError, OSError):
+      pass
+    if done < size:
+      dst.seek(done)
+      with FileSlice(path, offset + done, size - done) as rest:
+        shutil.copyfileobj(rest, dst, ZIP_COPY_SIZE)
+    if dst.tell() != size:
+      raise ValueError('Unexpected end of %s' % path)
+
+
 def extract_file_from_zip(input_zip, output, members=None):
   """extract some files from a zip file
 
+  Stored members are copied from their data in the zip with
+  copy_file_span(), compressed ones are decompressed straight to the output.
+
   Args:
       input: input zip
       output: output folder
@@ -61,8 +176,18 @@ def extract_file_from_zip(input_zip, output, members=None):
   """
   try:
     logger.info('Extracting %s from %s to %s' % (members, input_zip, output))
-    with zipfile.ZipFile(input_zip, 'r') as zf:
-      zf.extractall(output, members=[members])
+    # same path sanitizing as ZipFile.extract()
+    parts = [p for p in members.split('/') if p not in ('', '.', '..')]
+    target = os.path.join(output, *parts)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    span = zip_member_offset(input_zip, members)
+    if span is not None:
+      copy_file_span(input_zip, *span, target)
+    else:
+      with open_zip_member(input_zip, members) as src, \
+          open(target, 'wb') as dst:
+        shutil.copyfileobj(src, dst, ZIP_COPY_SIZE)
   except KeyError:
     logger.error("Can't extract %s from archive", members)
 
@@ -76,36 +201,31 @@ def zip_list(input_zip):
   Returns:
       list: sorted list
   """
-  with zipfile.ZipFile(input_zip, 'r') as zf:
-    list_files = zf.infolist()
-    lf = []
-    for f in list_files:
-      lf.append(f.filename)
-    return sorted(lf)
+  return sorted(zip_index(input_zip))
 
 
 def gnuzip(input_zip, output):
   """Gunzips the given gzip compressed file to a given output file
 
   Args:
-      input : input gzip file.
+      input : input gzip file or readable binary stream.
       output : output file.
   """
   with gzip.open(input_zip, "rb") as in_file, \
       open(output, "wb") as out_file:
-    shutil.copyfileobj(in_file, out_file)
+    shutil.copyfileobj(in_file, out_file, ZIP_COPY_SIZE)
 
 
 def zstd(input_zip, output):
   """Zstd the given zstd compressed file to a given output file
 
   Args:
-      input : input gzip file.
+      input : input zstd file or readable binary stream.
       output : output file.
   """
   with zstandard.open(input_zip, "rb") as in_file, \
       open(output, "wb") as out_file:
-    shutil.copyfileobj(in_file, out_file)
+    shutil.copyfileobj(in_file, out_file, ZIP_COPY_SIZE)
 
 
 def extract_brotli(br_img, output):
@@ -121,91 +241,204 @@ def extract_brotli(br_img, output):
   if os.path.exists(br_img):
     basedir = os.path.realpath(os.path.dirname(br_img))
     output = os.path.realpath(output)
-    sdat_img = br_img.split('.br')[0]
     img_name = os.path.basename(br_img).split('.')[0]
     # check if output folder exists (if not make it)
     if not os.path.exists(output):
       mkdir(output)
 
-    logger.info("Convert %s.new.dat.br to %s.new.dat" % (img_name, img_name))
-    cmd = [brotli, '-df', br_img]
-    RunCommand(cmd)
-
-    if os.path.exists(sdat_img):
-      logger.info('Convertig %s.new.dat to %s.img' % (img_name, img_name))
-      cmd = [
-        'python', sdat2img, os.path.join(
-          basedir, img_name+'.transfer.list'), sdat_img, os.path.join(output, img_name+'.img')
-      ]
-      RunCommand(cmd)
+    # stream the decompressed data into sdat2img, no .new.dat on disk
+    logger.info('Convertig %s.new.dat.br to %s.img' % (img_name, img_name))
+    sdat = import_script(sdat2img)
+    with open(os.path.join(basedir, img_name+'.transfer.list'), 'r') as transfer_list, \
+        sdat.open_new_dat(br_img, brotli) as new_dat:
+      sdat.main(transfer_list, new_dat, os.path.join(output, img_name+'.img'))
 
     if os.path.exists(os.path.join(output, img_name+'.img')):
       remove(br_img)
-      remove(os.path.join(output, img_name+'.new.dat'))
       remove(os.path.join(output, img_name+'.transfer.list'))
 
   else:
     logger.info("Not found %s", br_img)
 
 
-def extract_super_img(input_img, output, type_img='sparse'):
+def extract_brotli_from_zip(input_zip, img_name, output):
+  """Convert <img_name>.new.dat.br of the zip to output/<img_name>.img
+
+  The member is decompressed into sdat2img while it is read from the zip,
+  neither the .br nor the .new.dat is written to disk.
+
+  Args:
+      input_zip : input zip
+      img_name : image name (eg: system)
+      output : output folder
+  """
+  if not os.path.exists(output):
+    mkdir(output)
+
+  logger.info('Convertig %s.new.dat.br to %s.img' % (img_name, img_name))
+  sdat = import_script(sdat2img)
+  with zipfile.ZipFile(input_zip, 'r') as zf:
+    transfer_list = io.StringIO(
+      zf.read(img_name+'.transfer.list').decode('ascii'))
+  with open_zip_member(input_zip, img_name+'.new.dat.br') as br_stream, \
+      sdat.open_new_dat(br_stream, brotli) as new_dat:
+    sdat.main(transfer_list, new_dat, os.path.join(output, img_name+'.img'))
+
+
+def extract_super_img(input_img, output, type_img='sparse', jobs=1):
   """extract super img
 
+  The partitions are written straight from input_img, no super.raw: a
+  sparse or raw image is read in place, gz/zstd/brotli images are decoded
+  as a stream that is routed to the partition images.
+
   Args:
       input_img (_type_): img input
       output (_type_): output directory
       type_img (str, optional): _description_. Defaults to 'sparse'.
+      jobs (int, optional): partitions unpacked at once. Defaults to 1.
   """
-  raw_img = os.path.join(output, "super.raw")
-  check_sparse = os.path.join(load_config('BASH', 'check_sparse'))
-
   if type_img == 'sparse':
-    cmd = ['bash', check_sparse, input_img]
-    check_sparse = RunCommand(cmd)
-    if check_sparse[0].strip() == "sparse":
-      logger.info("Extracting sparse super image...")
-      cmd = [simg2img, input_img, raw_img]
-      RunCommand(cmd)
-    else:
-      os.rename(input_img, raw_img)
+    unpack_super(input_img, output, jobs)
 
-    if os.path.exists(raw_img):
-      remove(input_img)  # cleanup after extract
+  elif type_img in ('gz', 'zstd'):
+    logger.info("Extracting %s super image..." % type_img)
+    with (gzip if type_img == 'gz' else zstandard).open(input_img, 'rb') as f:
+      unpack_super_stream(f, output)
 
-  elif type_img == 'gz':
-    logger.info("Extracting gzip super image...")
-    gnuzip(input_img, raw_img)
-    if os.path.exists(raw_img):
-      remove(input_img)  # cleanup after extract
+  elif type_img == 'brotli':
+    logger.info("Extracting brotli super image...")
+    sdat = import_script(sdat2img)
+    transfer_list = os.path.join(os.path.dirname(input_img),
+                                 'super.transfer.list')
+    with open(transfer_list, 'r') as f:
+      commands = sdat.transfer_list_file_to_commands(f)
+    unpack_super_sdat(commands, lambda: sdat.open_new_dat(input_img, brotli),
+                      output)
+    remove(transfer_list)
 
-  elif type_img == 'zstd':
-    logger.info("Extracting zstd super image...")
-    zstd(input_img, raw_img)
-    if os.path.exists(raw_img):
-      remove(input_img)  # cleanup after extract
+  else:
+    logger.info("Not supported yet.")
+    return
+
+  remove(input_img)  # cleanup after extract
+
+
+def extract_super_from_zip(input_zip, member, output, type_img='sparse',
+                           jobs=1):
+  """extract a super image member of the zip without unzipping it first
+
+  gz/zstd/brotli members are decoded while they are read from the zip, a
+  stored sparse (or raw) super.img is read at its offset in the zip.
+
+  Args:
+      input_zip: input zip
+      member: super image member (eg: super.img.zst)
+      output: output directory
+      type_img (str, optional): sparse, gz, zstd or brotli. Defaults to 'sparse'.
+      jobs (int, optional): partitions unpacked at once. Defaults to 1.
+  """
+  if type_img == 'sparse':
+    span = zip_member_offset(input_zip, member)
+    if span is None:
+      # the sparse reader seeks around, a compressed member is unzipped first
+      extract_file_from_zip(input_zip, output, members=member)
+      extract_super_img(os.path.join(output, member), output, jobs=jobs)
+    else:
+      unpack_super(input_zip, output, jobs, offset=span[0])
+
+  elif type_img in ('gz', 'zstd'):
+    logger.info("Extracting %s super image..." % type_img)
+    with open_zip_member(input_zip, member) as f, \
+        (gzip if type_img == 'gz' else zstandard).open(f, 'rb') as super_img:
+      unpack_super_stream(super_img, output)
 
   elif type_img == 'brotli':
     logger.info("Extracting brotli super image...")
-    extract_brotli(input_img, output)
-    os.rename(os.path.join(output, 'super.img'),
-              os.path.join(output, 'super.raw'))
+    sdat = import_script(sdat2img)
+    with zipfile.ZipFile(input_zip, 'r') as zf:
+      commands = sdat.transfer_list_file_to_commands(
+        io.StringIO(zf.read('super.transfer.list').decode('ascii')))
+
+    @contextlib.contextmanager
+    def open_new_dat():
+      with open_zip_member(input_zip, 'super.new.dat.br') as br_stream, \
+          sdat.open_new_dat(br_stream, brotli) as new_dat:
+        yield new_dat
+
+    unpack_super_sdat(commands, open_new_dat, output)
 
   else:
     logger.info("Not supported yet.")
 
-  # extract images from super.img
-  try:
-    logger.info("Extracting raw super image...")
-    if os.path.exists(raw_img):
-      cmd = [lpunpack, raw_img, output]
-      RunCommand(cmd)
-      remove(raw_img)  # cleanup after extract
 
-  except:  # pylint: disable=W0702
-    logger.error("Error when extracting raw super image...")
+@contextlib.contextmanager
+def __super_errors(super_img):
+  """exit on errors of the LP metadata or of the image data"""
+  lp = import_script(lpunpack)
+  try:
+    yield lp
+  except (OSError, ValueError, lp.LpError):
+    logger.exception("Error when extracting super image {}", super_img)
     exit(1)
 
 
+def unpack_super(super_img, output, jobs=1, offset=0):
+  """extract the PARTITIONS packed in a raw or sparse super image at offset
+  of super_img
+
+  The LP metadata is parsed here and the extents of the partitions are
+  copied with copy_file_range, other logical partitions are left out.
+  """
+  with __super_errors(super_img) as lp:
+    logger.info("Extracting super image...")
+    images = lp.main(super_img, output, partitions=PARTITIONS, jobs=jobs,
+                     offset=offset)
+    logger.info("Unpacked {} partition(s) from {}", len(images), super_img)
+
+
+def unpack_super_stream(stream, output):
+  """route a decoded super image stream to the PARTITIONS images
+
+  Only the data that lands in the partitions is written, the super image
+  is never on disk.
+  """
+  with __super_errors('stream') as lp:
+    with lp.SuperWriter(output, PARTITIONS) as writer:
+      lp.write_stream(stream, writer)
+    logger.info("Unpacked {} partition(s) from the stream", len(writer.paths))
+
+
+def unpack_super_sdat(commands, open_new_dat, output):
+  """route the image of a super transfer list to the PARTITIONS images
+
+  The commands may write the image in any order, so a first pass over
+  the new data reads the head of the image with the LP metadata, then the
+  second pass routes every range to the partitions. This decodes part of
+  the stream twice instead of writing the whole super image to disk.
+
+  Args:
+      commands: commands of super.transfer.list (sdat2img)
+      open_new_dat: callable returning a new context manager of the new data
+      output: output directory
+  """
+  sdat = import_script(sdat2img)
+  with __super_errors('super.new.dat') as lp:
+    size = SUPER_HEAD_SIZE
+    while True:
+      with open_new_dat() as new_dat:
+        head = sdat.read_head(commands, new_dat, size)
+      end = lp.metadata_end(lp.BufferSource(head))
+      if end <= size:
+        break
+      size = end
+
+    with open_new_dat() as new_dat, \
+        lp.SuperWriter(output, PARTITIONS, head=head[:end]) as writer:
+      sdat.apply_commands(commands, new_dat, writer)
+    logger.info("Unpacked {} partition(s) from super.new.dat", len(writer.paths))
+
+
 def extract_payload(img, output):
   """Unpack payload.bin
 
@@ -218,143 +451,138 @@ def extract_payload(img, output):
   remove(img)
 
 
-def extract_fw(input_zip, output_folder):
-  """Extract firmware
-
-  Args:
-      input_zip (_type_): input rom zip
-      output_folder (_type_): out dir
-  """
-  list_images = []
-  list_zip = zip_list(input_zip)
-  br = False
-  super_img = False
-  chunck = False
-  list_other = ['vbmeta_system', 'vbmeta', 'boot', 'dtbo']
-
-  for lz in list_zip:
-    if re.search(r"(super.*)", lz) is not None:  # super
-      super_img = True
-      list_images.append(lz)
-
-    elif lz == 'payload.bin':
-      extract_file_from_zip(input_zip, output_folder, members=lz)
-      extract_payload(os.path.join(
-        output_folder, 'payload.bin'), output_folder)
-
-    elif re.search(r"(.*.br)", lz) is not None:
-      br = True
-
-    elif re.search(r"(.*.img)", lz) is not None:
-      for part in PARTITIONS:
-        if part+'.img' == lz:
-          extract_file_from_zip(input_zip, output_folder, members=lz)
-
+def __extract_super(input_zip, output_folder, item, jobs=1):
+  """Extract the super image members of a plan item and unpack them"""
+  if item.fmt != 'sparsechunk':
+    logger.info("{} super image detected.",
+                {'gz': 'Gzip'}.get(item.fmt, item.fmt.capitalize()))
+    extract_super_from_zip(input_zip, item.name, output_folder,
+                           type_img=item.fmt, jobs=jobs)
+    return
+
+  logger.info("Sparsechunk super image detected.")
+  # plan members are sorted by chunk number
+  spans = [zip_member_offset(input_zip, c) for c in item.members]
+
+  with __super_errors(item.name) as lp:
+    if None not in spans:
+      # the chunks are read in place from the zip as one sparse image
+      source = lp.SparseSource([(input_zip, span[0]) for span in spans])
+      try:
+        images = lp.unpack(source, output_folder, PARTITIONS, jobs=jobs)
+      finally:
+        source.close()
     else:
-      continue
-
-  if super_img:
-    for s in list_images:
-      if len(list_images) == 1:
-        if re.search(r"(super.img.gz)", s) is not None:
-          logger.info("Gzip super image detected.")
-          extract_file_from_zip(input_zip, output_folder, members=s)
-          extract_super_img(os.path.join(
-            output_folder, s), output_folder, type_img='gz')
-
-        if re.search(r"(super.img.zst)", s) is not None:
-          logger.info("Zstd super image detected.")
-          extract_file_from_zip(input_zip, output_folder, members=s)
-          extract_super_img(os.path.join(
-            output_folder, s), output_folder, type_img='zstd')
-
-        elif re.search(r'super.img$', s) is not None:  # sparse
-          logger.info("Sparse super image detected.")
-          extract_file_from_zip(input_zip, output_folder, members=s)
-          extract_super_img(os.path.join(
-            output_folder, s), output_folder)
-
-      elif len(list_images) > 1:
-        if re.search(r"(super.new.dat.br)", s) is not None:
-          logger.info("Brotli super image detected.")
-          extract_file_from_zip(input_zip, output_folder,
-                                members='super.new.dat.br')
-          extract_file_from_zip(input_zip, output_folder,
-                                members='super.transfer.list')
-
-          extract_super_img(os.path.join(
-            output_folder, 'super.new.dat.br'), output_folder, type_img='brotli')
-
-        else:  # Sparsechunk super.img
-          chunck = True
-
-    if chunck:
-      logger.info("Sparsechunk super image detected.")
-      list_chunk = []
-
-      for c in list_images:
-        extract_file_from_zip(input_zip, output_folder, members=c)
-        list_chunk.append(os.path.join(output_folder, c))
-
-      # sort list chunk according to numirical part
-      list_chunk.sort(key=lambda test_string: list(
-        map(int, re.findall(r'\d+', test_string)))[0])
-
-      # merg chunck super img
-      cmd = [simg2img, *list_chunk, os.path.join(output_folder, 'super.img')]
-      RunCommand(cmd)
+      # compressed chunks are decoded one after the other
+      with lp.SuperWriter(output_folder, PARTITIONS) as writer:
+        for c in item.members:
+          with open_zip_member(input_zip, c) as f:
+            lp.write_sparse_stream(f, writer)
+      images = writer.paths
+    logger.info("Unpacked {} partition(s) from {} sparse chunks", len(images),
+                len(item.members))
 
-      # remove chunks apfter merge to super.img
-      for c in list_chunk:
-        remove(c)
 
-      # extract super.img
-      extract_super_img(os.path.join(
-        output_folder, 'super.img'), output_folder)
-
-  if br:
-    extracted_list = PARTITIONS
+def extract_fw(input_zip, output_folder, scheduler=None, plan=None):
+  """Extract firmware
 
-    logger.info("Brotli images detected.")
-    for br_img in extracted_list:
-      for in_zip in list_zip:
-        if in_zip == br_img+'.new.dat.br':
-          extract_file_from_zip(input_zip, output_folder, members=in_zip)
-          extract_file_from_zip(input_zip, output_folder,
-                                members=br_img+'.transfer.list')
-          extract_brotli(os.path.join(output_folder, in_zip), output_folder)
+  Every step is a task of `scheduler` named "<member>:unzip",
+  "<part>:sdat2img", "super:extract" or "payload:extract", so the
+  partitions can be unpacked next to each other and next to the tasks of
+  extract_img(). Without a scheduler the tasks run here one by one.
 
-  # extract other images from zip file
-  for other in list_zip:
-    for lo in list_other:
-      if re.search(rf"({lo}.*)", other) is not None:
-        extract_file_from_zip(input_zip, output_folder, members=other)
+  The tasks follow the FirmwarePlan of the zip, nothing is added when its
+  output does not fit in output_folder.
 
+  Args:
+      input_zip (_type_): input rom zip
+      output_folder (_type_): out dir
+      scheduler (Scheduler, optional): add the tasks to it, the caller runs it.
+      plan (FirmwarePlan, optional): plan of input_zip. Defaults to a new one.
 
-def extract_img(main_project):
-  """"Extract super/erofs/ext4 images"""
-  for part in PARTITIONS:
-    ext4_info = os.path.join(load_config('PYTHON', 'ext4_info'))
-    erofs_info = os.path.join(load_config('PYTHON', 'erofs_info'))
-    extract_ext4 = os.path.join(load_config('PYTHON', 'extract_ext4'))
-    erofs = os.path.join(load_config('LINUX', 'erofs'))
-    check_super_erofs = os.path.join(
-      load_config('PYTHON', 'check_super_erofs'))
-
-    input_img = os.path.join(main_project, 'Source', part+'.img')
-    info_dir = os.path.join(main_project, 'Config')
-    out_dir = os.path.join(main_project, 'Output', part)
-    source_dir = os.path.join(main_project, 'Source')
-
-    # if type of img data try to extract super img with other name
-    if os.path.isfile(input_img):
-      cmd = ['python', check_super_erofs, input_img]
-      check = RunCommand(cmd)
-
-      if check[0].strip() == "super":
-        extract_super_img(input_img, source_dir)
-
-      elif check[0].strip() == "erofs":
+  Returns:
+      bool: False if there is not enough space for the plan.
+  """
+  if plan is None:
+    plan = FirmwarePlan(input_zip, PARTITIONS)
+  plan.log()
+  if not plan.check_disk(output_folder):
+    return False
+
+  run = scheduler is None
+  if run:
+    scheduler = Scheduler()
+
+  def unzip(member):
+    name = member+':unzip'
+    if name not in scheduler:
+      scheduler.add(name, extract_file_from_zip, input_zip, output_folder,
+                    members=member, resource=DISK)
+    return name
+
+  for item in plan.items:
+    if item.kind == 'payload':
+      scheduler.add('payload:extract', extract_payload,
+                    os.path.join(output_folder, 'payload.bin'), output_folder,
+                    deps=[unzip(item.name)], resource=CPU)
+
+    elif item.kind == 'super':
+      # the partitions are copied next to each other inside this task
+      scheduler.add('super:extract', __extract_super, input_zip, output_folder,
+                    item, jobs=scheduler.limits[DISK], resource=DISK)
+
+    elif item.kind == 'sdat':
+      # streamed out of the zip, nothing to unzip first
+      scheduler.add(item.partition+':sdat2img', extract_brotli_from_zip,
+                    input_zip, item.partition, output_folder, resource=CPU)
+
+    else:  # img, other
+      unzip(item.name)
+
+  if run:
+    scheduler.run()
+  return True
+
+
+# images claimed by an extract task, so an image unpacked from a super image
+# found in extract_partition() is not extracted twice
+_claimed = set()
+_claimed_lock = threading.Lock()
+# erofs extraction shares Output/config, run one at a time
+_erofs_lock = threading.Lock()
+
+
+def extract_partition(main_project, part):
+  """Extract Source/<part>.img (super/erofs/ext4) if it exists"""
+  erofs_info = os.path.join(load_config('PYTHON', 'erofs_info'))
+  extract_ext4 = os.path.join(load_config('PYTHON', 'extract_ext4'))
+  erofs = os.path.join(load_config('LINUX', 'erofs'))
+  check_super_erofs = os.path.join(
+    load_config('PYTHON', 'check_super_erofs'))
+
+  input_img = os.path.join(main_project, 'Source', part+'.img')
+  info_dir = os.path.join(main_project, 'Config')
+  out_dir = os.path.join(main_project, 'Output', part)
+  source_dir = os.path.join(main_project, 'Source')
+
+  with _claimed_lock:
+    if not os.path.isfile(input_img) or input_img in _claimed:
+      return
+    _claimed.add(input_img)
+
+  # if type of img data try to extract super img with other name
+  if os.path.isfile(input_img):
+    cmd = ['python', check_super_erofs, input_img]
+    check = RunCommand(cmd)
+
+    if check[0].strip() == "super":
+      extract_super_img(input_img, source_dir)
+      # the partitions packed in it were not in Source when their tasks ran
+      for super_part in PARTITIONS:
+        extract_partition(main_project, super_part)
+
+    elif check[0].strip() == "erofs":
+      with _erofs_lock:
         try:
           # FIXME rename part_a to part on output folder
           if part.endswith('_a'):
@@ -384,16 +612,40 @@ def extract_img(main_project):
         except:  # pylint: disable=W0702
           logger.exception("Error when erofs extraction")
 
-      else:
-        logger.info("File system Type: {} :: ext4", input_img)
-        mkdir(out_dir)
-        logger.info("Extract information {}", part)
-        cmd = ['python', ext4_info, input_img, info_dir]
-        RunCommand(cmd)
-        logger.info("Extract {} to {}", input_img, out_dir)
-        cmd = ['python', extract_ext4, input_img, out_dir]
-        RunCommand(cmd)
-        remove(input_img)
+    else:
+      logger.info("File system Type: {} :: ext4", input_img)
+      mkdir(out_dir)
+      # one walk over the image writes files and information together
+      logger.info("Extract {} to {} (information to {})", input_img, out_dir, info_dir)
+      extract = import_script(extract_ext4).ExtractExt4(
+        input_img, out_dir, info_dir=info_dir)
+      extract.extract_ext4()
+      remove(input_img)
+
+
+def extract_img(main_project, scheduler=None):
+  """"Extract super/erofs/ext4 images
+
+  Adds an "<part>:extract" task per partition to `scheduler`, after the
+  extract_fw() tasks that produce its image. Without a scheduler the
+  partitions are extracted here one by one.
+  """
+  run = scheduler is None
+  if run:
+    scheduler = Scheduler()
+
+  source_dir = os.path.join(main_project, 'Source')
+  producers = [name for name in ('super:extract', 'payload:extract')
+               if name in scheduler]
+  for part in PARTITIONS:
+    deps = [name for name in (part+'.img:unzip', part+':sdat2img')
+            if name in scheduler]
+    if deps or producers or os.path.isfile(os.path.join(source_dir, part+'.img')):
+      scheduler.add(part+':extract', extract_partition, main_project, part,
+                    deps=deps+producers, resource=DISK)
+
+  if run:
+    scheduler.run()
 
 
 def display_rom_info(proj_dir: str):
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# File Name    :   firmware_plan.py
+"""
+    Edit_OEM_ROM_Project
+    Copyright (C) <2022>  <Abdalrohman Alnasier>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import functools
+import os
+import re
+import shutil
+import struct
+import zipfile
+from collections import namedtuple
+
+from loguru import logger
+
+BLOCK_SIZE = 4096
+SPARSE_HEADER = struct.Struct('<I4H4I')
+SPARSE_HEADER_MAGIC = 0xED26FF3A
+# local file header of a zip member: signature, then the lengths of the
+# file name and extra field that sit between it and the member data
+ZIP_LOCAL_HEADER = struct.Struct('<4s22xHH')
+
+# member name patterns, compiled once
+SUPER_RE = re.compile(r'super')
+SUPER_GZ_RE = re.compile(r'super.img.gz')
+SUPER_ZST_RE = re.compile(r'super.img.zst')
+SUPER_SPARSE_RE = re.compile(r'super.img$')
+SUPER_BR = 'super.new.dat.br'
+CHUNK_NUMBER_RE = re.compile(r'\d+')
+# boot/dtbo/vbmeta images are unpacked as they are
+OTHER_RE = re.compile(r'vbmeta_system|vbmeta|boot|dtbo')
+
+# A member of the zip: offset is where the data of a stored (uncompressed)
+# member starts in the zip, None for compressed or encrypted members.
+ZipMember = namedtuple('ZipMember', 'name size compressed_size offset')
+
+# One unit of extract work: kind is payload, img, sdat, super or other;
+# fmt the super image format (gz, zstd, sparse, brotli, sparsechunk);
+# output_bytes what it writes to disk (a lower bound where only the
+# compressed size is known, e.g. payload.bin, the size of the whole image
+# for a super image, which is more than the partitions unpacked from it).
+PlanItem = namedtuple('PlanItem', 'kind name partition fmt members output_bytes')
+
+
+@functools.lru_cache(maxsize=8)
+def _zip_index(path, mtime_ns, size):
+  members = {}
+  with zipfile.ZipFile(path, 'r') as zf:
+    fd = zf.fp.fileno()
+    for info in zf.infolist():
+      offset = None
+      if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1:
+        signature, name_len, extra_len = ZIP_LOCAL_HEADER.unpack(
+          os.pread(fd, ZIP_LOCAL_HEADER.size, info.header_offset))
+        if signature != b'PK\x03\x04':
+          raise zipfile.BadZipFile(f'Bad local header of {info.filename} in {path}')
+        offset = info.header_offset + ZIP_LOCAL_HEADER.size + name_len + extra_len
+      members[info.filename] = ZipMember(info.filename, info.file_size,
+                                         info.compress_size, offset)
+  return members
+
+
+def zip_index(input_zip):
+  """Read the central directory of input_zip once
+
+  The index is cached while the zip is not modified, so the extract steps
+  look members up without opening the archive again.
+
+  Returns:
+      dict: member name -> ZipMember.
+  """
+  st = os.stat(input_zip)
+  return _zip_index(os.path.realpath(input_zip), st.st_mtime_ns, st.st_size)
+
+
+class FirmwarePlan:
+  """What extract_fw() will do with a firmware zip, built from one read of
+  its central directory.
+
+  Members are classified by dict lookups on the partition names and a few
+  precompiled patterns. The items are in the order their tasks are added:
+  payload and partition images, the super image, the brotli images (largest
+  first, so they start early when run in parallel) and the other images.
+
+  Args:
+      input_zip (str): firmware zip.
+      partitions (list): partition names (the MAIN partitions of config.ini).
+  """
+
+  def __init__(self, input_zip, partitions):
+    self.input_zip = input_zip
+    self.members = zip_index(input_zip)
+    self.items = []
+    self.__classify(partitions)
+
+  def __classify(self, partitions):
+    img_names = {part+'.img': part for part in partitions}
+    br_names = {part+'.new.dat.br': part for part in partitions}
+    names = sorted(self.members)
+
+    super_members = []
+    sdat = []
+    for name in names:
+      if SUPER_RE.search(name) is not None:
+        super_members.append(name)
+      elif name == 'payload.bin':
+        self.__add('payload', name, None, None, [name], self.members[name].size)
+      elif name in br_names:
+        sdat.append(name)
+      elif name in img_names:
+        self.__add('img', name, img_names[name], None, [name],
+                   self.members[name].size)
+
+    if super_members:
+      fmt = self.__super_format(super_members)
+      if fmt is not None:
+        if fmt == 'sparsechunk':
+          super_members.sort(
+            key=lambda name: [int(n) for n in CHUNK_NUMBER_RE.findall(name)[:1]])
+        self.__add('super', super_members[0], 'super', fmt, super_members,
+                   self.__super_bytes(fmt, super_members))
+
+    sdat.sort(key=lambda name: -self.members[name].compressed_size)
+    for name in sdat:
+      part = br_names[name]
+      transfer_list = part+'.transfer.list'
+      if transfer_list not in self.members:
+        logger.warning(f"No {transfer_list} for {name}, skip it")
+        continue
+      self.__add('sdat', name, part, 'brotli', [name, transfer_list],
+                 self.__sdat_bytes(transfer_list))
+
+    planned = {m for item in self.items for m in item.members}
+    for name in names:
+      if name not in planned and OTHER_RE.search(name) is not None:
+        self.__add('other', name, None, None, [name], self.members[name].size)
+
+  def __add(self, kind, name, partition, fmt, members, output_bytes):
+    self.items.append(PlanItem(kind, name, partition, fmt, members, output_bytes))
+
+  @staticmethod
+  def __super_format(names):
+    """Same rules the super extraction always used, by member names"""
+    if len(names) == 1:
+      name = names[0]
+      if SUPER_GZ_RE.search(name) is not None:
+        return 'gz'
+      if SUPER_ZST_RE.search(name) is not None:
+        return 'zstd'
+      if SUPER_SPARSE_RE.search(name) is not None:
+        return 'sparse'
+      return None
+    if SUPER_BR in names:
+      return 'brotli'
+    return 'sparsechunk'
+
+  def __read(self, name, offset, size):
+    """Read bytes of a stored member, None if it is compressed"""
+    member = self.members[name]
+    if member.offset is None:
+      return None
+    with open(self.input_zip, 'rb') as f:
+      return os.pread(f.fileno(), min(size, member.size), member.offset + offset)
+
+  def __super_bytes(self, fmt, names):
+    if fmt == 'brotli':
+      return self.__sdat_bytes('super.transfer.list')
+    if fmt == 'sparse':
+      header = self.__read(names[0], 0, SPARSE_HEADER.size)
+      if header is not None and len(header) == SPARSE_HEADER.size:
+        fields = SPARSE_HEADER.unpack(header)
+        if fields[0] == SPARSE_HEADER_MAGIC:
+          return fields[5] * fields[6]
+    return sum(self.members[name].size for name in names)
+
+  def __sdat_bytes(self, transfer_list):
+    """Image size from the highest block a transfer list writes"""
+    if transfer_list not in self.members:
+      return 0
+    with zipfile.ZipFile(self.input_zip, 'r') as zf:
+      lines = zf.read(transfer_list).decode('ascii').splitlines()
+    end = 0
+    for line in lines[4:]:
+      cmd = line.split(' ')
+      if len(cmd) == 2 and cmd[0] in ('new', 'zero', 'erase'):
+        end = max([end] + [int(n) for n in cmd[1].split(',')[2::2]])
+    return end * BLOCK_SIZE
+
+  def kind(self, kind):
+    """Items of one kind"""
+    return [item for item in self.items if item.kind == kind]
+
+  @property
+  def formats(self):
+    return sorted({item.fmt for item in self.items if item.fmt})
+
+  @property
+  def partitions(self):
+    return [item.partition for item in self.items if item.partition]
+
+  @property
+  def input_bytes(self):
+    """Compressed bytes read from the zip"""
+    return sum(self.members[m].compressed_size
+               for item in self.items for m in item.members)
+
+  @property
+  def output_bytes(self):
+    """Bytes written by the extract steps (before unpacking filesystems)"""
+    return sum(item.output_bytes for item in self.items)
+
+  def log(self):
+    """Log the plan"""
+    for item in self.items:
+      logger.info("Plan: {:<7} {:<24} {:>14,} bytes{}", item.kind, item.name,
+                  item.output_bytes, f" ({item.fmt})" if item.fmt else "")
+    logger.info("Plan: {} item(s), {:,} bytes from the zip, {:,} bytes to write",
+                len(self.items), self.input_bytes, self.output_bytes)
+
+  def check_disk(self, output_folder):
+    """Check there is room for output_bytes in output_folder
+
+    Returns:
+        bool: True if there is enough free space.
+    """
+    path = os.path.abspath(output_folder)
+    while not os.path.exists(path):
+      path = os.path.dirname(path)
+    free = shutil.disk_usage(path).free
+    if free < self.output_bytes:
+      logger.error(f"Not enough space in {output_folder}: "
+                   f"{self.output_bytes:,} bytes needed, {free:,} free")
+      return False
+    return True
@@ -20,6 +20,7 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import importlib
 import os
 import platform
 import shutil
@@ -121,6 +122,46 @@ def RunCommand(arg, verbose=True, **kwargs):
   return output, proc.returncode
 
 
+def import_script(script):
+  """Import a python script (eg: bin/python/extract_ext4.py) as module.
+
+  The script directory is added to sys.path so the script's own imports
+  (eg: ext4) resolve like when it runs standalone.
+
+  Args:
+      script (path): Specify script path.
+
+  Returns:
+      module: imported module.
+  """
+  script_dir = os.path.dirname(os.path.realpath(script))
+  if script_dir not in sys.path:
+    sys.path.insert(0, script_dir)
+
+  return importlib.import_module(os.path.splitext(os.path.basename(script))[0])
+
+
+def progress_logger(title, step=10):
+  """Make a progress callback that logs every `step` percent.
+
+  Args:
+      title (str): Specify text printed before the percent.
+      step (int): Specify percent between two log lines. Defaults to 10.
+
+  Returns:
+      function: callback(done, total).
+  """
+  last = [-step]
+
+  def progress(done, total):
+    percent = done * 100 // total if total else 100
+    if percent - last[0] >= step or (percent == 100 and last[0] != 100):
+      last[0] = percent
+      logger.info("{}: {}%", title, percent)
+
+  return progress
+
+
 def mkdir(dir_name):
   """like mkdir -p in gnu linux.
   ex: mkdir('test/1/2/3')
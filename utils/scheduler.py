@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*-coding:utf-8 -*-
+# File Name    :   scheduler.py
+"""
+    Edit_OEM_ROM_Project
+    Copyright (C) <2022>  <Abdalrohman Alnasier>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from loguru import logger
+
+# resource classes a task can hold while it runs
+DISK = 'disk'
+CPU = 'cpu'
+
+# default cap of concurrent disk-heavy tasks (unzip, image copies)
+DISK_JOBS = 4
+
+
+class Task:
+  """A unit of work in the scheduler graph.
+
+  Task names are "<partition>:<stage>" (eg: system:sdat2img), the stage
+  part is used to sum wall time per stage.
+  """
+
+  def __init__(self, name, func, args, kwargs, deps, resource):
+    self.name = name
+    self.func = func
+    self.args = args
+    self.kwargs = kwargs
+    self.deps = deps
+    self.resource = resource
+    self.elapsed = None
+    self.state = 'pending'
+
+  @property
+  def stage(self):
+    return self.name.split(':', 1)[-1]
+
+
+class Scheduler:
+  """Run tasks on a thread pool as soon as their dependencies finished.
+
+  Every task may hold one resource (DISK or CPU) while it runs, so
+  disk-heavy stages are capped separately from CPU-heavy ones. The heavy
+  work is done in subprocesses or in calls that release the GIL (zlib,
+  brotli, copy_file_range, pwrite), so threads are enough to keep the
+  cores busy. With jobs=1 tasks run one by one in the order they were added.
+
+  Args:
+      jobs (int): Specify max tasks running at once. Defaults to 1.
+      disk_jobs (int): Specify max DISK tasks. Defaults to min(jobs, DISK_JOBS).
+      cpu_jobs (int): Specify max CPU tasks. Defaults to jobs.
+  """
+
+  def __init__(self, jobs=1, disk_jobs=None, cpu_jobs=None):
+    self.jobs = max(1, jobs)
+    self.limits = {
+      DISK: max(1, disk_jobs or min(self.jobs, DISK_JOBS)),
+      CPU: max(1, cpu_jobs or self.jobs),
+    }
+    self.tasks = {}
+    self.lock = threading.Lock()
+
+  def __contains__(self, name):
+    return name in self.tasks
+
+  def add(self, name, func, *args, deps=(), resource=None, **kwargs):
+    """Add a task running func(*args, **kwargs) after all deps.
+
+    Dependencies must be added before the tasks that need them, which
+    also keeps the graph free of cycles.
+
+    Returns:
+        str: task name.
+    """
+    with self.lock:
+      if name in self.tasks:
+        raise ValueError(f"Task {name} already added")
+      for dep in deps:
+        if dep not in self.tasks:
+          raise ValueError(f"Task {name} depends on unknown task {dep}")
+      self.tasks[name] = Task(name, func, args, kwargs, tuple(deps), resource)
+    return name
+
+  def __run_task(self, task):
+    start = time.time()
+    try:
+      task.func(*task.args, **task.kwargs)
+    finally:
+      task.elapsed = time.time() - start
+      logger.info("[{}] done in {:.1f}s", task.name, task.elapsed)
+
+  def __ready(self, running):
+    """Yield pending tasks whose deps are done and resource has a slot."""
+    for task in list(self.tasks.values()):
+      if task.state != 'pending':
+        continue
+      states = [self.tasks[dep].state for dep in task.deps]
+      if any(s in ('failed', 'skipped') for s in states):
+        task.state = 'skipped'
+        logger.error("[{}] skipped, a dependency failed", task.name)
+        continue
+      if any(s != 'done' for s in states):
+        continue
+      if task.resource is not None and \
+              running.get(task.resource, 0) >= self.limits[task.resource]:
+        continue
+      yield task
+
+  def run(self):
+    """Run all added tasks and report wall time per stage.
+
+    Raises:
+        Exception: the first error raised by a task, after every task that
+            does not depend on it has finished.
+    """
+    start = time.time()
+    error = None
+    futures = {}
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+      while True:
+        with self.lock:
+          for task in self.__ready(running):
+            if len(futures) >= self.jobs:
+              break
+            task.state = 'running'
+            running[task.resource] = running.get(task.resource, 0) + 1
+            futures[pool.submit(self.__run_task, task)] = task
+
+        if not futures:
+          break
+
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+          task = futures.pop(future)
+          running[task.resource] -= 1
+          if future.exception() is not None:
+            task.state = 'failed'
+            logger.opt(exception=future.exception()).error(
+              "[{}] failed", task.name)
+            error = error or future.exception()
+          else:
+            task.state = 'done'
+
+    self.__report(time.time() - start)
+    if error is not None:
+      raise error
+
+  def __report(self, wall_time):
+    stages = {}
+    for task in self.tasks.values():
+      if task.elapsed is not None:
+        total, count = stages.get(task.stage, (0.0, 0))
+        stages[task.stage] = (total + task.elapsed, count + 1)
+
+    for stage, (total, count) in sorted(stages.items(), key=lambda s: -s[1][0]):
+      logger.info("Stage {}: {:.1f}s in {} task(s)", stage, total, count)
+    logger.info("Total wall time: {:.1f}s with {} job(s)", wall_time, self.jobs)